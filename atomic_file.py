@@ -0,0 +1,28 @@
+# Description: Writes a file under a temporary name next to it and renames it into place when done,
+# so a process reading it at the same time never sees half a file.
+
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode='w', newline=None, fsync=False):
+    """
+    Opens a temporary file for writing in `mode` and replaces `path` with it once the block ends.
+    The temporary name is this process's own; if the block raises, it is removed and `path` is left as it was.
+    With `fsync`, the content is on disk before the rename.
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, mode, newline=newline) as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
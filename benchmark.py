@@ -0,0 +1,445 @@
+# Description: End-to-end throughput benchmark of process_files.py.
+# Generates zip fixtures (an MP4 and its metadata json), serves them from a fake Drive, starts the
+# mock Gong server with the requested latency, bandwidth and error rates, then runs main() in a
+# separate process against both. Reports files/sec, MB/sec, per-stage p50/p95/p99 latencies,
+# peak RSS and peak disk use in DEST_DIR, the startup time of an import and of a --dry-run, and writes
+# them as JSON so runs can be compared.
+# With --workers several processes share the work through the state database, and --kill-worker-after
+# kills the first of them mid-run to check that the others take its files over.
+# Usage: python benchmark.py [--files 20] [--video-mb 8] [--pipeline] [--gong-latency 0.1] [--workers 3] [--set NAME=VALUE ...]
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from threading import Thread, Event
+
+import requests
+
+from fake_drive_server import make_server, start_in_thread
+from pipeline import folder_size
+from state_server import make_server as make_state_server
+from state_store import StateStore, UPLOADED
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['download', 'unpack', 'create_call', 'upload']
+
+# Settings are patched before process_files imports them, its `from settings import *` copies them
+IMPORTER = """
+import json, sys
+import settings
+for name, value in json.loads(sys.argv[1]).items():
+    setattr(settings, name, value)
+import process_files
+"""
+RUNNER = IMPORTER + "process_files.main()\n"
+PLANNER = IMPORTER + "print(json.dumps(process_files.plan_run()))\n"
+
+# MP4 fixtures
+
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+def box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def full_box(box_type, payload, flags=0):
+    return box(box_type, struct.pack('>I', flags) + payload)
+
+def build_moov(duration, fps=30, width=1280, height=720):
+    movie_timescale = 1000
+    track_timescale = fps * 512
+    frames = int(duration * fps)
+    mvhd = full_box(b'mvhd', struct.pack('>IIII', 0, 0, movie_timescale, int(duration * movie_timescale))
+                    + struct.pack('>IH10x', 0x10000, 0x100) + MATRIX + bytes(24) + struct.pack('>I', 2))
+    tkhd = full_box(b'tkhd', struct.pack('>III4xI8xhhH2x', 0, 0, 1, int(duration * movie_timescale), 0, 0, 0)
+                    + MATRIX + struct.pack('>II', width << 16, height << 16), flags=3)
+    mdhd = full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, track_timescale, frames * 512, 0x55c4, 0))
+    hdlr = full_box(b'hdlr', struct.pack('>I4s12x', 0, b'vide') + b'VideoHandler\0')
+    stts = full_box(b'stts', struct.pack('>III', 1, frames, 512))
+    stbl = box(b'stbl', stts)
+    mdia = box(b'mdia', mdhd + hdlr + box(b'minf', stbl))
+    return box(b'moov', mvhd + box(b'trak', tkhd + mdia))
+
+def write_mp4(f, duration, media_size, seed):
+    """
+    Writes an MP4 with the moov box after the media data, like most recorders do.
+    The media data is random bytes seeded per file, so every fixture has different content.
+    """
+    rng = random.Random(seed)
+    block = rng.randbytes(min(media_size, 1024 * 1024))
+    f.write(box(b'ftyp', b'isom' + struct.pack('>I', 512) + b'isomiso2avc1mp41'))
+    f.write(struct.pack('>I4s', 8 + media_size, b'mdat'))
+    remaining = media_size
+    while remaining > 0:
+        chunk = block[:remaining]
+        f.write(chunk)
+        remaining -= len(chunk)
+    f.write(build_moov(duration))
+
+def generate_fixtures(folder, count, video_size, short_fraction, participants, seed):
+    rng = random.Random(seed)
+    short_ids = set(rng.sample(range(count), int(count * short_fraction)))
+    for index in range(count):
+        duration = 10 if index in short_ids else 120
+        info = {
+            'MeetingTitle': f"Benchmark meeting {index}",
+            'ParticpantNames': rng.sample(participants, min(3, len(participants))),
+            'StartTime': '2024-01-15 10:00:00',
+        }
+        with zipfile.ZipFile(os.path.join(folder, f"recording{index:05d}.zip"), 'w', zipfile.ZIP_STORED) as zip_ref:
+            zip_ref.writestr('info.json', json.dumps(info))
+            with zip_ref.open(f"video{index}.mp4", 'w', force_zip64=True) as f:
+                write_mp4(f, duration, video_size, f"{seed}-{index}")
+
+def write_file_list(path, files):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['title', 'mimeType', 'id', 'size', 'md5Checksum'])
+        writer.writeheader()
+        for file in files.values():
+            writer.writerow({'title': file['name'], 'mimeType': file['mimeType'], 'id': file['id'],
+                             'size': file['size'], 'md5Checksum': file['md5Checksum']})
+
+# Measurements
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+class DiskSampler:
+    """
+    Samples the size of a folder every `interval` seconds on a thread and keeps the peak.
+    """
+    def __init__(self, folder, interval=0.05):
+        self.folder = folder
+        self.interval = interval
+        self.peak = 0
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name="disk-sampler", daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, folder_size(self.folder))
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.peak
+
+def read_stage_times(log_dir):
+    stage_times = {}
+    for name in os.listdir(log_dir):
+        if not name.startswith('process_files_'):
+            continue
+        with open(os.path.join(log_dir, name), 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                # Every stage logs one record with its duration when it ends
+                if 'stage' in entry and 'duration' in entry:
+                    stage_times.setdefault(entry['stage'], []).append(entry['duration'])
+    return stage_times
+
+def summarize_stage_times(stage_times):
+    summary = {}
+    for stage in STAGES + sorted(set(stage_times) - set(STAGES)):
+        values = stage_times.get(stage, [])
+        summary[stage] = {
+            'count': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'max': max(values) if values else None,
+        }
+    return summary
+
+def summarize_concurrency(snapshots):
+    """
+    Adds up the concurrency adjustments of every worker by pool and action, and lists each worker's final limits.
+    """
+    adjustments = {}
+    final_limits = {}
+    for snapshot in snapshots:
+        for entry in snapshot.get('concurrency_adjustments_total', {}).get('values', []):
+            actions = adjustments.setdefault(entry['labels']['pool'], {})
+            action = entry['labels']['action']
+            actions[action] = actions.get(action, 0) + entry['value']
+        for entry in snapshot.get('concurrency_limit', {}).get('values', []):
+            final_limits.setdefault(entry['labels']['pool'], []).append(entry['value'])
+    return {'adjustments': adjustments, 'final_limits': final_limits}
+
+# Servers
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_mock_gong(port, env, log_path, timeout=30):
+    log_file = open(log_path, 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'mock_gong_server:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+        cwd=REPO_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Mock Gong server exited, see {log_path}")
+        try:
+            requests.post(f"http://127.0.0.1:{port}/reset", timeout=1)
+            return process
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"Mock Gong server did not start within {timeout}s")
+
+def measure_startup(overrides, work_dir, env):
+    """
+    Times a bare import of process_files and a dry run in fresh processes, nothing in either may log in
+    or open a file. Returns (import seconds, dry run seconds, plan).
+    """
+    timings = []
+    for script in (IMPORTER, PLANNER):
+        started_at = time.monotonic()
+        output = subprocess.run([sys.executable, '-c', script, json.dumps(overrides)], cwd=work_dir, env=env,
+                                capture_output=True, check=True, timeout=60).stdout
+        timings.append(time.monotonic() - started_at)
+    return timings[0], timings[1], json.loads(output)
+
+def parse_overrides(pairs):
+    overrides = {}
+    for pair in pairs:
+        name, _, value = pair.partition('=')
+        try:
+            overrides[name] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[name] = value
+    return overrides
+
+
+def run_benchmark(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='gong-benchmark-')
+    fixtures_dir = os.path.join(work_dir, 'fixtures')
+    data_dir = os.path.join(work_dir, 'data')
+    log_dir = os.path.join(work_dir, 'logs')
+    dest_dir = os.path.join(work_dir, 'dest')
+    for folder in (fixtures_dir, data_dir, log_dir, dest_dir):
+        os.makedirs(folder, exist_ok=True)
+
+    participants = [f"Participant {index}" for index in range(20)]
+    # Half the participants are Gong users, the run fetches them from the mock Gong server
+    users_file = os.path.join(work_dir, 'gong_users.json')
+    with open(users_file, 'w') as f:
+        json.dump([{'id': str(7000000000000000000 + index), 'firstName': 'Participant', 'lastName': str(index),
+                    'emailAddress': f"participant{index}@example.com", 'active': True,
+                    'settings': {'telephonyCallsImported': True}} for index in range(10)], f)
+
+    print(f"Generating {args.files} fixtures of {args.video_mb} MB in {fixtures_dir}")
+    generate_fixtures(fixtures_dir, args.files, int(args.video_mb * 1024 * 1024), args.short_fraction, participants, args.seed)
+
+    drive_server = make_server(fixtures_dir, latency=args.drive_latency, bandwidth=args.drive_bandwidth * 1024 * 1024,
+                               drop_rate=args.drive_drop_rate)
+    start_in_thread(drive_server)
+    write_file_list(os.path.join(data_dir, 'file_list.csv'), drive_server.files)
+
+    gong_port = free_port()
+    gong_env = dict(os.environ)
+    gong_env.update({
+        'MOCK_GONG_LATENCY': str(args.gong_latency),
+        'MOCK_GONG_BANDWIDTH': str(args.gong_bandwidth * 1024 * 1024),
+        'MOCK_GONG_429_RATE': str(args.gong_429_rate),
+        'MOCK_GONG_ERROR_RATE': str(args.gong_error_rate),
+        'MOCK_GONG_RETRY_AFTER': str(args.gong_retry_after),
+        'MOCK_GONG_VERIFY_UPLOADS': '1' if args.verify_uploads else '0',
+        'MOCK_GONG_USERS_FILE': users_file,
+        'MOCK_GONG_USERS_PAGE_SIZE': '4',
+    })
+    gong_process = start_mock_gong(gong_port, gong_env, os.path.join(log_dir, 'mock_gong.log'))
+
+    overrides = parse_overrides(args.set)
+    # Runs may overlap, and the metrics snapshot is written on exit anyway
+    overrides.setdefault('METRICS_PORT', 0)
+    if args.pipeline:
+        overrides['PIPELINE_MODE'] = True
+    if args.stream_from_zip:
+        overrides['STREAM_FROM_ZIP'] = True
+    env = dict(os.environ)
+    state_server = None
+    if args.state_server:
+        # The workers share the state over HTTP, as they would from several hosts
+        state_server = make_state_server(StateStore(os.path.join(data_dir, 'state.db')), port=0)
+        Thread(target=state_server.serve_forever, name="state-server", daemon=True).start()
+        env['STATE_SERVER_URL'] = f"http://127.0.0.1:{state_server.server_port}"
+    env.update({
+        'PYTHONPATH': os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')])),
+        'DRIVE_API_URL': f"http://127.0.0.1:{drive_server.server_port}",
+        'DRIVE_ACCESS_TOKEN': 'benchmark',
+        'GONG_API_URL': f"http://127.0.0.1:{gong_port}",
+        'GONG_KEY': 'benchmark',
+        'GONG_SECRET': 'benchmark',
+        'DEFAULT_USER_ID': '1',
+        'DEFAULT_USER_NAME': 'Benchmark User',
+    })
+
+    import_seconds, dry_run_seconds, plan = measure_startup(overrides, work_dir, env)
+    print(f"Import took {import_seconds:.3f}s, dry run {dry_run_seconds:.3f}s: {plan['pending']} files, {plan['pending_bytes'] / 1024 / 1024:.1f} MB to download")
+
+    print(f"Running {args.workers} process_files worker(s) with {overrides or 'default settings'}")
+    sampler = DiskSampler(dest_dir)
+    sampler.start()
+    started_at = time.monotonic()
+    workers = []
+    killed = None
+    try:
+        for number in range(args.workers):
+            worker_overrides = dict(overrides)
+            suffix = f".{number}" if args.workers > 1 else ''
+            if args.workers > 1:
+                worker_overrides['METRICS_SNAPSHOT'] = os.path.join(log_dir, f"metrics{suffix}.json")
+            with open(os.path.join(log_dir, f"process_files{suffix}.out"), 'w') as out:
+                workers.append(subprocess.Popen([sys.executable, '-c', RUNNER, json.dumps(worker_overrides)], cwd=work_dir,
+                                                env={**env, 'WORKER_ID': f"benchmark-{number}"}, stdout=out, stderr=subprocess.STDOUT))
+        if args.kill_worker_after is not None:
+            try:
+                workers[0].wait(args.kill_worker_after)
+            except subprocess.TimeoutExpired:
+                # Like a crash: no cleanup, its leases run out on their own
+                workers[0].kill()
+                killed = 0
+                print(f"Killed worker 0 after {args.kill_worker_after}s")
+        returncodes = [worker.wait() for worker in workers]
+        elapsed = time.monotonic() - started_at
+        # Only the workers have been waited for so far, so this is the peak of the largest
+        peak_rss_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        gong_stats = requests.get(f"http://127.0.0.1:{gong_port}/stats", timeout=10).json()
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.kill()
+        peak_disk = sampler.stop()
+        gong_process.terminate()
+        gong_process.wait()
+        drive_server.shutdown()
+        if state_server:
+            state_server.shutdown()
+            state_server.state_store.close()
+
+    state_store = StateStore(os.path.join(data_dir, 'state.db'))
+    states = state_store.count_by_state()
+    uploaded_ids = {file_id for file_id in drive_server.files if (state_store.get(file_id) or {}).get('state') == UPLOADED}
+    state_store.close()
+    finished = sum(count for state, count in states.items() if state in ('uploaded', 'short', 'error'))
+    uploaded_bytes = sum(int(drive_server.files[file_id]['size']) for file_id in uploaded_ids)
+    total_bytes = sum(int(file['size']) for file in drive_server.files.values())
+
+    metrics_snapshots = []
+    for name in sorted(os.listdir(log_dir)):
+        if name.startswith('metrics') and name.endswith('.json'):
+            with open(os.path.join(log_dir, name), 'r') as f:
+                metrics_snapshots.append(json.load(f)['metrics'])
+
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'work_dir', 'keep')},
+        'settings': overrides,
+        # The killed worker's exit code is left out
+        'returncode': max((code for number, code in enumerate(returncodes) if number != killed), key=abs, default=0),
+        'returncodes': returncodes,
+        'elapsed_seconds': elapsed,
+        'import_seconds': import_seconds,
+        'dry_run_seconds': dry_run_seconds,
+        'plan': plan,
+        'files': len(drive_server.files),
+        'input_bytes': total_bytes,
+        'states': states,
+        'files_per_second': finished / elapsed,
+        'uploaded_files_per_second': len(uploaded_ids) / elapsed,
+        'uploaded_mb_per_second': uploaded_bytes / 1024 / 1024 / elapsed,
+        'stages': summarize_stage_times(read_stage_times(log_dir)),
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': peak_rss_kb / 1024,
+        'peak_disk_mb': peak_disk / 1024 / 1024,
+        'gong': gong_stats,
+        'concurrency': summarize_concurrency(metrics_snapshots),
+        # One snapshot per worker
+        'metrics': metrics_snapshots[0] if len(metrics_snapshots) == 1 else metrics_snapshots,
+    }
+    if args.keep:
+        results['work_dir'] = work_dir
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def print_results(results):
+    print(f"Finished in {results['elapsed_seconds']:.2f}s with exit code {results['returncode']} - STATES: {results['states']}")
+    print(f"  {results['files_per_second']:.2f} files/s, {results['uploaded_files_per_second']:.2f} uploads/s, {results['uploaded_mb_per_second']:.2f} MB/s uploaded")
+    print(f"  peak RSS {results['peak_rss_mb']:.1f} MB, peak disk {results['peak_disk_mb']:.1f} MB")
+    print(f"  startup: import {results['import_seconds']:.3f}s, dry run {results['dry_run_seconds']:.3f}s")
+    gong = results['gong']
+    print(f"  Gong received {gong['calls']} calls and {gong['uploads']} uploads, {len(gong['duplicate_client_unique_ids'])} duplicate clientUniqueIds, {gong['user_pages']} user pages")
+    for pool, limits in sorted(results['concurrency']['final_limits'].items()):
+        actions = results['concurrency']['adjustments'].get(pool, {})
+        print(f"  concurrency {pool}: {actions.get('decrease', 0):g} decreases, {actions.get('increase', 0):g} increases, final limit {', '.join(f'{limit:g}' for limit in limits)}")
+    for stage, summary in results['stages'].items():
+        if summary['count']:
+            print(f"  {stage:<12} n={summary['count']:<5} p50={summary['p50']:.3f}s p95={summary['p95']:.3f}s p99={summary['p99']:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark of process_files.py against a fake Drive and the mock Gong server')
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--video-mb', type=float, default=8, help='Size of the media data of each video')
+    parser.add_argument('--short-fraction', type=float, default=0.2, help='Fraction of videos shorter than a minute')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--pipeline', action='store_true', help='Run with PIPELINE_MODE')
+    parser.add_argument('--stream-from-zip', action='store_true', help='Run with STREAM_FROM_ZIP')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes sharing the file list')
+    parser.add_argument('--state-server', action='store_true', help='Have the workers share the state through state_server.py')
+    parser.add_argument('--kill-worker-after', type=float, help='Kill the first worker after this many seconds')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='Override a setting, the value is parsed as JSON if it can be')
+    parser.add_argument('--drive-latency', type=float, default=0.0, help='Seconds added to every Drive request')
+    parser.add_argument('--drive-bandwidth', type=float, default=0.0, help='MB/s per Drive download, 0 for unlimited')
+    parser.add_argument('--drive-drop-rate', type=float, default=0.0, help='Fraction of Drive downloads cut off halfway')
+    parser.add_argument('--gong-latency', type=float, default=0.0, help='Seconds added to every Gong request')
+    parser.add_argument('--gong-bandwidth', type=float, default=0.0, help='MB/s per Gong upload, 0 for unlimited')
+    parser.add_argument('--gong-429-rate', type=float, default=0.0, help='Fraction of Gong requests answered with 429')
+    parser.add_argument('--gong-error-rate', type=float, default=0.0, help='Fraction of Gong requests answered with 503')
+    parser.add_argument('--gong-retry-after', type=float, default=1, help='Retry-After seconds of the 429 responses')
+    parser.add_argument('--check-backoff', action='store_true',
+                        help='Exit with 1 unless the upload concurrency was decreased, use with --gong-429-rate')
+    parser.add_argument('--verify-uploads', action='store_true', help='Have the mock Gong server hash every upload')
+    parser.add_argument('--work-dir', help='Folder for the fixtures, data, logs and downloads, a temporary folder by default')
+    parser.add_argument('--keep', action='store_true', help='Keep the work folder')
+    parser.add_argument('--output', help='JSON results file, benchmark_results/benchmark_<timestamp>.json by default')
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print_results(results)
+    output = args.output or os.path.join('benchmark_results', datetime.datetime.now().strftime("benchmark_%Y%m%d%H%M%S.json"))
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if args.check_backoff:
+        decreases = results['concurrency']['adjustments'].get('upload', {}).get('decrease', 0)
+        if not decreases:
+            print(f"No upload concurrency decrease with --gong-429-rate {args.gong_429_rate}")
+            sys.exit(1)
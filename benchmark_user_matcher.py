@@ -0,0 +1,124 @@
+# Description: Micro-benchmark of the participant name to Gong user id lookup.
+# Compares the indexed UserMatcher with the linear substring scan it replaced.
+# Before timing it checks the matcher on names that must and must not match.
+# Usage: python benchmark_user_matcher.py [--users 10000] [--names 2000]
+
+import argparse
+import random
+import string
+import sys
+import time
+
+from user_directory import build_user_map
+from user_matcher import UserMatcher
+
+
+def random_word(rng, length):
+    return rng.choice(string.ascii_uppercase) + ''.join(rng.choice(string.ascii_lowercase) for _ in range(length - 1))
+
+def generate_users(count, rng):
+    users = []
+    for index in range(count):
+        first_name = random_word(rng, rng.randint(3, 9))
+        last_name = random_word(rng, rng.randint(4, 12))
+        users.append({
+            'id': str(7000000000000000000 + index),
+            'firstName': first_name,
+            'lastName': last_name,
+            'emailAddress': f"{first_name}.{last_name}{index}@example.com".lower(),
+            'active': True,
+            'settings': {'telephonyCallsImported': True},
+        })
+    return users
+
+def generate_names(users, count, rng):
+    names = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.4:
+            user = rng.choice(users)
+            names.append(f"{user['firstName']} {user['lastName']}")
+        elif roll < 0.6:
+            user = rng.choice(users)
+            names.append(f"{user['firstName']} {user['lastName']} (Kaia)")
+        else:
+            # Customers and other participants that are not Gong users
+            names.append(f"{random_word(rng, 7)} {random_word(rng, 8)}")
+    return names
+
+# Participant names and the user they must match, None where a variant only appears inside other words
+MATCH_USERS = [
+    {'id': '1', 'firstName': 'Ed', 'lastName': 'Park', 'emailAddress': 'ed.park@example.com',
+     'active': True, 'settings': {'telephonyCallsImported': True}},
+    {'id': '2', 'firstName': 'Al', 'lastName': 'Li', 'emailAddress': 'al.li@example.com',
+     'active': True, 'settings': {'telephonyCallsImported': True}},
+]
+MATCH_CASES = [
+    ("Ed Park", '1'),
+    ("ed  park", '1'),
+    ("Ed Park (Kaia)", '1'),
+    ("E Park", '1'),
+    ("<ed.park@example.com>", '1'),
+    ("Al Li", '2'),
+    ("Call with Al Li", '2'),
+    ("Mike Parker", None),
+    ("Ted Parkinson", None),
+    ("Natalia Lima", None),
+]
+
+def check_matches():
+    """
+    Returns the (name, expected, matched) of every case the matcher gets wrong.
+    """
+    matcher = UserMatcher(build_user_map(MATCH_USERS))
+    return [(name, expected, matcher.match(name)) for name, expected in MATCH_CASES if matcher.match(name) != expected]
+
+def linear_scan(user_map, name):
+    if name in user_map:
+        return user_map[name]
+    for key, value in user_map.items():
+        if key in name:
+            return value
+    return None
+
+def timed(function, names):
+    start = time.perf_counter()
+    for name in names:
+        function(name)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the participant name to Gong user id lookup')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--names', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    failures = check_matches()
+    for name, expected, matched in failures:
+        print(f"{name!r} matched {matched}, expected {expected}")
+    if failures:
+        sys.exit(1)
+    print(f"match checks:  {len(MATCH_CASES)} ok")
+
+    rng = random.Random(args.seed)
+    users = generate_users(args.users, rng)
+    user_map = build_user_map(users)
+    names = generate_names(users, args.names, rng)
+
+    start = time.perf_counter()
+    matcher = UserMatcher(user_map)
+    build_time = time.perf_counter() - start
+
+    linear_time = timed(lambda name: linear_scan(user_map, name), names)
+    matcher_time = timed(matcher.match, names)
+
+    print(f"users: {args.users} keys: {len(user_map)} names: {args.names}")
+    print(f"matcher build: {build_time:.3f}s")
+    print(f"linear scan:   {linear_time:.3f}s ({linear_time / args.names * 1e6:.1f} us/name)")
+    print(f"user matcher:  {matcher_time:.3f}s ({matcher_time / args.names * 1e6:.1f} us/name)")
+    print(f"speedup:       {linear_time / matcher_time:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
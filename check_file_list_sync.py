@@ -0,0 +1,118 @@
+# Description: Checks create_file_list.py against the fake Drive server. A list in the old format is
+# listed again in full, then files are added, deleted, trashed and moved to another folder in the fixture
+# folder, and the next sync must pick up exactly those changes from the changes feed.
+# Usage: python check_file_list_sync.py [--keep]
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from fake_drive_server import make_server, start_in_thread, FOLDER_ID, TRASH_FOLDER
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# Run in the work folder, the settings put data/ under the current directory
+SYNCER = """
+import create_file_list, settings
+from drive_client import DriveClient
+create_file_list.sync_file_list(DriveClient(settings.DRIVE_API_URL, lambda: settings.DRIVE_ACCESS_TOKEN), settings.GOOGLE_FOLDER_ID)
+"""
+
+
+def write_fixture(folder, name, size):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, name), 'wb') as f:
+        f.write(os.urandom(size))
+
+def read_list(path):
+    with open(path, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        return reader.fieldnames, list(reader)
+
+def sync(work_dir, env):
+    output = subprocess.run([sys.executable, '-c', SYNCER], cwd=work_dir, env=env, capture_output=True, text=True, timeout=60)
+    if output.returncode:
+        raise RuntimeError(f"Sync failed:\n{output.stdout}{output.stderr}")
+    return output.stdout.strip().splitlines()[-1]
+
+def check(description, rows, server, expected_ids):
+    """
+    Returns the problems with a synced list: the wrong files, or sizes and checksums that don't match the fake Drive.
+    """
+    problems = []
+    ids = [row['id'] for row in rows]
+    if ids != expected_ids:
+        problems.append(f"{description}: listed {ids}, expected {expected_ids}")
+    for row in rows:
+        file = server.files.get(row['id'])
+        if file and (row['size'], row['md5Checksum']) != (file['size'], file['md5Checksum']):
+            problems.append(f"{description}: {row['id']} has size {row['size']!r} and md5 {row['md5Checksum']!r}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the full and incremental file list sync against the fake Drive')
+    parser.add_argument('--keep', action='store_true', help='Keep the work folder')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='gong-sync-check-')
+    fixtures_dir = os.path.join(work_dir, 'fixtures')
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir)
+    for name in ('a.zip', 'b.zip', 'c.zip', 'd.zip'):
+        write_fixture(fixtures_dir, name, 1000)
+
+    server = make_server(fixtures_dir)
+    start_in_thread(server)
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')])),
+        'DRIVE_API_URL': f"http://127.0.0.1:{server.server_port}",
+        'DRIVE_ACCESS_TOKEN': 'check',
+        'GOOGLE_FOLDER_ID': FOLDER_ID,
+    })
+    list_path = os.path.join(data_dir, 'file_list.csv')
+    problems = []
+    try:
+        # A list and token left by an older version, without sizes
+        with open(list_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['title', 'mimeType', 'id'])
+            writer.writeheader()
+            writer.writerow({'title': 'a.zip', 'mimeType': 'application/zip', 'id': 'a'})
+        with open(os.path.join(data_dir, 'drive_changes_token.json'), 'w') as f:
+            json.dump({'folder_id': FOLDER_ID, 'startPageToken': str(server.rescan())}, f)
+        print(f"old list:    {sync(work_dir, env)}")
+        problems += check("old list", read_list(list_path)[1], server, ['a', 'b', 'c', 'd'])
+
+        write_fixture(fixtures_dir, 'e.zip', 2000)
+        os.remove(os.path.join(fixtures_dir, 'a.zip'))
+        os.makedirs(os.path.join(fixtures_dir, TRASH_FOLDER))
+        shutil.move(os.path.join(fixtures_dir, 'b.zip'), os.path.join(fixtures_dir, TRASH_FOLDER, 'b.zip'))
+        os.makedirs(os.path.join(fixtures_dir, 'other'))
+        shutil.move(os.path.join(fixtures_dir, 'c.zip'), os.path.join(fixtures_dir, 'other', 'c.zip'))
+        print(f"changes:     {sync(work_dir, env)}")
+        columns, rows = read_list(list_path)
+        problems += check("changes", rows, server, ['d', 'e'])
+
+        print(f"no changes:  {sync(work_dir, env)}")
+        if read_list(list_path) != (columns, rows):
+            problems.append("no changes: the list changed")
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"Work folder: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+    print("file list sync: ok")
+
+
+if __name__ == "__main__":
+    main()
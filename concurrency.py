@@ -0,0 +1,152 @@
+# Description: AIMD (additive increase, multiplicative decrease) concurrency limit for a pool of workers.
+# Workers take a slot before each unit of work; every interval the limit grows by one if the slots were
+# all in use and nothing degraded, and is halved on throttling, errors or a rise in time per byte.
+
+import logging
+import time
+from contextlib import contextmanager
+from threading import Thread, Condition, Event
+
+from metrics import counter, gauge
+
+CONCURRENCY_LIMIT = gauge('concurrency_limit', 'Active workers allowed per pool', ['pool'])
+CONCURRENCY_ADJUSTMENTS = counter('concurrency_adjustments_total', 'Concurrency limit decisions', ['pool', 'action'])
+
+
+class AdaptiveLimit:
+    """
+    Lets up to `limit` workers of the pool `name` run at once, with `minimum <= limit <= maximum`.
+
+    Work runs inside `slot()`; exceptions of the `congestion_errors` types count as errors.
+    `record_bytes(n)` adds transferred bytes and `record_throttle()` a 429 or retried request.
+    Every `interval` seconds `adjust()` looks at the window since the last call:
+    - halves the limit if errors and throttles are more than `error_rate` of the attempts,
+    - halves it if the seconds per byte rose above `latency_tolerance` times the best seen,
+    - adds one if all slots were in use at some point,
+    - otherwise keeps it.
+    With `adaptive=False` the limit stays where it started.
+    """
+    def __init__(self, name, initial, minimum, maximum, interval=10.0, error_rate=0.05, latency_tolerance=2.0,
+                 congestion_errors=(Exception,), adaptive=True, logger=None):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(maximum, initial))
+        self.interval = interval
+        self.error_rate = error_rate
+        self.latency_tolerance = latency_tolerance
+        self.congestion_errors = congestion_errors
+        self.adaptive = adaptive
+        self.logger = logger or logging.getLogger(__name__)
+        self.condition = Condition()
+        self.active = 0
+        self.best_cost = None
+        self._reset_window()
+        self.stopped = Event()
+        self.thread = None
+        CONCURRENCY_LIMIT.set(self.limit, pool=name)
+
+    def _reset_window(self):
+        self.completed = 0
+        self.errors = 0
+        self.throttles = 0
+        self.busy_seconds = 0.0
+        self.bytes = 0
+        self.peak_active = self.active
+        self.window_started_at = time.monotonic()
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+        started_at = time.monotonic()
+        congested = False
+        try:
+            yield
+        except self.congestion_errors:
+            congested = True
+            raise
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.completed += 1
+                self.errors += congested
+                self.busy_seconds += time.monotonic() - started_at
+                self.condition.notify()
+
+    def record_bytes(self, count):
+        with self.condition:
+            self.bytes += count
+
+    def record_throttle(self):
+        with self.condition:
+            self.throttles += 1
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = max(self.minimum, min(self.maximum, limit))
+            self.condition.notify_all()
+        CONCURRENCY_LIMIT.set(self.limit, pool=self.name)
+
+    def adjust(self):
+        """
+        Applies one AIMD decision to the window since the last call and returns (action, reason).
+        """
+        with self.condition:
+            completed, errors, throttles = self.completed, self.errors, self.throttles
+            busy_seconds, transferred, peak_active = self.busy_seconds, self.bytes, self.peak_active
+            elapsed = time.monotonic() - self.window_started_at
+            self._reset_window()
+        limit = self.limit
+        if not completed and not throttles:
+            return 'hold', 'idle'
+
+        attempts = completed + throttles
+        congestion = (errors + throttles) / attempts
+        # Seconds a worker spends per byte, it goes up when the link or the server is saturated
+        cost = busy_seconds / transferred if transferred else None
+        stats = (f"{completed} done, {errors} errors, {throttles} throttled, "
+                 f"{transferred / elapsed / 1024 / 1024:.2f} MB/s, peak {peak_active} active")
+        if congestion > self.error_rate:
+            new_limit, action, reason = limit // 2, 'decrease', f"congestion {congestion:.0%}"
+        elif cost and self.best_cost and cost > self.best_cost * self.latency_tolerance:
+            new_limit, action, reason = limit // 2, 'decrease', f"time per MB {cost * 1024 * 1024:.2f}s vs best {self.best_cost * 1024 * 1024:.2f}s"
+        elif peak_active >= limit:
+            new_limit, action, reason = limit + 1, 'increase', 'all workers busy'
+        else:
+            new_limit, action, reason = limit, 'hold', 'workers not all busy'
+        if cost:
+            # The best time per byte slowly forgets, so it follows lasting changes of the link
+            self.best_cost = cost if self.best_cost is None else min(cost, self.best_cost * 1.05)
+
+        new_limit = max(self.minimum, min(self.maximum, new_limit))
+        if new_limit == limit:
+            action = 'hold'
+        CONCURRENCY_ADJUSTMENTS.inc(pool=self.name, action=action)
+        if action != 'hold':
+            self.set_limit(new_limit)
+            self.logger.info("Concurrency %s: %d -> %d (%s) - %s", self.name, limit, new_limit, reason, stats)
+        else:
+            self.logger.debug("Concurrency %s: %d (%s) - %s", self.name, limit, reason, stats)
+        return action, reason
+
+    def start(self):
+        if self.adaptive:
+            self.thread = Thread(target=self._run, name=f"{self.name}-concurrency", daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.adjust()
+            except Exception:
+                self.logger.exception("Concurrency %s: adjustment failed", self.name)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
@@ -2,26 +2,127 @@
 # To be used on process_files.py
 # A file_list.csv file is created in the data folder.
 # A web browser will open to authenticate the Google Drive account.
+#
+# The first run lists the whole folder, page by page, and saves a Drive changes token.
+# Later runs only fetch the changes since that token: new files are appended to the list and
+# removed or trashed files are dropped from it. Use --full to list the whole folder again.
+# A list written by an older version, without the size and checksum columns, is always listed again in full.
 
+import argparse
 import csv
+import json
 
-from google_auth import authenticate_and_get_drive
+from atomic_file import atomic_write
+from drive_client import DriveClient
+from settings import GOOGLE_FOLDER_ID, INPUT_LIST, DRIVE_API_URL, DRIVE_ACCESS_TOKEN, DRIVE_CHANGES_TOKEN
 
-from settings import GOOGLE_FOLDER_ID
+FIELDNAMES = ['title', 'mimeType', 'id', 'size', 'md5Checksum']
 
-drive, gauth = authenticate_and_get_drive()
 
-file_titles = set()
+def file_row(f):
+    return {'title': f['name'], 'mimeType': f['mimeType'], 'id': f['id'], 'size': f.get('size', ''), 'md5Checksum': f.get('md5Checksum', '')}
 
-file_list = drive.ListFile({'q': f"'{GOOGLE_FOLDER_ID}' in parents and trashed=false"}).GetList()
-with open('file_list.csv', 'w') as f:
-    fieldnames = ['title', 'mimeType', 'id']
-    writer = csv.DictWriter(f, fieldnames=fieldnames)
-    writer.writeheader()
-    for f in file_list:
-        if f["title"] in file_titles:
-            continue
-        file_titles.add(f["title"])
-        writer.writerow({'title': f["title"], 'mimeType': f["mimeType"], 'id': f["id"]})
-        print(f'title: {f["title"]} mimeType: {f["mimeType"]} id: {f["id"]}')
-    
+def load_changes_token(folder_id):
+    try:
+        with open(DRIVE_CHANGES_TOKEN, 'r') as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None
+    # A token saved for another folder is no use to us
+    if saved.get('folder_id') != folder_id:
+        return None
+    return saved['startPageToken']
+
+def save_changes_token(folder_id, token):
+    with atomic_write(DRIVE_CHANGES_TOKEN) as f:
+        json.dump({'folder_id': folder_id, 'startPageToken': token}, f)
+
+def full_sync(drive_client, folder_id):
+    # Take the token first, so anything that changes while we list is picked up next time
+    token = drive_client.get_start_page_token()
+    file_titles = set()
+    with atomic_write(INPUT_LIST, newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        for page in drive_client.list_folder(folder_id):
+            for file in page:
+                if file['name'] in file_titles:
+                    continue
+                file_titles.add(file['name'])
+                writer.writerow(file_row(file))
+                print(f'title: {file["name"]} mimeType: {file["mimeType"]} id: {file["id"]}')
+            # Each page is on disk before the next one is requested
+            f.flush()
+    save_changes_token(folder_id, token)
+    print(f"Listed {len(file_titles)} files")
+
+def incremental_sync(drive_client, folder_id, token):
+    with open(INPUT_LIST, 'r', newline='') as f:
+        rows = list(csv.DictReader(f))
+    known_ids = {row['id'] for row in rows}
+    file_titles = {row['title'] for row in rows}
+
+    added = []
+    removed_ids = set()
+    new_token = token
+    for changes, page_new_token in drive_client.list_changes(token):
+        for change in changes:
+            file = change.get('file')
+            in_folder = bool(file) and folder_id in file.get('parents', []) and not file.get('trashed')
+            if change.get('removed') or not in_folder:
+                if change['fileId'] in known_ids:
+                    removed_ids.add(change['fileId'])
+                continue
+            if file['id'] in known_ids or file['name'] in file_titles:
+                continue
+            known_ids.add(file['id'])
+            file_titles.add(file['name'])
+            added.append(file_row(file))
+            print(f'title: {file["name"]} mimeType: {file["mimeType"]} id: {file["id"]}')
+        new_token = page_new_token or new_token
+
+    if removed_ids:
+        # Rewrite the list without the removed files
+        with atomic_write(INPUT_LIST, newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(row for row in rows if row['id'] not in removed_ids)
+            writer.writerows(added)
+    elif added:
+        with open(INPUT_LIST, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+            writer.writerows(added)
+    save_changes_token(folder_id, new_token)
+    print(f"Added {len(added)} files, removed {len(removed_ids)} files")
+
+def list_columns():
+    try:
+        with open(INPUT_LIST, 'r', newline='') as f:
+            return csv.DictReader(f).fieldnames
+    except FileNotFoundError:
+        return None
+
+def sync_file_list(drive_client, folder_id, full=False):
+    token = None if full else load_changes_token(folder_id)
+    columns = list_columns()
+    if token and columns == FIELDNAMES:
+        incremental_sync(drive_client, folder_id, token)
+    else:
+        if token and columns:
+            # The sizes and checksums of the files already listed only come with a full listing
+            print(f"{INPUT_LIST} has the columns of an older version, listing the whole folder")
+        full_sync(drive_client, folder_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create or update the list of files to process from the Google Drive folder')
+    parser.add_argument('--full', action='store_true', help='List the whole folder again instead of fetching changes')
+    args = parser.parse_args()
+
+    if DRIVE_ACCESS_TOKEN:
+        drive_client = DriveClient(DRIVE_API_URL, lambda: DRIVE_ACCESS_TOKEN)
+    else:
+        from google_auth import authenticate_and_get_drive
+        drive, gauth = authenticate_and_get_drive()
+        drive_client = DriveClient(DRIVE_API_URL, lambda: gauth.credentials.access_token)
+    sync_file_list(drive_client, GOOGLE_FOLDER_ID, full=args.full)
@@ -0,0 +1,311 @@
+# Description: Small Google Drive v3 REST client built on requests.
+# Used where PyDrive2 can't help, e.g. reading parts of a file with HTTP Range requests.
+
+import hashlib
+import io
+import os
+
+import requests
+
+
+FILE_FIELDS = 'id,name,mimeType,size,md5Checksum'
+# Drive throttles with 403 and one of these reasons as well as with 429
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RangeNotSupportedError(Exception):
+    pass
+
+class ChecksumMismatchError(IOError):
+    pass
+
+class DriveHTTPError(requests.exceptions.HTTPError):
+    """
+    An error response of the Drive API, so callers can tell it from the errors of other APIs.
+    """
+    pass
+
+
+def raise_for_status(response):
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        raise DriveHTTPError(*e.args, request=e.request, response=response) from None
+
+def error_reasons(response):
+    try:
+        return {error.get('reason') for error in response.json()['error'].get('errors', [])}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+
+def is_transient_error(error: DriveHTTPError):
+    """
+    Whether a Drive error is worth retrying later: throttling, a server error, or an expired token
+    (401, refreshed before the next attempt).
+    """
+    status_code = error.response.status_code if error.response is not None else None
+    if status_code in TRANSIENT_STATUS_CODES or status_code == 401:
+        return True
+    return status_code == 403 and bool(error_reasons(error.response) & RATE_LIMIT_REASONS)
+
+
+class Md5Consumer:
+    """
+    The md5 of a download, fed like the `consumer` of DriveClient.download.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.digest = hashlib.md5()
+
+    def update(self, data):
+        self.digest.update(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+def feed_prefix(path, length, consumers, chunk_size=1024 * 1024):
+    """
+    Resets the consumers and feeds them the first `length` bytes of a file, to continue them with more data.
+    """
+    for consumer in consumers:
+        consumer.reset()
+    with open(path, 'rb') as f:
+        while length > 0 and (chunk := f.read(min(chunk_size, length))):
+            for consumer in consumers:
+                consumer.update(chunk)
+            length -= len(chunk)
+
+
+class HttpRangeReader(io.RawIOBase):
+    """
+    A seekable, read-only file object over a remote file, fetched with HTTP Range requests.
+    Reads are rounded out to aligned `block_size` blocks and the last few blocks are cached,
+    so the small reads done by zipfile don't each turn into a request.
+    """
+    def __init__(self, session, url, get_headers, size, block_size=64 * 1024, max_cached_blocks=8, timeout=None):
+        self.session = session
+        self.timeout = timeout
+        self.url = url
+        self.get_headers = get_headers
+        self.size = size
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        self.position = 0
+        self.cache = []
+        self.bytes_fetched = 0
+        self.requests_made = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position: {position}")
+        self.position = position
+        return self.position
+
+    def fetch(self, start, end):
+        """
+        Returns the bytes in [start, end) of the remote file.
+        """
+        headers = dict(self.get_headers())
+        headers['Range'] = f"bytes={start}-{end - 1}"
+        with self.session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            raise_for_status(response)
+            if response.status_code != 206:
+                raise RangeNotSupportedError(f"Expected 206 Partial Content, got {response.status_code} for {self.url}")
+            data = response.raw.read(end - start, decode_content=True)
+        self.requests_made += 1
+        self.bytes_fetched += len(data)
+        return data
+
+    def _get_block(self, position):
+        for start, data in self.cache:
+            if start <= position < start + len(data):
+                return start, data
+        start = position - position % self.block_size
+        end = min(start + self.block_size, self.size)
+        data = self.fetch(start, end)
+        self.cache.append((start, data))
+        if len(self.cache) > self.max_cached_blocks:
+            self.cache.pop(0)
+        return start, data
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        wanted = min(len(buffer), self.size - self.position)
+        if wanted > self.block_size:
+            # Large reads go straight to the server instead of through the cache
+            data = self.fetch(self.position, self.position + wanted)
+        else:
+            start, block = self._get_block(self.position)
+            offset = self.position - start
+            data = block[offset:offset + wanted]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class DriveClient:
+    """
+    Talks to the Drive v3 REST API with the access token of an authenticated PyDrive2 session.
+    `get_access_token` is called for every request so refreshed tokens are picked up.
+    `timeout` is the (connect, read) timeout of every request.
+    """
+    def __init__(self, api_url, get_access_token, session=None, timeout=(10, 60)):
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self.get_access_token = get_access_token
+        self.session = session or requests.Session()
+
+    def headers(self):
+        return {'Authorization': f"Bearer {self.get_access_token()}"}
+
+    def file_url(self, file_id):
+        return f"{self.api_url}/files/{file_id}"
+
+    def get_metadata(self, file_id, fields=FILE_FIELDS):
+        response = self.session.get(self.file_url(file_id), headers=self.headers(), params={'fields': fields}, timeout=self.timeout)
+        raise_for_status(response)
+        return response.json()
+
+    def open_range_reader(self, file_id, size=None, block_size=64 * 1024):
+        if size is None:
+            size = int(self.get_metadata(file_id, fields='size')['size'])
+        return HttpRangeReader(
+            self.session,
+            f"{self.file_url(file_id)}?alt=media",
+            self.headers,
+            size,
+            block_size=block_size,
+            timeout=self.timeout,
+        )
+
+    def download(self, file_id, destination, size=None, md5_checksum=None, chunk_size=1024 * 1024, max_resumes=3, on_resume=None,
+                 consumer=None):
+        """
+        Streams a file's content to `destination` and returns the number of bytes fetched.
+        If `destination` already holds the start of the file, only the rest is requested with a
+        Range request, and a connection dropped mid-transfer is resumed up to `max_resumes` times,
+        calling `on_resume(offset)` before each.
+        With `md5_checksum` the finished file is checked against it, and removed if it doesn't match.
+        `consumer`, an object with `reset()` and `update(data)`, is fed the whole content in order too.
+        Both are computed as the data comes in, only a prefix left by an earlier attempt is read back.
+        """
+        url = f"{self.file_url(file_id)}?alt=media"
+        fetched = 0
+        resumes = 0
+        md5 = Md5Consumer() if md5_checksum else None
+        consumers = [c for c in (md5, consumer) if c]
+        fed = 0
+        while True:
+            offset = os.path.getsize(destination) if os.path.exists(destination) else 0
+            if size is not None and offset > size:
+                # More bytes than the file has, this is not a partial copy of it
+                offset = 0
+                os.remove(destination)
+            if consumers and fed != offset:
+                feed_prefix(destination, offset, consumers)
+                fed = offset
+            if size is not None and offset == size:
+                break
+            headers = self.headers()
+            if offset:
+                headers['Range'] = f"bytes={offset}-"
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    if offset and response.status_code == 416:
+                        # Nothing after the offset, the file is complete
+                        break
+                    raise_for_status(response)
+                    # A server that ignores the Range header sends the whole file again
+                    mode = 'ab' if response.status_code == 206 else 'wb'
+                    if mode == 'wb' and fed:
+                        for c in consumers:
+                            c.reset()
+                        fed = 0
+                    with open(destination, mode) as f:
+                        for chunk in response.iter_content(chunk_size):
+                            f.write(chunk)
+                            fetched += len(chunk)
+                            for c in consumers:
+                                c.update(chunk)
+                            fed += len(chunk)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout):
+                if resumes >= max_resumes:
+                    raise
+                resumes += 1
+                if on_resume:
+                    on_resume(os.path.getsize(destination) if os.path.exists(destination) else 0)
+
+        if size is not None and os.path.getsize(destination) != size:
+            raise IOError(f"Downloaded {os.path.getsize(destination)} of {size} bytes of {file_id}")
+        if md5_checksum:
+            actual = md5.hexdigest()
+            if actual != md5_checksum:
+                os.remove(destination)
+                raise ChecksumMismatchError(f"MD5 of {file_id} is {actual}, Drive has {md5_checksum}")
+        return fetched
+
+    def list_folder(self, folder_id, fields=FILE_FIELDS, page_size=1000):
+        """
+        Yields the files in a folder one page at a time, with only the requested fields.
+        """
+        params = {
+            'q': f"'{folder_id}' in parents and trashed=false",
+            'fields': f"nextPageToken,files({fields})",
+            'pageSize': page_size,
+        }
+        while True:
+            response = self.session.get(f"{self.api_url}/files", headers=self.headers(), params=params, timeout=self.timeout)
+            raise_for_status(response)
+            page = response.json()
+            yield page.get('files', [])
+            if not page.get('nextPageToken'):
+                break
+            params['pageToken'] = page['nextPageToken']
+
+    def get_start_page_token(self):
+        response = self.session.get(f"{self.api_url}/changes/startPageToken", headers=self.headers(), timeout=self.timeout)
+        raise_for_status(response)
+        return response.json()['startPageToken']
+
+    def list_changes(self, page_token, fields=FILE_FIELDS, page_size=1000):
+        """
+        Yields (changes, new_start_page_token) for every page of changes since `page_token`.
+        new_start_page_token is None except on the last page.
+        """
+        params = {
+            'pageToken': page_token,
+            'fields': f"nextPageToken,newStartPageToken,changes(fileId,removed,file({fields},parents,trashed))",
+            'pageSize': page_size,
+            'includeRemoved': 'true',
+            'spaces': 'drive',
+        }
+        while True:
+            response = self.session.get(f"{self.api_url}/changes", headers=self.headers(), params=params, timeout=self.timeout)
+            raise_for_status(response)
+            page = response.json()
+            yield page.get('changes', []), page.get('newStartPageToken')
+            if not page.get('nextPageToken'):
+                break
+            params['pageToken'] = page['nextPageToken']
@@ -0,0 +1,259 @@
+# Description: Fake Google Drive v3 server for benchmarks and local testing.
+# Serves every file in a folder as a Drive file: listing, metadata, downloads with HTTP Range
+# support and a changes feed. Downloads can be slowed down with a per-connection bandwidth
+# limit or cut off halfway, and every request can be delayed.
+# The folder is the Drive folder FOLDER_ID. Files moved into its .trash subfolder are trashed, and files
+# in any other subfolder are in another Drive folder of that name. The folder is scanned again whenever the
+# file list or the changes are requested, and every file added, changed, moved or deleted since is a change.
+# Usage: python fake_drive_server.py FOLDER [--port 8766] [--folder-id fake-folder] [--latency 0.05] [--bandwidth 10000000] [--drop-rate 0.1]
+#   then run the scripts with DRIVE_API_URL=http://localhost:8766 DRIVE_ACCESS_TOKEN=anything GOOGLE_FOLDER_ID=fake-folder
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from urllib.parse import urlparse, parse_qs
+
+CHUNK_SIZE = 64 * 1024
+FOLDER_ID = 'fake-folder'
+TRASH_FOLDER = '.trash'
+# Kept for the server, not part of the Drive metadata
+PRIVATE_FIELDS = ('path', 'mtime')
+
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def scan_files(folder, folder_id=FOLDER_ID, previous=None):
+    """
+    Returns the Drive metadata of every file in `folder` and its subfolders by id. The id is the file
+    name without its extension, the md5Checksum is computed like Drive does, over the whole content.
+    Checksums of files whose size and modification time are the same as in `previous` are reused.
+    """
+    previous = previous or {}
+    files = {}
+    for root, folders, names in os.walk(folder):
+        folders.sort()
+        relative = os.path.relpath(root, folder)
+        trashed = relative == TRASH_FOLDER
+        parent = folder_id if relative in ('.', TRASH_FOLDER) else relative
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            file_id = os.path.splitext(name)[0]
+            known = previous.get(file_id)
+            if known and known['path'] == path and known['mtime'] == stat.st_mtime_ns and known['size'] == str(stat.st_size):
+                md5_checksum = known['md5Checksum']
+            else:
+                md5_checksum = file_md5(path)
+            files[file_id] = {
+                'id': file_id,
+                'name': name,
+                'mimeType': 'application/zip' if name.endswith('.zip') else 'application/octet-stream',
+                'size': str(stat.st_size),
+                'md5Checksum': md5_checksum,
+                'parents': [parent],
+                'trashed': trashed,
+                'path': path,
+                'mtime': stat.st_mtime_ns,
+            }
+    return files
+
+def public_metadata(file):
+    return {key: value for key, value in file.items() if key not in PRIVATE_FIELDS}
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self.send_json({'error': {'code': 401, 'message': 'Login required'}}, 401)
+            return
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip('/')
+        if path == '/files':
+            self.list_files(params)
+        elif path == '/changes/startPageToken':
+            self.send_json({'startPageToken': str(self.server.rescan())})
+        elif path == '/changes':
+            self.list_changes(params)
+        elif path.startswith('/files/'):
+            file = self.server.files.get(path[len('/files/'):])
+            if file is None:
+                self.send_json({'error': {'code': 404, 'message': 'File not found'}}, 404)
+            elif params.get('alt') == 'media':
+                self.send_media(file)
+            else:
+                self.send_json(public_metadata(file))
+        else:
+            self.send_json({'error': {'code': 404, 'message': 'Not found'}}, 404)
+
+    def list_files(self, params):
+        self.server.rescan()
+        files = list(self.server.files.values())
+        # Only the two conditions the scripts use: '<folder id>' in parents and trashed=false
+        query = params.get('q', '')
+        parent = re.search(r"'([^']*)' in parents", query)
+        if parent:
+            files = [f for f in files if parent.group(1) in f['parents']]
+        if 'trashed=false' in query.replace(' ', ''):
+            files = [f for f in files if not f['trashed']]
+        start = int(params.get('pageToken', 0))
+        page_size = int(params.get('pageSize', 100))
+        body = {'files': [public_metadata(f) for f in files[start:start + page_size]]}
+        if start + page_size < len(files):
+            body['nextPageToken'] = str(start + page_size)
+        self.send_json(body)
+
+    def list_changes(self, params):
+        # A page token is the position in the server's list of changes
+        end = self.server.rescan()
+        start = int(params.get('pageToken', end))
+        page_size = int(params.get('pageSize', 100))
+        body = {'changes': self.server.changes[start:start + page_size]}
+        if start + page_size < end:
+            body['nextPageToken'] = str(start + page_size)
+        else:
+            body['newStartPageToken'] = str(end)
+        self.send_json(body)
+
+    def send_media(self, file):
+        size = int(file['size'])
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range')
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header or '')
+        if match:
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                # Suffix range: the last N bytes
+                start = max(0, size - int(match.group(2)))
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', file['mimeType'])
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        remaining = end - start + 1
+        # A dropped download stops halfway and closes the connection
+        if random.random() < self.server.drop_rate:
+            remaining //= 2
+            self.close_connection = True
+        started_at = time.monotonic()
+        sent = 0
+        try:
+            with open(file['path'], 'rb') as f:
+                f.seek(start)
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+                    sent += len(chunk)
+                    if self.server.bandwidth:
+                        # Sleep until the bytes sent so far fit the bandwidth limit
+                        delay = sent / self.server.bandwidth - (time.monotonic() - started_at)
+                        if delay > 0:
+                            time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading, e.g. after the few blocks it wanted
+            self.close_connection = True
+
+
+class FakeDriveServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def rescan(self):
+        """
+        Scans the folder again, records a change for every file added, changed, moved or deleted since
+        the last scan, and returns the number of changes recorded so far.
+        """
+        with self.scan_lock:
+            files = scan_files(self.folder, self.folder_id, self.files)
+            for file_id, file in files.items():
+                known = self.files.get(file_id)
+                if known is None or public_metadata(known) != public_metadata(file):
+                    self.changes.append({'fileId': file_id, 'removed': False, 'file': public_metadata(file)})
+            for file_id in self.files.keys() - files.keys():
+                self.changes.append({'fileId': file_id, 'removed': True})
+            self.files = files
+            return len(self.changes)
+
+
+def make_server(folder, host='127.0.0.1', port=0, latency=0.0, bandwidth=0.0, drop_rate=0.0, quiet=True, folder_id=FOLDER_ID):
+    """
+    Creates the server, port 0 picks a free port. `bandwidth` is in bytes per second per download
+    and `drop_rate` the fraction of downloads that are cut off halfway.
+    """
+    server = FakeDriveServer((host, port), FakeDriveHandler)
+    server.folder = folder
+    server.folder_id = folder_id
+    server.scan_lock = Lock()
+    server.changes = []
+    server.files = scan_files(folder, folder_id)
+    server.latency = latency
+    server.bandwidth = bandwidth
+    server.drop_rate = drop_rate
+    server.quiet = quiet
+    return server
+
+def start_in_thread(server):
+    thread = Thread(target=server.serve_forever, name="fake-drive", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve the files of a folder as a fake Google Drive v3 API')
+    parser.add_argument('folder')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--folder-id', default=FOLDER_ID, help='Drive id of the folder')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='Bytes per second per download, 0 for unlimited')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Fraction of downloads cut off halfway')
+    args = parser.parse_args()
+
+    server = make_server(args.folder, args.host, args.port, args.latency, args.bandwidth, args.drop_rate, quiet=False,
+                         folder_id=args.folder_id)
+    print(f"Serving {len(server.files)} files from {args.folder} as folder {args.folder_id} on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,160 @@
+# Description: Shared Gong API client with a pooled session, a token bucket rate limiter
+# and retries with jittered exponential backoff that honor Retry-After.
+
+import datetime
+import email.utils
+import logging
+import random
+import time
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+
+from metrics import counter
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Answers Gong gives before doing anything with the request, the only ones worth retrying a POST or PUT for
+UNAPPLIED_STATUS_CODES = {429, 503}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+GONG_REQUESTS = counter('gong_requests_total', 'Gong API requests sent, retries included', ['method', 'outcome'])
+GONG_RETRIES = counter('gong_retries_total', 'Gong API requests retried', ['method', 'reason'])
+
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions per second on average, with bursts of up to `capacity`.
+    Thread safe; `acquire` blocks until a token is available.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def parse_retry_after(value):
+    """
+    Returns the delay in seconds from a Retry-After header, given either as seconds or as an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def is_unsent_error(error):
+    """
+    Whether a request failed before any of it was sent: the connection couldn't be made.
+    A read timeout or a dropped connection may come after the server acted on the request.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class GongClient:
+    """
+    A thread-safe Gong API client. All requests share one connection pool and one rate limiter.
+    429 and 5xx responses, connection errors and timeouts are retried up to `max_retries` times,
+    calling `on_retry(reason)` before each retry. Requests that aren't idempotent, like creating a call
+    or uploading its media, are only retried when Gong can't have acted on them: a 429 or 503, or a
+    connection that couldn't be made. `timeout` is the (connect, read) timeout of every request that
+    doesn't pass its own.
+    """
+    def __init__(self, api_url, key, secret, rate_limit=3, burst=3, max_retries=5, backoff_base=1.0,
+                 backoff_max=60.0, pool_size=10, logger=None, on_retry=None, timeout=(10, 300)):
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = TokenBucket(rate_limit, burst)
+        self.logger = logger or logging.getLogger(__name__)
+        self.on_retry = on_retry
+        self.session = requests.Session()
+        self.session.auth = (key, secret)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def backoff(self, attempt):
+        # Full jitter: a random delay up to the exponential cap
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def request(self, method, path, data_factory=None, idempotent=None, **kwargs):
+        """
+        Sends a request and returns the last response, which may still be an error. Its `attempts`
+        attribute is the number of times the request was sent.
+        `data_factory` is called before every attempt to build a fresh request body,
+        for bodies like streams that can only be sent once. `idempotent` defaults to whether
+        the method is one that can be sent twice safely.
+        """
+        url = f"{self.api_url}{path}"
+        kwargs.setdefault('timeout', self.timeout)
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        retry_status_codes = RETRY_STATUS_CODES if idempotent else UNAPPLIED_STATUS_CODES
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            if data_factory:
+                kwargs['data'] = data_factory()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                GONG_REQUESTS.inc(method=method, outcome=type(e).__name__)
+                if attempt >= self.max_retries or not (idempotent or is_unsent_error(e)):
+                    raise
+                GONG_RETRIES.inc(method=method, reason=type(e).__name__)
+                if self.on_retry:
+                    self.on_retry(type(e).__name__)
+                delay = self.backoff(attempt)
+                self.logger.warning("Gong request failed, retrying in %.1fs - %s %s ATTEMPT: %d ERROR: %s", delay, method, path, attempt + 1, e)
+            else:
+                GONG_REQUESTS.inc(method=method, outcome=response.status_code)
+                if response.status_code not in retry_status_codes or attempt >= self.max_retries:
+                    response.attempts = attempt + 1
+                    return response
+                GONG_RETRIES.inc(method=method, reason=response.status_code)
+                if self.on_retry:
+                    self.on_retry(response.status_code)
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                delay = min(retry_after, self.backoff_max) if retry_after is not None else self.backoff(attempt)
+                self.logger.warning("Gong returned %d, retrying in %.1fs - %s %s ATTEMPT: %d", response.status_code, delay, method, path, attempt + 1)
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
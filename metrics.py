@@ -0,0 +1,320 @@
+# Description: Counters, gauges and histograms with labels, exposed in the Prometheus text format
+# over HTTP and written to a JSON snapshot file at a fixed interval.
+# Metrics are created once at module level with `counter`, `gauge` and `histogram` and updated from any thread.
+
+import json
+import logging
+import math
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock, Event
+
+from atomic_file import atomic_write
+
+# Seconds, from a fast API call to a multi-GB upload
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _label_key(metric, labels):
+    if set(labels) != set(metric.labelnames):
+        raise ValueError(f"{metric.name} takes labels {metric.labelnames}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in metric.labelnames)
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self.values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(zip(self.labelnames, key)), 'value': value} for key, value in sorted(self.values.items())]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = _label_key(self, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        Counts the blocks running inside this context, e.g. the busy workers of a stage.
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """
+    Observations counted in cumulative buckets, with their sum and count. The JSON snapshot
+    also estimates p50, p95 and p99 from the buckets.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = _label_key(self, labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the seconds spent in the block. Yields the labels, so the block can set its
+        outcome; an `outcome` label left unset becomes 'ok', or 'error' if the block raised.
+        """
+        labels = dict(labels)
+        started_at = time.monotonic()
+        try:
+            yield labels
+        except BaseException:
+            if 'outcome' in self.labelnames:
+                labels.setdefault('outcome', 'error')
+            raise
+        finally:
+            if 'outcome' in self.labelnames:
+                labels.setdefault('outcome', 'ok')
+            self.observe(time.monotonic() - started_at, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def _quantile(self, counts, q):
+        # Linear interpolation inside the bucket holding the quantile, like Prometheus' histogram_quantile
+        count = sum(counts)
+        rank = q * count
+        cumulative = 0
+        lower = 0.0
+        for bound, bucket_count in zip(self.buckets, counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if bound == math.inf:
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower = bound if bound != math.inf else lower
+        return lower
+
+    def snapshot(self):
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in sorted(self.values.items())]
+        result = []
+        for key, counts, total in items:
+            count = sum(counts)
+            result.append({
+                'labels': dict(zip(self.labelnames, key)),
+                'count': count,
+                'sum': total,
+                'mean': total / count if count else None,
+                'p50': self._quantile(counts, 0.5),
+                'p95': self._quantile(counts, 0.95),
+                'p99': self._quantile(counts, 0.99),
+            })
+        return result
+
+
+class Registry:
+    """
+    All metrics of the process. Collectors are called before every render or snapshot,
+    for gauges that are read from somewhere else, like queue sizes.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.lock = Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def collect(self):
+        with self.lock:
+            collectors = list(self.collectors)
+            metrics = list(self.metrics.values())
+        for collector in collectors:
+            collector()
+        return metrics
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.collect():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {
+            'timestamp': time.time(),
+            'metrics': {metric.name: {'type': metric.type, 'values': metric.snapshot()} for metric in self.collect()},
+        }
+
+REGISTRY = Registry()
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path in ('/', '/metrics'):
+            body = self.server.registry.render_prometheus().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            body = json.dumps(self.server.registry.snapshot()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def write_snapshot(path, registry=REGISTRY):
+    with atomic_write(path) as f:
+        json.dump(registry.snapshot(), f, indent=2)
+
+
+class MetricsExporter:
+    """
+    Serves the registry on http://host:port/metrics (and /metrics.json) and writes a JSON
+    snapshot to `snapshot_path` every `snapshot_interval` seconds and once more on `stop()`.
+    A port of 0 or a snapshot path of None turns that part off. Neither a port in use nor a failed
+    snapshot stops the process being measured, they are logged.
+    """
+    def __init__(self, port=0, snapshot_path=None, snapshot_interval=60, host='127.0.0.1', registry=REGISTRY, logger=None):
+        self.port = port
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.host = host
+        self.registry = registry
+        self.logger = logger or logging.getLogger(__name__)
+        self.server = None
+        self.stopped = Event()
+        self.threads = []
+
+    def start(self):
+        if self.port:
+            try:
+                self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+            except OSError as e:
+                self.logger.error("Not serving metrics on port %d - ERROR: %s", self.port, e)
+        if self.server:
+            self.server.daemon_threads = True
+            self.server.registry = self.registry
+            self.threads.append(Thread(target=self.server.serve_forever, name="metrics-server", daemon=True))
+        if self.snapshot_path:
+            self.threads.append(Thread(target=self._write_snapshots, name="metrics-snapshot", daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def _write_snapshot(self):
+        try:
+            write_snapshot(self.snapshot_path, self.registry)
+        except Exception:
+            self.logger.exception("Writing the metrics snapshot %s failed", self.snapshot_path)
+
+    def _write_snapshots(self):
+        while not self.stopped.wait(self.snapshot_interval):
+            self._write_snapshot()
+
+    def stop(self):
+        self.stopped.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.snapshot_path:
+            self._write_snapshot()
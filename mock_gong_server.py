@@ -1,21 +1,87 @@
 # Description: Mock Gong server for testing purposes
 
 from typing import List
+import asyncio
+import hashlib
+import json
+import os
 import random
+import time
 
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Request
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
 app = FastAPI()
 
+# Set MOCK_GONG_VERIFY_UPLOADS=1 to hash every uploaded file and return the digest and size,
+# so the client can check that the streamed payload arrived intact
+VERIFY_UPLOADS = os.environ.get('MOCK_GONG_VERIFY_UPLOADS') == '1'
+
+# Fault injection for testing the client's rate limiting and retries:
+# MOCK_GONG_LATENCY seconds are added to every request, MOCK_GONG_429_RATE and MOCK_GONG_ERROR_RATE
+# are the fractions of requests answered with 429 (with Retry-After: MOCK_GONG_RETRY_AFTER) and 503
+LATENCY = float(os.environ.get('MOCK_GONG_LATENCY', 0))
+RATE_429 = float(os.environ.get('MOCK_GONG_429_RATE', 0))
+ERROR_RATE = float(os.environ.get('MOCK_GONG_ERROR_RATE', 0))
+RETRY_AFTER = os.environ.get('MOCK_GONG_RETRY_AFTER', '1')
+# MOCK_GONG_BANDWIDTH bytes per second simulates a slow link: a media upload is answered
+# only after the time its size would take to transfer at that rate
+BANDWIDTH = float(os.environ.get('MOCK_GONG_BANDWIDTH', 0))
+# MOCK_GONG_USERS_FILE is a JSON list of the users served by /v2/users, MOCK_GONG_USERS_PAGE_SIZE per page
+USERS_FILE = os.environ.get('MOCK_GONG_USERS_FILE')
+USERS_PAGE_SIZE = int(os.environ.get('MOCK_GONG_USERS_PAGE_SIZE', 100))
+
+@app.middleware("http")
+async def inject_faults(request: Request, call_next):
+    if request.url.path in ("/reset", "/stats"):
+        return await call_next(request)
+    if LATENCY:
+        await asyncio.sleep(LATENCY)
+    roll = random.random()
+    if roll < RATE_429:
+        print(f"Injected 429 for {request.method} {request.url.path}")
+        return JSONResponse({"errors": ["Too many requests"]}, status_code=429, headers={"Retry-After": RETRY_AFTER})
+    if roll < RATE_429 + ERROR_RATE:
+        print(f"Injected 503 for {request.method} {request.url.path}")
+        return JSONResponse({"errors": ["Service unavailable"]}, status_code=503)
+    return await call_next(request)
+
+# Counts of what was received since the last reset, calls by clientUniqueId
+stats = {"calls": {}, "uploads": 0, "user_pages": 0}
+
 @app.post("/reset")
 def read_root():
     """
     Put a breakpoint here to reset the mock server
     """
     print(f"--------- Reset Point ---------\n")
+    stats["calls"] = {}
+    stats["uploads"] = 0
+    stats["user_pages"] = 0
     return {"info": "Reset Point"}
 
+@app.get("/stats")
+def get_stats():
+    duplicates = {unique_id: count for unique_id, count in stats["calls"].items() if count > 1}
+    return {"calls": sum(stats["calls"].values()), "uploads": stats["uploads"], "user_pages": stats["user_pages"],
+            "duplicate_client_unique_ids": duplicates}
+
+@app.get("/v2/users")
+def get_users(cursor: str | None = None):
+    users = []
+    if USERS_FILE:
+        # Read on every request, so the benchmark can add users during a run
+        with open(USERS_FILE, 'r') as f:
+            users = json.load(f)
+    start = int(cursor or 0)
+    page = users[start:start + USERS_PAGE_SIZE]
+    stats["user_pages"] += 1
+    records = {"totalRecords": len(users), "currentPageSize": len(page), "currentPageNumber": start // USERS_PAGE_SIZE}
+    if start + USERS_PAGE_SIZE < len(users):
+        records["cursor"] = str(start + USERS_PAGE_SIZE)
+    return {"requestId": str(random.randint(1000, 9999)), "records": records, "users": page}
+
 class Party(BaseModel):
     name: str
     userId: str | None = None
@@ -31,10 +97,26 @@ class Call(BaseModel):
 @app.post("/v2/calls")
 def post_call(call: Call):
     parties = ",".join([f"{party.name}[{party.userId}]" for party in call.parties])
+    stats["calls"][call.clientUniqueId] = stats["calls"].get(call.clientUniqueId, 0) + 1
+    if stats["calls"][call.clientUniqueId] > 1:
+        print(f"Duplicate clientUniqueId: {call.clientUniqueId}")
     print(f"Received call\nclientUniqueId: {call.clientUniqueId}\ntitle: {call.title}\nactualStart: {call.actualStart}\nparties: {parties}\nprimaryUser: {call.primaryUser}\ndirection: {call.direction}")
     return {"callId": random.randint(1000, 9999)}
 
 @app.put("/v2/calls/{call_id}/media")
 def post_call_media(call_id: str, mediaFile: UploadFile = File(...)):
     print(f"Received file: {mediaFile.filename} for call: {call_id}")
-    return {"url": f'https://gong.io?callId={call_id}'}
\ No newline at end of file
+    stats["uploads"] += 1
+    if BANDWIDTH:
+        size = mediaFile.file.seek(0, os.SEEK_END)
+        mediaFile.file.seek(0)
+        time.sleep(size / BANDWIDTH)
+    if not VERIFY_UPLOADS:
+        return {"url": f'https://gong.io?callId={call_id}'}
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := mediaFile.file.read(1024 * 1024):
+        digest.update(chunk)
+        size += len(chunk)
+    print(f"Verified file: {mediaFile.filename} for call: {call_id} size: {size} sha256: {digest.hexdigest()}")
+    return {"url": f'https://gong.io?callId={call_id}', "size": size, "sha256": digest.hexdigest()}
\ No newline at end of file
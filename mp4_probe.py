@@ -0,0 +1,284 @@
+# Description: Reads the duration and frame rate of an MP4 file from its moov box, without ffprobe.
+# Only the box headers and the moov box are read, the media data (mdat) is skipped.
+
+import io
+import os
+import struct
+import zipfile
+
+# The moov box of a multi-hour recording is a few MB, anything bigger is not a file we understand
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+SKIP_CHUNK_SIZE = 1024 * 1024
+
+
+class Mp4ProbeError(Exception):
+    pass
+
+class NoVideoTrackError(Mp4ProbeError):
+    pass
+
+
+class _FileWindow(io.RawIOBase):
+    """
+    A seekable view of the bytes [start, start + size) of another seekable file.
+    Used for stored (uncompressed) zip members, so skipping mdat is a seek and not a read.
+    """
+    def __init__(self, fileobj, start, size):
+        self.fileobj = fileobj
+        self.start = start
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self.position
+
+    def readinto(self, buffer):
+        wanted = min(len(buffer), self.size - self.position)
+        if wanted <= 0:
+            return 0
+        self.fileobj.seek(self.start + self.position)
+        data = self.fileobj.read(wanted)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class _LimitedStream:
+    """
+    A forward-only stream that gives up after `max_bytes`, so probing a compressed member
+    with the moov box at the end doesn't end up reading the whole file.
+    """
+    def __init__(self, stream, max_bytes):
+        self.stream = stream
+        self.remaining = max_bytes
+
+    def seekable(self):
+        return False
+
+    def read(self, size):
+        if size > self.remaining:
+            raise Mp4ProbeError("Read limit reached before finding the moov box")
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise Mp4ProbeError(f"Unexpected end of file, wanted {size} bytes and got {len(data)}")
+    return data
+
+def _skip(stream, size):
+    try:
+        seekable = stream.seekable()
+    except AttributeError:
+        seekable = False
+    if seekable:
+        stream.seek(size, os.SEEK_CUR)
+        return
+    # Non-seekable streams (e.g. a compressed zip member) have to be read through
+    while size > 0:
+        data = stream.read(min(size, SKIP_CHUNK_SIZE))
+        if not data:
+            raise Mp4ProbeError("Unexpected end of file while skipping a box")
+        size -= len(data)
+
+def _read_box_header(stream):
+    """
+    Returns (box_type, payload_size) or None at the end of the stream.
+    payload_size is None for a box that runs to the end of the file.
+    """
+    header = stream.read(8)
+    if not header:
+        return None
+    if len(header) != 8:
+        raise Mp4ProbeError("Truncated box header")
+    size, box_type = struct.unpack('>I4s', header)
+    if size == 1:
+        size = struct.unpack('>Q', _read_exact(stream, 8))[0] - 16
+    elif size == 0:
+        size = None
+    else:
+        size -= 8
+    if size is not None and size < 0:
+        raise Mp4ProbeError(f"Invalid box size for {box_type!r}")
+    return box_type, size
+
+def _iter_boxes(data):
+    """
+    Iterates over (box_type, payload) for the boxes packed in a bytes buffer.
+    """
+    offset = 0
+    while offset + 8 <= len(data):
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header_size or offset + size > len(data):
+            raise Mp4ProbeError(f"Invalid box size for {box_type!r}")
+        yield box_type, data[offset + header_size:offset + size]
+        offset += size
+
+def _find_box(data, box_type):
+    for child_type, payload in _iter_boxes(data):
+        if child_type == box_type:
+            return payload
+    return None
+
+def _parse_timescale_and_duration(payload):
+    # mvhd and mdhd share the same layout up to the duration
+    version = payload[0]
+    if version == 1:
+        timescale, duration = struct.unpack_from('>IQ', payload, 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', payload, 12)
+    if timescale == 0:
+        raise Mp4ProbeError("Zero timescale")
+    return timescale, duration
+
+def _parse_sample_count(stts):
+    entry_count = struct.unpack_from('>I', stts, 4)[0]
+    total = 0
+    for index in range(entry_count):
+        sample_count, _ = struct.unpack_from('>II', stts, 8 + index * 8)
+        total += sample_count
+    return total
+
+def _parse_track(trak):
+    """
+    Returns (handler_type, duration_seconds, sample_count) for a trak box.
+    """
+    mdia = _find_box(trak, b'mdia')
+    if mdia is None:
+        raise Mp4ProbeError("Track without mdia box")
+    hdlr = _find_box(mdia, b'hdlr')
+    mdhd = _find_box(mdia, b'mdhd')
+    if hdlr is None or mdhd is None:
+        raise Mp4ProbeError("Track without hdlr or mdhd box")
+    handler_type = hdlr[8:12]
+    timescale, duration = _parse_timescale_and_duration(mdhd)
+    sample_count = 0
+    minf = _find_box(mdia, b'minf')
+    stbl = _find_box(minf, b'stbl') if minf is not None else None
+    stts = _find_box(stbl, b'stts') if stbl is not None else None
+    if stts is not None:
+        sample_count = _parse_sample_count(stts)
+    return handler_type, duration / timescale, sample_count
+
+def read_moov(stream):
+    """
+    Walks the top level boxes of an MP4 stream and returns the payload of the moov box.
+    """
+    while True:
+        header = _read_box_header(stream)
+        if header is None:
+            raise Mp4ProbeError("No moov box found")
+        box_type, size = header
+        if box_type == b'moov':
+            if size is None or size > MAX_MOOV_SIZE:
+                raise Mp4ProbeError(f"Unsupported moov box size: {size}")
+            return _read_exact(stream, size)
+        if size is None:
+            raise Mp4ProbeError("No moov box found")
+        _skip(stream, size)
+
+def _parse_track_header_duration(tkhd):
+    # The tkhd duration is in the movie (mvhd) timescale
+    if tkhd[0] == 1:
+        return struct.unpack_from('>Q', tkhd, 28)[0]
+    return struct.unpack_from('>I', tkhd, 20)[0]
+
+def parse_moov(moov):
+    """
+    Returns (duration, fps) of the first video track in a moov payload.
+    """
+    # In a fragmented MP4 the samples and the real duration are in the moof boxes after the moov
+    if _find_box(moov, b'mvex') is not None:
+        raise Mp4ProbeError("Fragmented MP4, the duration is not in the moov box")
+    mvhd = _find_box(moov, b'mvhd')
+    if mvhd is None:
+        raise Mp4ProbeError("No mvhd box found")
+    movie_timescale, movie_duration = _parse_timescale_and_duration(mvhd)
+
+    for box_type, payload in _iter_boxes(moov):
+        if box_type != b'trak':
+            continue
+        handler_type, duration, sample_count = _parse_track(payload)
+        if handler_type != b'vide':
+            continue
+        if not duration:
+            tkhd = _find_box(payload, b'tkhd')
+            track_duration = _parse_track_header_duration(tkhd) if tkhd is not None else 0
+            duration = (track_duration or movie_duration) / movie_timescale
+        if not duration:
+            raise Mp4ProbeError("No duration in the moov box")
+        fps = sample_count / duration
+        return duration, fps
+    raise NoVideoTrackError("No video track found")
+
+def probe_mp4(source):
+    """
+    Returns (duration, fps) of an MP4 file. `source` can be a path or a binary file object,
+    such as an open file or a zip member opened with ZipFile.open.
+    """
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as f:
+            return probe_mp4(f)
+    try:
+        return parse_moov(read_moov(source))
+    except (struct.error, IndexError) as e:
+        raise Mp4ProbeError(f"Malformed MP4 box: {e}")
+
+def open_stored_member(fileobj, zip_info):
+    """
+    Returns a seekable window over the data of a stored zip member, found by reading its local header.
+    """
+    fileobj.seek(zip_info.header_offset)
+    header = fileobj.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise Mp4ProbeError(f"Bad local file header for {zip_info.filename}")
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    name_length = fields[zipfile._FH_FILENAME_LENGTH]
+    extra_length = fields[zipfile._FH_EXTRA_FIELD_LENGTH]
+    data_start = zip_info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+    return _FileWindow(fileobj, data_start, zip_info.file_size)
+
+def probe_mp4_in_zip(fileobj, max_read_bytes=8 * 1024 * 1024):
+    """
+    Returns (duration, fps) of the .mp4 member of a zip archive given as a seekable file object.
+    Only the central directory, the member's local header and its box headers and moov box are read.
+    Compressed members can't be skipped through, so they are read for at most `max_read_bytes`
+    (no limit if None).
+    """
+    with zipfile.ZipFile(fileobj) as zip_ref:
+        mp4_members = [info for info in zip_ref.infolist() if info.filename.endswith('.mp4')]
+        if not mp4_members:
+            raise Mp4ProbeError("No .mp4 file in archive")
+        zip_info = mp4_members[0]
+        if zip_info.compress_type == zipfile.ZIP_STORED:
+            return probe_mp4(io.BufferedReader(open_stored_member(fileobj, zip_info)))
+        with zip_ref.open(zip_info) as member:
+            if max_read_bytes is None:
+                return probe_mp4(member)
+            return probe_mp4(_LimitedStream(member, max_read_bytes))
@@ -0,0 +1,144 @@
+# Description: Streams a multipart/form-data body with a fixed-size buffer, so uploading a
+# multi-GB recording doesn't load it into memory the way requests' `files=` argument does.
+
+import hashlib
+import io
+import time
+import uuid
+from threading import Condition
+
+
+class UploadMemoryBudget:
+    """
+    A global cap on the bytes held in upload buffers. Each stream reserves its buffer
+    before it starts and waits while the cap is reached.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.condition = Condition()
+
+    def acquire(self, size):
+        # A single buffer bigger than the whole budget is allowed through on its own
+        size = min(size, self.max_bytes)
+        with self.condition:
+            while self.in_use + size > self.max_bytes:
+                self.condition.wait()
+            self.in_use += size
+        return size
+
+    def release(self, size):
+        with self.condition:
+            self.in_use -= size
+            self.condition.notify_all()
+
+
+class MultipartFileStream:
+    """
+    A file-like multipart/form-data body with a single file field. The file is read
+    `chunk_size` bytes at a time while the body is sent. When `file_size` is known the body
+    has a length and requests sends a Content-Length, otherwise use `iter_chunks()` to
+    send it with chunked transfer encoding.
+
+    `on_progress(bytes_sent, elapsed_seconds)` is called after every chunk and the
+    SHA-256 of the file content is available in `sha256` once the body has been sent.
+    Use it as a context manager so the buffer is reserved from and returned to `budget`.
+    """
+    def __init__(self, field_name, file_name, fileobj, file_size=None, chunk_size=1024 * 1024,
+                 budget=None, on_progress=None, content_type='application/octet-stream'):
+        self.fileobj = fileobj
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.budget = budget
+        self.on_progress = on_progress
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.preamble = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{file_name}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        self.epilogue = f"\r\n--{self.boundary}--\r\n".encode()
+        self.bytes_sent = 0
+        self.sha256 = None
+        self.started_at = None
+        self.reserved = 0
+        self.buffer = b''
+        self.offset = 0
+        self.chunks = None
+        seekable = getattr(fileobj, 'seekable', None)
+        self.start_position = fileobj.tell() if seekable and seekable() else None
+
+    def __enter__(self):
+        if self.budget:
+            self.reserved = self.budget.acquire(self.chunk_size)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.budget and self.reserved:
+            self.budget.release(self.reserved)
+            self.reserved = 0
+
+    def __len__(self):
+        if self.file_size is None:
+            raise TypeError("Length unknown, send the body with iter_chunks()")
+        return len(self.preamble) + self.file_size + len(self.epilogue)
+
+    def rewind(self):
+        """
+        Resets the body so it can be sent again, e.g. when a request is retried.
+        Only possible for seekable files.
+        """
+        if self.started_at is None:
+            return
+        if self.start_position is None:
+            raise io.UnsupportedOperation("Can't resend the body of a non-seekable file")
+        self.fileobj.seek(self.start_position)
+        self.bytes_sent = 0
+        self.sha256 = None
+        self.started_at = None
+        self.buffer = b''
+        self.offset = 0
+        self.chunks = None
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at if self.started_at else 0.0
+
+    @property
+    def throughput(self):
+        elapsed = self.elapsed
+        return self.bytes_sent / elapsed if elapsed else 0.0
+
+    def iter_chunks(self):
+        self.started_at = time.monotonic()
+        digest = hashlib.sha256()
+        yield self.preamble
+        while True:
+            chunk = self.fileobj.read(self.chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            self.bytes_sent += len(chunk)
+            if self.on_progress:
+                self.on_progress(self.bytes_sent, self.elapsed)
+            yield chunk
+        if self.file_size is not None and self.bytes_sent != self.file_size:
+            raise IOError(f"File ended after {self.bytes_sent} of {self.file_size} bytes")
+        self.sha256 = digest.hexdigest()
+        yield self.epilogue
+
+    def read(self, size=-1):
+        if self.chunks is None:
+            self.chunks = self.iter_chunks()
+        if size < 0:
+            rest = self.buffer[self.offset:] + b''.join(self.chunks)
+            self.buffer, self.offset = b'', 0
+            return rest
+        # Short reads are fine for file objects, so never copy across chunks
+        if self.offset >= len(self.buffer):
+            self.buffer = next(self.chunks, b'')
+            self.offset = 0
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
@@ -0,0 +1,276 @@
+# Description: A small staged pipeline built from bounded queues and per-stage worker pools.
+# Used by process_files.py to keep the Google Drive and Gong links busy at the same time.
+# Also holds the scheduling helpers: a delay queue for retries, a disk space budget that admits
+# work by its projected size, and the size-based orderings of the work.
+
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import time
+from collections import deque
+from queue import Queue
+from threading import Thread, Lock, Condition, Semaphore
+
+
+class DelayQueue:
+    """
+    A queue whose items become available `delay` seconds after they are put, earliest first.
+    Like queue.Queue, `join()` waits until `task_done()` was called for every item put.
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = Condition()
+        self.unfinished = 0
+
+    def put(self, item, delay=0):
+        with self.condition:
+            # The counter keeps items with the same due time in the order they were put
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), item))
+            self.unfinished += 1
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while True:
+                if self.heap:
+                    wait = self.heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        return heapq.heappop(self.heap)[2]
+                    self.condition.wait(wait)
+                else:
+                    self.condition.wait()
+
+    def qsize(self):
+        with self.condition:
+            return len(self.heap)
+
+    def delayed_count(self):
+        """
+        The number of items that are not due yet.
+        """
+        now = time.monotonic()
+        with self.condition:
+            return sum(1 for due, _, _ in self.heap if due > now)
+
+    def task_done(self):
+        with self.condition:
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            while self.unfinished > 0:
+                self.condition.wait()
+
+
+def folder_size(folder):
+    total = 0
+    for root, _, names in os.walk(folder):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # Removed while we were looking
+                pass
+    return total
+
+
+class DiskBudget:
+    """
+    Admits work by the disk space it is expected to use in `path`. Reservations together stay under
+    `max_bytes` (0 for no limit), and a new one must fit in the free space of `path` less
+    `reserve_bytes`, after what the admitted work has yet to write. A reservation bigger than
+    `max_bytes` is let through on its own, one bigger than the free space waits for space freed
+    from outside. Waiting work is admitted in the order it asked, so a large reservation holds back
+    the smaller ones behind it rather than starving while they keep fitting. It is checked again on
+    every release and at least every `check_interval` seconds, since the free space also changes from outside.
+    """
+    def __init__(self, path, max_bytes=0, reserve_bytes=0, check_interval=5.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.reserve_bytes = reserve_bytes
+        self.check_interval = check_interval
+        self.in_use = 0
+        self.tickets = itertools.count()
+        self.waiting = deque()
+        self.condition = Condition()
+
+    def available(self):
+        """
+        The free bytes left for new work: free space, less the reserve and what admitted work will still write.
+        """
+        # What the admitted work has written so far is already gone from the free space
+        pending = max(0, self.in_use - folder_size(self.path))
+        return shutil.disk_usage(self.path).free - self.reserve_bytes - pending
+
+    def _fits(self, size):
+        if self.max_bytes and self.in_use and self.in_use + size > self.max_bytes:
+            return False
+        return size <= self.available()
+
+    def acquire(self, size, on_wait=None, on_stuck=None):
+        """
+        Waits until `size` bytes fit and reserves them. `on_wait()` is called once if it has to wait, and
+        `on_stuck()` once if it waits with nothing reserved, when no release can make it fit.
+        """
+        with self.condition:
+            ticket = next(self.tickets)
+            self.waiting.append(ticket)
+            try:
+                waiting = stuck = False
+                while self.waiting[0] != ticket or not self._fits(size):
+                    if not waiting and on_wait:
+                        on_wait()
+                    waiting = True
+                    if not stuck and self.waiting[0] == ticket and not self.in_use and on_stuck:
+                        on_stuck()
+                        stuck = True
+                    self.condition.wait(self.check_interval)
+                self.in_use += size
+            finally:
+                self.waiting.remove(ticket)
+                # The next in line may fit as well
+                self.condition.notify_all()
+        return size
+
+    def release(self, size):
+        with self.condition:
+            self.in_use -= size
+            self.condition.notify_all()
+
+
+FIFO = 'fifo'
+SMALLEST = 'smallest'
+MIXED = 'mixed'
+
+def order_by_size(items, order, size_of):
+    """
+    Orders work by size: FIFO keeps the order it came in, SMALLEST starts with the smallest items, and
+    MIXED alternates the smallest and the largest left, so short transfers run next to long ones.
+    Items whose size is None go last.
+    """
+    if order == FIFO:
+        return list(items)
+    if order not in (SMALLEST, MIXED):
+        raise ValueError(f"Unknown order {order}, expected one of {(FIFO, SMALLEST, MIXED)}")
+    sized = sorted((item for item in items if size_of(item) is not None), key=size_of)
+    unsized = [item for item in items if size_of(item) is None]
+    if order == SMALLEST:
+        return sized + unsized
+    mixed = []
+    smallest, largest = 0, len(sized) - 1
+    while smallest <= largest:
+        mixed.append(sized[smallest])
+        if smallest < largest:
+            mixed.append(sized[largest])
+        smallest += 1
+        largest -= 1
+    return mixed + unsized
+
+
+class Stage:
+    """
+    A pipeline stage. `handler(item)` does the work for one item and returns True to pass
+    the item on to the next stage, or False when the item is finished.
+    """
+    def __init__(self, name, handler, num_workers, max_queue_size):
+        self.name = name
+        self.handler = handler
+        self.num_workers = num_workers
+        self.queue = Queue(maxsize=max_queue_size)
+
+
+class Pipeline:
+    """
+    Runs items through a list of stages. Each stage has its own bounded queue, so a slow
+    stage pushes back on the stages before it, and `max_in_flight` caps how many items
+    are between the first and the last stage at any time (and therefore the disk in use).
+
+    `on_finish(item)` is called once an item has left the pipeline, successfully or not.
+    `on_error(item, exception)` is called when a handler raises and returns the number of
+    seconds after which the item should be retried from the first stage, or None to give up.
+    An `on_error` that raises itself is logged and the item given up, so it still leaves the pipeline.
+    Items waiting for a retry don't hold an in-flight slot.
+    """
+    def __init__(self, stages, max_in_flight, on_error, on_finish=None, logger=None):
+        self.stages = stages
+        self.logger = logger or logging.getLogger(__name__)
+        self.on_error = on_error
+        self.on_finish = on_finish
+        self.in_flight = Semaphore(max_in_flight)
+        self.feed_queue = DelayQueue()
+        self.outstanding = 0
+        self.outstanding_lock = Lock()
+        self.all_done = Condition(self.outstanding_lock)
+        self.threads = []
+
+    def start(self):
+        feeder = Thread(target=self._feeder, name="feeder", daemon=True)
+        feeder.start()
+        self.threads.append(feeder)
+        for index, stage in enumerate(self.stages):
+            for number in range(stage.num_workers):
+                t = Thread(target=self._worker, args=(index,), name=f"{stage.name}-{number}", daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, item, delay=0):
+        with self.outstanding_lock:
+            self.outstanding += 1
+        self.feed_queue.put(item, delay)
+
+    def join(self):
+        with self.all_done:
+            while self.outstanding > 0:
+                self.all_done.wait()
+
+    def queue_sizes(self):
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    def _feeder(self):
+        # Items (new and retried) only enter the first stage once an in-flight slot is free
+        while True:
+            item = self.feed_queue.get()
+            self.in_flight.acquire()
+            self.stages[0].queue.put(item)
+            self.feed_queue.task_done()
+
+    def _finish(self, item):
+        self.in_flight.release()
+        try:
+            if self.on_finish:
+                self.on_finish(item)
+        finally:
+            with self.all_done:
+                self.outstanding -= 1
+                if self.outstanding == 0:
+                    self.all_done.notify_all()
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        while True:
+            item = stage.queue.get()
+            try:
+                forward = stage.handler(item)
+            except Exception as e:
+                forward = False
+                try:
+                    retry_delay = self.on_error(item, e)
+                except Exception:
+                    self.logger.exception("Handling the error of an item in stage %s failed, giving it up", stage.name)
+                    retry_delay = None
+                if retry_delay is not None:
+                    # Give the slot back before retrying so the feeder can never block on us
+                    self.in_flight.release()
+                    self.feed_queue.put(item, retry_delay)
+                    stage.queue.task_done()
+                    continue
+            if forward and index + 1 < len(self.stages):
+                self.stages[index + 1].queue.put(item)
+            else:
+                self._finish(item)
+            stage.queue.task_done()
@@ -1,104 +1,284 @@
 # Description: This script downloads the files from the Google Drive folder and uploads them to Gong.
-# Usage: python process_files.py
+# Usage: python process_files.py [--dry-run [--json]]
 
+import argparse
 import datetime
+import hashlib
 import os
 import csv
 import json
+import logging
+import random
 import requests
-from queue import Queue
-from threading import Thread, Lock
+from threading import Thread, Lock, RLock, Event
 import zipfile
 from pathlib import Path
-import logging
-import pickle
+import shutil
 import subprocess
-import traceback
+import time
+from contextlib import contextmanager, nullcontext
+from fractions import Fraction
+from functools import partial, wraps
 
-from google_auth import authenticate_and_get_drive
+from pipeline import Pipeline, Stage, DelayQueue, DiskBudget, order_by_size
+from state_server import RemoteStateStore
+from state_store import StateStore, read_csv, read_progress, LeaseHeartbeat, LeaseLostError, DRIVE_MD5, VIDEO_SHA256, FINISHED_STATES
+from mp4_probe import probe_mp4, probe_mp4_in_zip, Mp4ProbeError, NoVideoTrackError
+from zip_stream import ZipMemberHasher
+from drive_client import DriveClient, ChecksumMismatchError, DriveHTTPError, is_transient_error as is_transient_drive_error
+from multipart_upload import MultipartFileStream, UploadMemoryBudget
+from gong_client import GongClient, RETRY_STATUS_CODES
+from user_directory import UserDirectory
+from metrics import counter, gauge, histogram, MetricsExporter, REGISTRY
+from structured_logging import configure_logging, log_context
+from concurrency import AdaptiveLimit
+from transcode import transcode, output_path as transcode_output_path, make_pool as make_transcode_pool, TranscodeError, AUDIO
 
 from settings import *
 
 
-def configure_logging():
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
+# Only a run configures the handlers and opens a log file, importing the module or planning a run doesn't
+logger = logging.getLogger(__name__)
 
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(threadName)s: %(message)s')
+def setup_logging():
+    return configure_logging(
+        __name__,
+        # One file per process, several can run side by side
+        os.path.join(LOG_DIR, datetime.datetime.now().strftime(f"process_files_%Y%m%d%H%M%S_{os.getpid()}.jsonl")),
+        file_level=LOG_FILE_LEVEL,
+        console_level=LOG_CONSOLE_LEVEL,
+        max_bytes=LOG_MAX_BYTES,
+        backup_count=LOG_BACKUP_COUNT,
+    )
 
-    log_file = os.path.join(LOG_DIR, datetime.datetime.now().strftime("process_files_%Y%m%d%H%M%S.log"))
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(logging.DEBUG)
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+STAGE_SECONDS = histogram('stage_duration_seconds', 'Time spent in a stage per file', ['stage', 'outcome'])
+BUSY_WORKERS = gauge('busy_workers', 'Workers running a stage right now', ['stage'])
+QUEUE_DEPTH = gauge('queue_depth', 'Files waiting for a stage', ['stage'])
+DOWNLOAD_BYTES = counter('drive_download_bytes_total', 'Bytes downloaded from Drive')
+DOWNLOAD_RESUMES = counter('drive_download_resumes_total', 'Dropped downloads resumed with a Range request')
+DOWNLOAD_CHECKSUM_ERRORS = counter('drive_download_checksum_errors_total', 'Downloads that did not match the Drive md5Checksum')
+DOWNLOAD_SECONDS = histogram('drive_download_duration_seconds', 'Drive download time per file', ['outcome'])
+UNZIP_SECONDS = histogram('unzip_duration_seconds', 'Time to extract an archive or read its metadata', ['mode', 'outcome'])
+PROBE_SECONDS = histogram('probe_duration_seconds', 'Time to read the length of a video', ['source', 'outcome'])
+GONG_REQUEST_SECONDS = histogram('gong_request_duration_seconds', 'Gong API latency per call, retries included', ['endpoint', 'outcome'])
+UPLOAD_BYTES = counter('gong_upload_bytes_total', 'Video bytes sent to Gong', ['outcome'])
+UPLOAD_THROUGHPUT = histogram(
+    'gong_upload_throughput_bytes_per_second',
+    'Throughput of each video upload',
+    ['outcome'],
+    buckets=(128 * 1024, 512 * 1024, 1024 ** 2, 2 * 1024 ** 2, 5 * 1024 ** 2, 10 * 1024 ** 2, 25 * 1024 ** 2, 50 * 1024 ** 2, 100 * 1024 ** 2),
+)
+TRANSCODE_SECONDS = histogram('transcode_duration_seconds', 'Time to transcode a video before uploading it', ['outcome'])
+TRANSCODE_SAVED_BYTES = counter('transcode_saved_bytes_total', 'Upload bytes saved by transcoding')
+DISK_RESERVED = gauge('disk_reserved_bytes', 'Scratch space reserved in DEST_DIR for the files in progress')
+ADMISSION_WAIT_SECONDS = histogram('admission_wait_seconds', 'Time files waited for scratch space before starting')
+TASK_RETRIES = counter('task_retries_total', 'Files started again after an error', ['error'])
 
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.DEBUG)
-    console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+def make_adaptive_limit(name, initial, minimum, maximum):
+    if not ADAPTIVE_CONCURRENCY:
+        # A fixed limit the size of the pool
+        minimum = maximum = initial
+    return AdaptiveLimit(
+        name,
+        initial,
+        minimum,
+        maximum,
+        interval=ADAPTIVE_INTERVAL,
+        error_rate=ADAPTIVE_ERROR_RATE,
+        latency_tolerance=ADAPTIVE_LATENCY_TOLERANCE,
+        congestion_errors=(requests.exceptions.RequestException,),
+        adaptive=ADAPTIVE_CONCURRENCY,
+        logger=logger,
+    )
 
-    return logger
+def pool_size(threads, limit: AdaptiveLimit):
+    return max(threads, limit.maximum)
 
-logger = configure_logging()
+def lazy(factory):
+    """
+    A RunContext attribute made by `factory` on first use, once, even with several threads asking at the same time.
+    """
+    name = factory.__name__
+    @property
+    @wraps(factory)
+    def getter(self):
+        if name not in self.__dict__:
+            with self.lock:
+                if name not in self.__dict__:
+                    self.__dict__[name] = factory(self)
+        return self.__dict__[name]
+    return getter
 
-drive, gauth = authenticate_and_get_drive()
+class RunContext:
+    """
+    The resources of a run, handed to the stages and workers. The Drive login, which may open a browser,
+    the user directory, the API clients and the transcode pool are only made when a file first needs them.
+    """
+    def __init__(self, state_store: StateStore):
+        self.state_store = state_store
+        self.lock = RLock()
+        self.upload_memory_budget = UploadMemoryBudget(UPLOAD_MEMORY_LIMIT)
+        self.disk_budget = DiskBudget(DEST_DIR, DISK_BUDGET, DISK_FREE_RESERVE, DISK_CHECK_INTERVAL)
+        self.content_claims = ContentClaims()
 
-user_map = pickle.load(open(USER_LIST_PICKLE, 'rb'))
+    def created(self, name):
+        return name in self.__dict__
 
-def remove_folder(folder_path):
-    logger.info(f"Removing folder: {folder_path}")
-    os.rmdir(folder_path)
+    @lazy
+    def gauth(self):
+        if DRIVE_ACCESS_TOKEN:
+            return None
+        from google_auth import authenticate_and_get_drive
+        drive, gauth = authenticate_and_get_drive()
+        return gauth
 
-def remove_file(file_path):
-    logger.info(f"Removing file: {file_path}")
-    os.remove(file_path)
+    def get_drive_access_token(self):
+        return DRIVE_ACCESS_TOKEN or self.gauth.credentials.access_token
 
-class ThreadSafeCsvWriter:
-    def __init__(self, file_name, fieldnames):
-        self.file_name = file_name
-        self.fieldnames = fieldnames
-        self.lock = Lock()
-        self.csv_file = open(file_name, 'a', newline='')
-        self.writer = csv.DictWriter(self.csv_file, fieldnames=fieldnames)
-        if os.path.getsize(file_name) == 0:
-            self.writer.writeheader()
+    def refresh_drive_auth(self):
+        if self.gauth and self.gauth.access_token_expired:
+            with self.lock:
+                if self.gauth.access_token_expired:
+                    self.gauth.Refresh()
 
-    def write_row(self, row_data):
-        with self.lock:
-            self.writer.writerow(row_data)
+    @lazy
+    def drive_client(self):
+        return DriveClient(DRIVE_API_URL, self.get_drive_access_token, timeout=(DRIVE_CONNECT_TIMEOUT, DRIVE_READ_TIMEOUT))
+
+    @lazy
+    def user_directory(self):
+        # Fetched through the shared client, so it counts against the same Gong rate limit as the uploads
+        return UserDirectory(
+            USER_DIRECTORY_FILE,
+            self.gong_client,
+            USER_DIRECTORY_TTL,
+            retry_interval=USER_DIRECTORY_RETRY_INTERVAL,
+            matcher_path=USER_MATCHER_PICKLE,
+            legacy_map_path=USER_LIST_PICKLE,
+            logger=logger,
+        ).open().start()
+
+    @lazy
+    def download_limit(self):
+        return make_adaptive_limit('download', DOWNLOAD_THREADS if PIPELINE_MODE else NUM_THREADS, MIN_ACTIVE_DOWNLOADS, MAX_ACTIVE_DOWNLOADS)
+
+    @lazy
+    def upload_limit(self):
+        return make_adaptive_limit('upload', UPLOAD_THREADS if PIPELINE_MODE else NUM_THREADS, MIN_ACTIVE_UPLOADS, MAX_ACTIVE_UPLOADS)
+
+    @lazy
+    def gong_client(self):
+        return GongClient(
+            GONG_API_URL,
+            GONG_KEY,
+            GONG_SECRET,
+            rate_limit=GONG_RATE_LIMIT,
+            burst=GONG_RATE_BURST,
+            max_retries=GONG_MAX_RETRIES,
+            backoff_base=GONG_BACKOFF_BASE,
+            backoff_max=GONG_BACKOFF_MAX,
+            pool_size=GONG_POOL_SIZE,
+            timeout=(GONG_CONNECT_TIMEOUT, GONG_READ_TIMEOUT),
+            logger=logger,
+            # Gong rate limits all our requests together, any throttling slows the uploads down
+            on_retry=lambda reason: self.upload_limit.record_throttle(),
+        )
 
-    def close(self):
-        self.csv_file.close()
+    @lazy
+    def transcode_pool(self):
+        # The worker processes only start with the first transcode
+        return make_transcode_pool(TRANSCODE_WORKERS)
 
+    def close(self, cancel=False):
+        for name in ('download_limit', 'upload_limit', 'user_directory'):
+            if self.created(name):
+                getattr(self, name).stop()
+        if self.created('transcode_pool'):
+            self.transcode_pool.shutdown(wait=not cancel, cancel_futures=cancel)
+
+def remove_folder(folder_path):
+    logger.info("Removing folder: %s", folder_path)
+    os.rmdir(folder_path)
+
+def remove_file(file_path):
+    logger.info("Removing file: %s", file_path)
+    os.remove(file_path)
 
 class InvalidVideoFileError(Exception):
     pass
 
-def get_video_length(filename):
+def get_video_length_with_ffprobe(filename):
+    # An argument list, the file name comes from the Drive file title
     try:
         result = subprocess.check_output(
-            f'ffprobe -v quiet -show_streams -select_streams v:0 -of json "{filename}"',
-            shell=True).decode()
-    except subprocess.CalledProcessError:
+            ['ffprobe', '-v', 'quiet', '-show_streams', '-select_streams', 'v:0', '-of', 'json', os.fspath(filename)]).decode()
+    except (subprocess.CalledProcessError, FileNotFoundError):
         raise Exception('ffprobe failed to run, please install ffmpeg on your system.')
     
     try:
         fields = json.loads(result)['streams'][0]
         duration = fields['duration']
-        fps      = eval(fields['r_frame_rate'])
-    except IndexError:
+        fps      = float(Fraction(fields['r_frame_rate']))
+    except (IndexError, KeyError, ValueError, ZeroDivisionError):
         raise InvalidVideoFileError
     return duration, fps
 
-def download_file(real_file_id, destination):
+def get_video_length(video):
+    """
+    Returns (duration, fps) of a video given as a path or a binary file object.
+    The MP4 header is parsed in process, ffprobe is only used for paths the parser can't read.
+    """
+    try:
+        return probe_mp4(video)
+    except NoVideoTrackError:
+        raise InvalidVideoFileError
+    except Mp4ProbeError as e:
+        if not isinstance(video, (str, os.PathLike)):
+            raise InvalidVideoFileError from e
+        logger.debug("Could not parse MP4 header, falling back to ffprobe - ERROR: %s - FILE: %s", e, video)
+    return get_video_length_with_ffprobe(video)
+
+def partial_download_path(destination):
+    return f"{destination}.part"
+
+def log_download_resume(real_file_id, offset):
+    DOWNLOAD_RESUMES.inc()
+    logger.warning("Download of %s dropped, resuming at %d bytes", real_file_id, offset)
+
+def download_file(context: RunContext, real_file_id, destination, size=None, md5_checksum=None, consumer=None):
+    """
+    Downloads to `destination` through a .part file that is kept when the download fails,
+    so the next attempt resumes where this one stopped. The result is checked against Drive's md5.
+    `consumer` is fed the content as it comes in, see DriveClient.download.
+    """
     # If the file exists, remove it and download again
     if os.path.exists(destination):
-        logger.info(f"ID: {real_file_id} - File already exists, removing: {destination}")
+        logger.info("File already exists, removing: %s", destination)
         remove_file(destination)
-        # raise Exception("File already exists")
-    logger.info(f"ID: {real_file_id} - Downloading file: {real_file_id} to {destination}")
-    sample_file = drive.CreateFile({'id': real_file_id})
-    sample_file.GetContentFile(destination)
+    partial_path = partial_download_path(destination)
+    if os.path.exists(partial_path):
+        logger.info("Resuming download of %s at %d bytes", real_file_id, os.path.getsize(partial_path))
+    else:
+        logger.info("Downloading file: %s to %s", real_file_id, destination)
+    try:
+        with DOWNLOAD_SECONDS.time():
+            fetched = context.drive_client.download(
+                real_file_id,
+                partial_path,
+                size=size,
+                md5_checksum=md5_checksum,
+                chunk_size=DOWNLOAD_CHUNK_SIZE,
+                max_resumes=DOWNLOAD_MAX_RESUMES,
+                on_resume=partial(log_download_resume, real_file_id),
+                consumer=consumer,
+            )
+    except ChecksumMismatchError:
+        DOWNLOAD_CHECKSUM_ERRORS.inc()
+        raise
+    os.replace(partial_path, destination)
+    DOWNLOAD_BYTES.inc(fetched)
+    context.download_limit.record_bytes(fetched)
+    logger.info("Downloaded %d bytes to %s", fetched, destination)
 
 def unpack_file(zip_file_path: str):
     extract_to_path = zip_file_path.replace('.zip', '')
@@ -117,25 +297,29 @@ def unpack_file(zip_file_path: str):
     remove_file(zip_file_path)
     return video_file, json_file, extract_to_path
 
+def read_zip_contents(zip_file_path: str):
+    """
+    Reads the metadata json of an archive in memory and returns (video member name, video size, metadata)
+    without extracting anything to disk.
+    """
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        names = zip_ref.namelist()
+        json_member = next(name for name in names if name.endswith('.json'))
+        video_member = next(name for name in names if name.endswith('.mp4'))
+        video_size = zip_ref.getinfo(video_member).file_size
+        info = json.loads(zip_ref.read(json_member))
+    return video_member, video_size, info
+
 def load_file_list():
     with open(INPUT_LIST, 'r') as f:
         reader = csv.DictReader(f)
         file_list = [row for row in reader]
     return file_list
 
-def load_processed_list(list_csv):
-    try:
-        with open(list_csv, 'r') as f:
-            reader = csv.DictReader(f)
-            completed_list = [row for row in reader]
-    except FileNotFoundError:
-        completed_list = []
-    return completed_list
-
-def create_call_in_gong(unique_id, title, start_time, primary_user_id, party_users, real_file_id):
+def create_call_in_gong(context: RunContext, unique_id, title, start_time, primary_user_id, party_users, real_file_id):
     # Limit title to 1024 characters
     title = title[:1024]
-    logger.info(f"ID: {real_file_id} - Creating call in Gong - UNIQUE_ID: {unique_id} TITLE: {title}")
+    logger.info("Creating call in Gong - UNIQUE_ID: %s TITLE: %s", unique_id, title)
     request_json = {
             "clientUniqueId": unique_id, 
             "title": title,
@@ -144,52 +328,116 @@ def create_call_in_gong(unique_id, title, start_time, primary_user_id, party_use
             "primaryUser": primary_user_id,
             "direction": "Inbound",
         }
-    logger.debug(f"ID: {real_file_id} - Request JSON: {request_json}")
-    response = requests.post(
-        f"{GONG_API_URL}/v2/calls",
-        auth=(GONG_KEY, GONG_SECRET),
-        json=request_json
-    )
+    logger.debug("Request JSON: %s", request_json)
+    with GONG_REQUEST_SECONDS.time(endpoint='create_call') as labels:
+        response = context.gong_client.post("/v2/calls", json=request_json)
+        labels['outcome'] = response.status_code
     if response.status_code >= 400:
-        logger.error(f"ID: {real_file_id} - Error creating call in Gong - UNIQUE_ID: {unique_id} TITLE: {title} STATUS_CODE: {response.status_code} RESPONSE: {response.text}")
+        logger.error("Error creating call in Gong - UNIQUE_ID: %s TITLE: %s STATUS_CODE: %s RESPONSE: %s", unique_id, title, response.status_code, response.text)
     response.raise_for_status()
     return response.json()['callId']
 
 class AlreadyUploadedError(Exception):
     pass
 
-def upload_file_to_gong_call(call_id, file_path, real_file_id):
-    logger.info(f"ID: {real_file_id} - Uploading file to Gong - CALL_ID: {call_id} FILE: {file_path}")
-    response = requests.put(
-        f"{GONG_API_URL}/v2/calls/{call_id}/media",
-        auth=(GONG_KEY, GONG_SECRET),
-        files={"mediaFile": open(file_path, 'rb')}
-    )
+class ClaimedElsewhereError(Exception):
+    """
+    Another worker holds the lease of the file. It is looked at again after `retry_after` seconds,
+    in case that worker dies or schedules a retry.
+    """
+    def __init__(self, owner, retry_after):
+        super().__init__(f"Claimed by {owner}")
+        self.owner = owner
+        self.retry_after = retry_after
+
+class FinishedElsewhereError(Exception):
+    pass
+
+class UploadIntegrityError(Exception):
+    pass
+
+def get_file_size(fileobj):
+    try:
+        return os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, OSError):
+        return None
+
+def upload_file_to_gong_call(context: RunContext, call_id, media_file, real_file_id, file_size=None):
+    """
+    Uploads a video to a Gong call. `media_file` is a path or an open binary file object,
+    such as a zip member opened with ZipFile.open. The multipart body is streamed with a
+    UPLOAD_CHUNK_SIZE buffer; without a known `file_size` it is sent with chunked encoding.
+    Returns the URL of the media, or None if a retry found it uploaded by an earlier attempt.
+    """
+    if isinstance(media_file, (str, os.PathLike)):
+        with open(media_file, 'rb') as f:
+            return upload_file_to_gong_call(context, call_id, f, real_file_id, file_size)
+    if file_size is None:
+        file_size = get_file_size(media_file)
+    file_path = getattr(media_file, 'name', 'mediaFile')
+    logger.info("Uploading file to Gong - CALL_ID: %s FILE: %s SIZE: %s", call_id, file_path, file_size)
+
+    last_progress_log = 0.0
+    def log_progress(bytes_sent, elapsed):
+        nonlocal last_progress_log
+        if elapsed - last_progress_log >= UPLOAD_PROGRESS_INTERVAL:
+            last_progress_log = elapsed
+            logger.info("Upload progress - CALL_ID: %s SENT: %d/%s bytes RATE: %.2f MB/s", call_id, bytes_sent, file_size, bytes_sent / elapsed / 1024 / 1024)
+
+    with MultipartFileStream(
+        "mediaFile",
+        os.path.basename(file_path),
+        media_file,
+        file_size=file_size,
+        chunk_size=UPLOAD_CHUNK_SIZE,
+        budget=context.upload_memory_budget,
+        on_progress=log_progress,
+    ) as body:
+        def make_body():
+            # A retried upload sends the file again from the start
+            body.rewind()
+            return body if file_size is not None else body.iter_chunks()
+
+        with GONG_REQUEST_SECONDS.time(endpoint='upload_media') as labels:
+            response = context.gong_client.put(
+                f"/v2/calls/{call_id}/media",
+                data_factory=make_body,
+                headers={"Content-Type": body.content_type}
+            )
+            labels['outcome'] = response.status_code
+    UPLOAD_BYTES.inc(body.bytes_sent, outcome=response.status_code)
+    context.upload_limit.record_bytes(body.bytes_sent)
+    if response.status_code < 400:
+        UPLOAD_THROUGHPUT.observe(body.throughput, outcome=response.status_code)
     if response.status_code >= 400:
-        logger.error(f"ID: {real_file_id} - Error uploading file to Gong - CALL_ID: {call_id} FILE: {file_path} STATUS_CODE: {response.status_code} RESPONSE: {response.text}")
-        if 'A media file with the same content has been uploaded in the past' in response.text:
-            logger.info(f"File already uploaded to Gong - CALL_ID: {call_id} FILE: {file_path}")
+        already_uploaded = 'A media file with the same content has been uploaded in the past' in response.text
+        if already_uploaded and response.attempts > 1:
+            # An earlier attempt of this same upload got through, Gong doesn't tell us its URL
+            logger.info("File uploaded by an earlier attempt - CALL_ID: %s FILE: %s", call_id, file_path)
+            return None
+        logger.error("Error uploading file to Gong - CALL_ID: %s FILE: %s STATUS_CODE: %s RESPONSE: %s", call_id, file_path, response.status_code, response.text)
+        if already_uploaded:
+            logger.info("File already uploaded to Gong - CALL_ID: %s FILE: %s", call_id, file_path)
             raise AlreadyUploadedError
         else:
             response.raise_for_status()
-    url = response.json()['url']
-    logger.info(f"ID: {real_file_id} - Uploaded file to Gong - CALL_ID: {call_id} FILE: {file_path} URL: {url}")
+    response_json = response.json()
+    # The mock Gong server echoes a digest of what it received, real Gong doesn't
+    if 'sha256' in response_json and response_json['sha256'] != body.sha256:
+        raise UploadIntegrityError(f"Uploaded content does not match - SENT: {body.sha256} RECEIVED: {response_json['sha256']}")
+    url = response_json['url']
+    logger.info("Uploaded file to Gong - CALL_ID: %s FILE: %s URL: %s SENT: %d bytes in %.1fs RATE: %.2f MB/s", call_id, file_path, url, body.bytes_sent, body.elapsed, body.throughput / 1024 / 1024)
     return url
 
-def get_user_id_if_exists(name):
-    if name in user_map:
-        return user_map[name]
-    for key, value in user_map.items():
-        if key in name:
-            return value
-    return None
+def get_user_id_if_exists(context: RunContext, name):
+    return context.user_directory.match(name)
 
-def create_party_users(participant_names):
+def create_party_users(context: RunContext, participant_names):
     primary_user_id = ""
     party_users = []
     user_id_map = set()
     for name in participant_names:
-        user_id = get_user_id_if_exists(name)
+        user_id = get_user_id_if_exists(context, name)
         primary_user_id = user_id if user_id else primary_user_id
         user_object = {"name": name}
         if user_id:
@@ -203,135 +451,726 @@ def create_party_users(participant_names):
         primary_user_id = DEFAULT_USER_ID
     return party_users, primary_user_id
 
-def is_video_short(video_file, real_file_id):
-    duration, fps = get_video_length(video_file)
-    logger.info(f"ID: {real_file_id} - Video length: {duration} FPS: {fps} - FILE: {video_file}")
+def is_length_short(duration, fps, real_file_id, source):
+    logger.info("Video length: %s FPS: %s - FILE: %s", duration, fps, source)
     if float(duration) < 60:
-        logger.info(f"ID: {real_file_id} - Video is less than 60 seconds, skipping - FILE: {video_file}")
+        logger.info("Video is less than 60 seconds, skipping - FILE: %s", source)
         return True
     return False
 
+def check_video_length(video_file, real_file_id):
+    """
+    Returns (is_short, duration in seconds) of a video file.
+    """
+    with PROBE_SECONDS.time(source='file') as labels:
+        duration, fps = get_video_length(video_file)
+        is_short = is_length_short(duration, fps, real_file_id, video_file)
+        labels['outcome'] = 'short' if is_short else 'long'
+    return is_short, float(duration)
+
+def get_zipped_video_length(zip_file_path, video_member):
+    """
+    Returns (duration, fps) of a video inside a local zip without extracting it.
+    Only if the header can't be parsed is the member extracted for ffprobe.
+    """
+    try:
+        with open(zip_file_path, 'rb') as f:
+            return probe_mp4_in_zip(f, max_read_bytes=None)
+    except NoVideoTrackError:
+        raise InvalidVideoFileError
+    except Mp4ProbeError as e:
+        logger.debug("Could not parse MP4 header, falling back to ffprobe - ERROR: %s - FILE: %s", e, zip_file_path)
+    extract_to_path = zip_file_path.replace('.zip', '') + '_probe'
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        video_file = zip_ref.extract(video_member, extract_to_path)
+    try:
+        return get_video_length_with_ffprobe(video_file)
+    finally:
+        shutil.rmtree(extract_to_path, ignore_errors=True)
+
+def check_zipped_video_length(zip_file_path, video_member, real_file_id):
+    """
+    Returns (is_short, duration in seconds) of a video inside a local zip.
+    """
+    with PROBE_SECONDS.time(source='zip') as labels:
+        duration, fps = get_zipped_video_length(zip_file_path, video_member)
+        is_short = is_length_short(duration, fps, real_file_id, f"{zip_file_path}:{video_member}")
+        labels['outcome'] = 'short' if is_short else 'long'
+    return is_short, float(duration)
+
+def is_remote_video_short(context: RunContext, real_file_id, size=None):
+    """
+    Checks the video length with a few ranged reads of the zip on Drive, before downloading it.
+    Returns False when the length can't be found this way, so the file is downloaded and checked as usual.
+    Without a known `size` it is looked up first.
+    """
+    if not PRECHECK_SHORT_VIDEOS:
+        return False
+    with PROBE_SECONDS.time(source='drive') as labels:
+        try:
+            with context.drive_client.open_range_reader(real_file_id, size=size, block_size=PRECHECK_BLOCK_SIZE) as reader:
+                duration, fps = probe_mp4_in_zip(reader, max_read_bytes=PRECHECK_MAX_READ_BYTES)
+        except NoVideoTrackError:
+            labels['outcome'] = 'no_video'
+            raise InvalidVideoFileError
+        except Exception as e:
+            logger.debug("Ranged length check failed, checking after download - ERROR: %s", e)
+            labels['outcome'] = 'failed'
+            return False
+        logger.info("Ranged length check read %d bytes in %d requests", reader.bytes_fetched, reader.requests_made)
+        is_short = is_length_short(duration, fps, real_file_id, f"drive:{real_file_id}")
+        labels['outcome'] = 'short' if is_short else 'long'
+    return is_short
+
 def convert_date_time_to_gong_format(date_time):
     date_strings = date_time.split(' ')
     date = date_strings[0]
     time = date_strings[1]
     return f"{date}T{time}Z"
 
-def process_files_to_gong(unique_id, meeting_video_file, info_json, real_file_id):
-    # Create the call in Gong
-    logger.info(f"ID: {real_file_id} - Upload data to gong - MEETING: {meeting_video_file} INFO: {info_json}")
-    with open(info_json, 'r') as f:
-        data = json.load(f)
-
-        meeting_title = data['MeetingTitle']
-        participant_names = data['ParticpantNames']
-        party_users, primary_user_id = create_party_users(participant_names)
-        start_time = convert_date_time_to_gong_format(data['StartTime'])
-
-        call_id = create_call_in_gong(
-            unique_id=unique_id,
-            title=f"{meeting_title} - {', '.join(participant_names)}",
-            start_time=start_time,
-            primary_user_id=primary_user_id,
-            party_users=party_users,
-            real_file_id=real_file_id
-        )
+def create_call_from_info(context: RunContext, unique_id, info, real_file_id):
+    meeting_title = info['MeetingTitle']
+    participant_names = info['ParticpantNames']
+    party_users, primary_user_id = create_party_users(context, participant_names)
+    start_time = convert_date_time_to_gong_format(info['StartTime'])
 
-    # Upload the video to Gong
-    url = upload_file_to_gong_call(call_id, meeting_video_file, real_file_id)
-    return call_id, url, participant_names
-    
+    call_id = create_call_in_gong(
+        context,
+        unique_id=unique_id,
+        title=f"{meeting_title} - {', '.join(participant_names)}",
+        start_time=start_time,
+        primary_user_id=primary_user_id,
+        party_users=party_users,
+        real_file_id=real_file_id
+    )
+    return call_id, participant_names
+
+class FileTask:
+    """
+    One Drive file travelling through the stages, with the paths and Gong ids
+    filled in by each stage as it goes.
+    """
+    def __init__(self, real_file_id, file_title, zip_file_destination, iterations=0, md5_checksum=None, size=None):
+        self.real_file_id = real_file_id
+        self.file_title = file_title
+        self.zip_file_destination = zip_file_destination
+        self.iterations = iterations
+        self.md5_checksum = md5_checksum
+        self.size = size
+        self.video_sha256 = None
+        # (zip member, sha256) of the video, when it was hashed during the download
+        self.downloaded_video_hash = None
+        self.content_claim = None
+        self.meeting_file = None
+        self.info_json = None
+        self.extracted_folder_path = None
+        self.video_member = None
+        self.video_size = None
+        self.video_duration = None
+        self.original_size = None
+        self.transcoded_file = None
+        self.disk_reservation = 0
+        self.info = None
+        self.call_id = None
+        self.participant_names = None
+
+@contextmanager
+def open_task_video(task: FileTask):
+    """
+    Opens the video of a task, either the extracted file or the member inside the zip.
+    """
+    if task.meeting_file:
+        with open(task.meeting_file, 'rb') as video:
+            yield video
+    else:
+        with zipfile.ZipFile(task.zip_file_destination, 'r') as zip_ref, zip_ref.open(task.video_member) as video:
+            yield video
+
+@contextmanager
+def open_task_upload(task: FileTask):
+    """
+    Opens what gets uploaded for a task, the transcoded file if there is one or else the video.
+    Yields the file and its size, None if it isn't known up front.
+    """
+    if task.transcoded_file:
+        with open(task.transcoded_file, 'rb') as upload:
+            yield upload, os.path.getsize(task.transcoded_file)
+    else:
+        with open_task_video(task) as video:
+            yield video, task.video_size
 
-def download_and_process_worker(file_queue: Queue, completed_list_writer: ThreadSafeCsvWriter, short_video_list_writer: ThreadSafeCsvWriter, error_video_list_writer: ThreadSafeCsvWriter):
+def hash_task_video(task: FileTask):
+    """
+    Returns the sha256 of the task's video, from the download if it was hashed as it came in.
+    """
+    if task.downloaded_video_hash:
+        member, sha256 = task.downloaded_video_hash
+        video_path = task.video_member or os.path.relpath(task.meeting_file, task.extracted_folder_path).replace(os.sep, '/')
+        if member == video_path:
+            return sha256
+    logger.debug("Reading the video to hash it - FILE: %s", task.file_title)
+    digest = hashlib.sha256()
+    with open_task_video(task) as video:
+        while chunk := video.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ContentClaims:
+    """
+    Content hashes of the files being processed right now. A second file with the same content
+    waits for the first to finish, and then finds it in the content index if it was uploaded.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.claims = {}
+
+    def claim(self, key):
+        while True:
+            with self.lock:
+                released = self.claims.get(key)
+                if released is None:
+                    self.claims[key] = Event()
+                    return
+            released.wait()
+
+    def release(self, key):
+        with self.lock:
+            self.claims.pop(key).set()
+
+def check_content_not_uploaded(task: FileTask, state_store: StateStore, hash_type, value):
+    known = state_store.find_content(hash_type, value)
+    if known:
+        logger.info("Content already uploaded by %s to CALL_ID: %s - %s: %s", known['file_id'], known['call_id'], hash_type, value)
+        raise AlreadyUploadedError
+
+def record_task_content(task: FileTask, state_store: StateStore):
+    state_store.record_content(task.real_file_id, task.call_id, {DRIVE_MD5: task.md5_checksum, VIDEO_SHA256: task.video_sha256})
+
+def claim_task(task: FileTask, state_store: StateStore):
+    """
+    Takes the lease of the task's file, so no other worker process works on it at the same time.
+    """
+    claimed, row = state_store.claim(task.real_file_id, task.file_title, WORKER_ID, LEASE_SECONDS)
+    if row['state'] in FINISHED_STATES:
+        raise FinishedElsewhereError
+    if not claimed:
+        # Look again when the lease or the other worker's retry delay runs out, and at least every heartbeat
+        due = max(row['lease_expires_at'] or 0, row['next_attempt_at'] or 0)
+        raise ClaimedElsewhereError(row['lease_owner'], min(LEASE_HEARTBEAT_INTERVAL, max(1.0, due - time.time())))
+    # Keep counting the retries of a worker that died
+    task.iterations = max(task.iterations, row['retries'])
+
+def scratch_bytes(task: FileTask):
+    """
+    The most disk space a task is expected to take in DEST_DIR at once, from the Drive file size.
+    """
+    size = task.size if task.size is not None else UNKNOWN_FILE_SIZE
+    # The zip, the extracted video, and the transcode input (taken out of the zip when streaming) and output
+    copies = 1 if STREAM_FROM_ZIP else 2
+    if TRANSCODE_MODE:
+        copies += (1 if STREAM_FROM_ZIP else 0) + (1 - TRANSCODE_MIN_SAVING)
+    return int(size * copies)
+
+def look_up_task_size(task: FileTask, context: RunContext):
+    """
+    Fills in the size and checksum of a task the file list has no size for, from its Drive metadata.
+    """
+    if task.size is not None:
+        return
+    context.refresh_drive_auth()
+    try:
+        metadata = context.drive_client.get_metadata(task.real_file_id, fields='size,md5Checksum')
+    except Exception as e:
+        logger.warning("Could not look up the file size, assuming %d bytes - ERROR: %s - FILE: %s",
+                       UNKNOWN_FILE_SIZE, e, task.file_title)
+        return
+    if metadata.get('size'):
+        task.size = int(metadata['size'])
+    task.md5_checksum = task.md5_checksum or metadata.get('md5Checksum')
+
+def admit_task(task: FileTask, disk_budget: DiskBudget):
+    """
+    Waits until the task's scratch space fits the disk budget and reserves it until the task is cleaned up.
+    """
+    size = scratch_bytes(task)
+    def log_wait():
+        logger.info("Waiting for %d bytes of scratch space, %d reserved, %d available - FILE: %s",
+                    size, disk_budget.in_use, disk_budget.available(), task.file_title)
+    def log_stuck():
+        logger.error("%d bytes of scratch space don't fit in the free space of %s even with nothing else reserved, "
+                     "waiting for space to be freed - FILE: %s", size, DEST_DIR, task.file_title)
+    with ADMISSION_WAIT_SECONDS.time():
+        task.disk_reservation = disk_budget.acquire(size, on_wait=log_wait, on_stuck=log_stuck)
+    DISK_RESERVED.inc(task.disk_reservation)
+
+def make_client_unique_id(real_file_id, number):
+    return f"{real_file_id}-{number}-reupload"
+
+def cleanup_task(task: FileTask, context: RunContext):
+    for path in (task.zip_file_destination, task.meeting_file, task.info_json, task.transcoded_file):
+        if path and os.path.exists(path):
+            remove_file(path)
+    if task.extracted_folder_path and os.path.exists(task.extracted_folder_path):
+        remove_folder(task.extracted_folder_path)
+    task.meeting_file = None
+    task.info_json = None
+    task.extracted_folder_path = None
+    task.transcoded_file = None
+    if task.disk_reservation:
+        context.disk_budget.release(task.disk_reservation)
+        DISK_RESERVED.dec(task.disk_reservation)
+        task.disk_reservation = 0
+    if task.content_claim:
+        context.content_claims.release(task.content_claim)
+        task.content_claim = None
+    task.video_member = None
+    task.video_size = None
+    task.downloaded_video_hash = None
+
+def timed_stage(name, limit=None):
+    """
+    Runs a stage with the file id and stage name in the log context and logs how long it took,
+    the benchmark reads these records for its per-stage latencies. With a `limit`, the name of
+    an AdaptiveLimit of the run context, the stage first waits for one of its slots.
+    """
+    def decorator(stage_function):
+        @wraps(stage_function)
+        def wrapper(task: FileTask, context: RunContext):
+            with getattr(context, limit).slot() if limit else nullcontext(), log_context(file_id=task.real_file_id, stage=name):
+                started_at = time.monotonic()
+                try:
+                    with BUSY_WORKERS.track(stage=name), STAGE_SECONDS.time(stage=name) as labels:
+                        forward = stage_function(task, context)
+                        labels['outcome'] = 'ok' if forward else 'skipped'
+                    return forward
+                finally:
+                    duration = time.monotonic() - started_at
+                    logger.info("Stage %s took %.3fs", name, duration, extra={'duration': duration})
+        return wrapper
+    return decorator
+
+@timed_stage("download", 'download_limit')
+def download_stage(task: FileTask, context: RunContext):
+    state_store = context.state_store
+    context.refresh_drive_auth()
+    logger.info("Processing file - TITLE: %s ITERATIONS: %d", task.file_title, task.iterations)
+    state_store.mark_downloading(task.real_file_id, task.file_title)
+    check_content_not_uploaded(task, state_store, DRIVE_MD5, task.md5_checksum)
+    if is_remote_video_short(context, task.real_file_id, task.size):
+        state_store.mark_short(task.real_file_id, task.file_title)
+        cleanup_task(task, context)
+        return False
+    # The video is hashed as the zip comes in, so it isn't read again for the content index
+    video_hasher = ZipMemberHasher('.mp4') if CONTENT_HASH_VIDEOS else None
+    download_file(context, task.real_file_id, task.zip_file_destination, task.size, task.md5_checksum, video_hasher)
+    if video_hasher and video_hasher.hexdigest():
+        task.downloaded_video_hash = (video_hasher.name, video_hasher.hexdigest())
+    return True
+
+@timed_stage("unpack")
+def unpack_stage(task: FileTask, context: RunContext):
+    state_store = context.state_store
+    if STREAM_FROM_ZIP:
+        logger.info("Reading archive - FILE: %s", task.zip_file_destination)
+        with UNZIP_SECONDS.time(mode='read'):
+            task.video_member, task.video_size, task.info = read_zip_contents(task.zip_file_destination)
+        task.original_size = task.video_size
+        is_short, task.video_duration = check_zipped_video_length(task.zip_file_destination, task.video_member, task.real_file_id)
+    else:
+        logger.info("Unpacking file - FILE: %s", task.zip_file_destination)
+        with UNZIP_SECONDS.time(mode='extract'):
+            task.meeting_file, task.info_json, task.extracted_folder_path = unpack_file(task.zip_file_destination)
+        with open(task.info_json, 'r') as f:
+            task.info = json.load(f)
+        task.original_size = os.path.getsize(task.meeting_file)
+        is_short, task.video_duration = check_video_length(task.meeting_file, task.real_file_id)
+    if is_short:
+        state_store.mark_short(task.real_file_id, task.file_title)
+        cleanup_task(task, context)
+        return False
+    if CONTENT_HASH_VIDEOS:
+        task.video_sha256 = hash_task_video(task)
+        context.content_claims.claim(task.video_sha256)
+        task.content_claim = task.video_sha256
+        check_content_not_uploaded(task, state_store, VIDEO_SHA256, task.video_sha256)
+    return True
+
+def transcode_task_video(task: FileTask, context: RunContext):
+    """
+    Transcodes the video of a task into `task.transcoded_file` if that saves enough bytes, and
+    returns the outcome. The original is uploaded when the transcode is skipped or fails.
+    """
+    expected_kbps = TRANSCODE_AUDIO_KBPS if TRANSCODE_MODE == AUDIO else TRANSCODE_LOWRES_KBPS
+    expected_size = (task.video_duration or 0) * expected_kbps * 1000 / 8
+    max_size = task.original_size * (1 - TRANSCODE_MIN_SAVING)
+    if task.original_size < TRANSCODE_MIN_SIZE or expected_size > max_size:
+        logger.info("Not transcoding, about %d of %d bytes would be left", expected_size, task.original_size)
+        return 'skipped'
+
+    destination = transcode_output_path(os.path.splitext(task.zip_file_destination)[0], TRANSCODE_MODE)
+    source = task.meeting_file
+    extract_to_path = None
+    if source is None:
+        # ffmpeg needs to seek in its input, so the video comes out of the zip for it
+        extract_to_path = os.path.splitext(task.zip_file_destination)[0] + '_transcode'
+        with zipfile.ZipFile(task.zip_file_destination, 'r') as zip_ref:
+            source = zip_ref.extract(task.video_member, extract_to_path)
+    logger.info("Transcoding to %s - FILE: %s", TRANSCODE_MODE, source)
+    try:
+        size = context.transcode_pool.submit(
+            transcode, source, destination, TRANSCODE_MODE, height=TRANSCODE_LOWRES_HEIGHT, max_kbps=TRANSCODE_LOWRES_KBPS
+        ).result()
+    except TranscodeError as e:
+        logger.warning("Transcoding failed, uploading the original - ERROR: %s", e)
+        return 'failed'
+    finally:
+        if extract_to_path:
+            shutil.rmtree(extract_to_path, ignore_errors=True)
+
+    if size > max_size:
+        logger.info("Transcoding left %d of %d bytes, uploading the original", size, task.original_size)
+        remove_file(destination)
+        return 'no_saving'
+    task.transcoded_file = destination
+    TRANSCODE_SAVED_BYTES.inc(task.original_size - size)
+    logger.info("Transcoded %d bytes to %d - FILE: %s", task.original_size, size, destination)
+    return 'transcoded'
+
+@timed_stage("transcode")
+def transcode_stage(task: FileTask, context: RunContext):
+    with TRANSCODE_SECONDS.time() as labels:
+        labels['outcome'] = transcode_task_video(task, context)
+    return True
+
+@timed_stage("create_call")
+def create_call_stage(task: FileTask, context: RunContext):
+    state_store = context.state_store
+    # Reserved under the lease, so no two attempts or workers ever create a call with the same id
+    unique_id = state_store.reserve_call_id(task.real_file_id, WORKER_ID, partial(make_client_unique_id, task.real_file_id), task.iterations)
+    task.call_id, task.participant_names = create_call_from_info(context, unique_id, task.info, task.real_file_id)
+    state_store.record_call_id(unique_id, task.call_id)
+    return True
+
+@timed_stage("upload", 'upload_limit')
+def upload_stage(task: FileTask, context: RunContext):
+    state_store = context.state_store
+    state_store.check_lease(task.real_file_id, WORKER_ID)
+    state_store.mark_uploading(task.real_file_id, task.file_title, task.call_id)
+    with open_task_upload(task) as (media_file, upload_size):
+        url = upload_file_to_gong_call(context, task.call_id, media_file, task.real_file_id, upload_size)
+        if upload_size is None:
+            upload_size = get_file_size(media_file)
+    record_task_content(task, state_store)
+    state_store.mark_completed(task.real_file_id, task.file_title, task.call_id, url, task.participant_names,
+                               original_size=task.original_size, uploaded_size=upload_size)
+    cleanup_task(task, context)
+    return True
+
+def claim_and_download_stage(task: FileTask, context: RunContext):
+    # Claimed and admitted outside the download stage, so checking files other workers hold, or waiting
+    # for disk space, doesn't count as downloading
+    claim_task(task, context.state_store)
+    look_up_task_size(task, context)
+    admit_task(task, context.disk_budget)
+    return download_stage(task, context)
+
+def process_task(task: FileTask, context: RunContext):
+    """
+    Runs every stage for one task on the calling thread.
+    """
+    if not claim_and_download_stage(task, context):
+        return
+    if not unpack_stage(task, context):
+        return
+    if TRANSCODE_MODE:
+        transcode_stage(task, context)
+    create_call_stage(task, context)
+    upload_stage(task, context)
+
+def retry_delay(retries):
+    # Exponential backoff with jitter, so files that failed together don't all come back together
+    delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (retries - 1))
+    return random.uniform(delay / 2, delay)
+
+def is_transient_http_error(error):
+    if isinstance(error, DriveHTTPError):
+        return is_transient_drive_error(error)
+    return error.response is not None and error.response.status_code in RETRY_STATUS_CODES
+
+def handle_task_error(task: FileTask, error: Exception, context: RunContext):
+    """
+    Records the outcome of a failed task. Returns the seconds to wait before retrying it,
+    or None if it is finished. Retries are saved in the state store, so they survive a restart.
+    """
+    state_store = context.state_store
+    real_file_id, file_title = task.real_file_id, task.file_title
+    delay = None
+    log_fields = {'file_id': real_file_id}
+    # Nothing was done for these, and the file belongs to another worker
+    if isinstance(error, FinishedElsewhereError):
+        logger.info("File finished by another worker - FILE: %s", file_title, extra=log_fields)
+        return None
+    if isinstance(error, ClaimedElsewhereError):
+        logger.debug("File claimed by %s, checking again in %.0fs - FILE: %s", error.owner, error.retry_after, file_title, extra=log_fields)
+        return error.retry_after
+    if isinstance(error, AlreadyUploadedError):
+        # Before cleaning up, so a file waiting on the same content finds it in the index
+        record_task_content(task, state_store)
+    try:
+        cleanup_task(task, context)
+    except Exception as e:
+        logger.error("An error occurred while cleaning up files - ERROR: %s - FILE: %s", e, file_title, exc_info=True, extra=log_fields)
+    if isinstance(error, LeaseLostError):
+        # Another worker took the file over, it records the outcome; look again in case it dies too
+        logger.warning("Lease lost to another worker, leaving the file to it - FILE: %s", file_title, extra=log_fields)
+        task.call_id = None
+        delay = LEASE_HEARTBEAT_INTERVAL
+    elif isinstance(error, AlreadyUploadedError):
+        logger.info("AlreadyUploadedError - File already uploaded to Gong - FILE: %s", file_title, extra=log_fields)
+        state_store.mark_error(real_file_id, file_title, 'Already uploaded')
+    elif isinstance(error, InvalidVideoFileError):
+        logger.info("InvalidVideoFileError - Invalid video file, writing to short video list - FILE: %s", file_title, extra=log_fields)
+        state_store.mark_short(real_file_id, file_title)
+    elif isinstance(error, DriveHTTPError) and not is_transient_http_error(error):
+        logger.error("DriveHTTPError - An error occurred while downloading from Drive - ERROR: %s - FILE: %s", error, file_title, exc_info=error, extra=log_fields)
+        state_store.mark_error(real_file_id, file_title, 'Drive download error')
+    elif isinstance(error, requests.exceptions.HTTPError) and not is_transient_http_error(error):
+        logger.error("HTTPError - An error occurred while uploading to Gong - ERROR: %s - FILE: %s", error, file_title, exc_info=error, extra=log_fields)
+        state_store.mark_error(real_file_id, file_title, 'Gong upload error')
+    else:
+        logger.info("An error occurred for task - ERROR: %s - FILE: %s", error, file_title, exc_info=error, extra=log_fields)
+        if task.iterations < MAX_ITERATIONS:
+            TASK_RETRIES.inc(error=type(error).__name__)
+            task.iterations += 1
+            task.call_id = None
+            delay = retry_delay(task.iterations)
+            logger.info("Retrying in %.0fs - RETRY: %d/%d FILE: %s", delay, task.iterations, MAX_ITERATIONS, file_title, extra=log_fields)
+            state_store.mark_retrying(real_file_id, file_title, task.iterations, time.time() + delay, str(error)[:500])
+        else:
+            logger.info("Max iterations reached for task - FILE: %s", file_title, extra=log_fields)
+            state_store.mark_error(real_file_id, file_title, 'Max iterations reached')
+    if delay is None:
+        # The task is finished, a partial download won't be resumed
+        partial_path = partial_download_path(task.zip_file_destination)
+        if os.path.exists(partial_path):
+            remove_file(partial_path)
+    return delay
+
+def download_and_process_worker(file_queue: DelayQueue, context: RunContext):
     while True:
+        logger.info("File queue size: %d", file_queue.qsize())
+        task = file_queue.get()
         try:
-            if gauth.access_token_expired:
-                gauth.Refresh()
-            logger.info(f"File queue size: {file_queue.qsize()}")
-            real_file_id, file_title, zip_file_destination, iterations = file_queue.get()
-            logger.info(f"ID: {real_file_id} - Processing file - TITLE: {file_title} ITERATIONS: {iterations}")
-            download_file(real_file_id, zip_file_destination)
-            logger.info(f"ID: {real_file_id} - Unpacking file - FILE: {zip_file_destination}")
-            meeting_file, info_json, extracted_folder_path = unpack_file(zip_file_destination)
-            if is_video_short(meeting_file, real_file_id):
-                short_video_list_writer.write_row({'id': real_file_id, 'title': file_title})
-            else:
-                unique_id = f"{real_file_id}-{iterations}-reupload"
-                call_id, url, participant_names = process_files_to_gong(unique_id, meeting_file, info_json, real_file_id)
-                completed_list_writer.write_row({
-                    'id': real_file_id, 
-                    'title': file_title, 
-                    'call_id': call_id, 
-                    'url': url, 
-                    'participant_names': '|'.join(participant_names)
-                })
-            remove_file(meeting_file)
-            remove_file(info_json)
-            remove_folder(extracted_folder_path)
-        except AlreadyUploadedError:
-            logger.info(f"ID: {real_file_id} - AlreadyUploadedError - File already uploaded to Gong - FILE: {file_title}")
-            error_video_list_writer.write_row({'id': real_file_id, 'title': file_title, 'reason': 'Already uploaded'})
-        except InvalidVideoFileError:
-            logger.info(f"ID: {real_file_id} - InvalidVideoFileError - Invalid video file, writing to short video list - FILE: {file_title}")
-            short_video_list_writer.write_row({'id': real_file_id, 'title': file_title})
-        except requests.exceptions.HTTPError as e:
-            logger.error(f"ID: {real_file_id} - HTTPError - An error occurred while uploading to Gong - ERROR: {e} - FILE: {file_title} TRACEBACK: {traceback.format_exc()}")
-            error_video_list_writer.write_row({'id': real_file_id, 'title': file_title, 'reason': 'Gong upload error'})
+            process_task(task, context)
         except Exception as e:
-            logger.info(f"ID: {real_file_id} - An error occurred for task - ERROR: {e} - FILE: {file_title} TRACEBACK: {traceback.format_exc()}")
             try:
-                remove_file(meeting_file)
-                remove_file(info_json)
-                remove_folder(extracted_folder_path)
-            except Exception as e:
-                logger.error(f"ID: {real_file_id} - An error occurred while cleaning up files - ERROR: {e} - FILE: {file_title} TRACEBACK: {traceback.format_exc()}")
-            if iterations < MAX_ITERATIONS:
-                file_queue.put((real_file_id, file_title, zip_file_destination, iterations + 1))
-            else:
-                logger.info(f"ID: {real_file_id} - Max iterations reached for task - FILE: {file_title}")
-                error_video_list_writer.write_row({'id': real_file_id, 'title': file_title, 'reason': 'Max iterations reached'})
-        file_queue.task_done()
-        logger.info(f"ID: {real_file_id} - Task done - FILE: {file_title}")
+                delay = handle_task_error(task, e, context)
+            except Exception:
+                # Its state wasn't recorded, the next run picks the file up again
+                logger.exception("Handling the error of a task failed, giving it up - FILE: %s", task.file_title, extra={'file_id': task.real_file_id})
+                delay = None
+            if delay is not None:
+                file_queue.put(task, delay)
+        finally:
+            file_queue.task_done()
+        logger.info("Task done - FILE: %s", task.file_title, extra={'file_id': task.real_file_id})
 
-def main():
-    file_list = load_file_list()
-    completed_list = load_processed_list(COMPLETED_LIST_CSV)
-    short_video_list = load_processed_list(SHORT_VIDEO_LIST_CSV)
-    error_video_list = load_processed_list(ERROR_VIDEO_LIST_CSV)
-
-    completed_list_writer = ThreadSafeCsvWriter(COMPLETED_LIST_CSV, ['id', 'title', 'call_id', 'url', 'participant_names'])
-    short_video_list_writer = ThreadSafeCsvWriter(SHORT_VIDEO_LIST_CSV, ['id', 'title'])
-    error_video_list_writer = ThreadSafeCsvWriter(ERROR_VIDEO_LIST_CSV, ['id', 'title', 'reason'])
-
-    # Return all files from file_list that do not have an id in completed_list or short_video_list
-    file_list = [f for f in file_list if f['id'] not in [c['id'] for c in completed_list]]
-    file_list = [f for f in file_list if f['id'] not in [c['id'] for c in short_video_list]]
-    file_list = [f for f in file_list if f['id'] not in [c['id'] for c in error_video_list]]
-    
-    file_queue = Queue()
+def run_pipeline(tasks, context: RunContext):
+    stages = [
+        Stage("download", partial(claim_and_download_stage, context=context), pool_size(DOWNLOAD_THREADS, context.download_limit), PIPELINE_QUEUE_SIZE),
+        Stage("unpack", partial(unpack_stage, context=context), UNPACK_THREADS, PIPELINE_QUEUE_SIZE),
+        Stage("create_call", partial(create_call_stage, context=context), CREATE_CALL_THREADS, PIPELINE_QUEUE_SIZE),
+        Stage("upload", partial(upload_stage, context=context), pool_size(UPLOAD_THREADS, context.upload_limit), PIPELINE_QUEUE_SIZE),
+    ]
+    if TRANSCODE_MODE:
+        # One thread per pool process, each waits on its transcode
+        stages.insert(2, Stage("transcode", partial(transcode_stage, context=context), TRANSCODE_WORKERS, PIPELINE_QUEUE_SIZE))
+    pipeline = Pipeline(
+        stages,
+        max_in_flight=PIPELINE_MAX_IN_FLIGHT,
+        on_error=partial(handle_task_error, context=context),
+        logger=logger,
+        on_finish=lambda task: logger.info("Task done - FILE: %s QUEUES: %s", task.file_title, pipeline.queue_sizes(), extra={'file_id': task.real_file_id}),
+    )
+    def collect_queue_depths():
+        # Files not yet admitted to the pipeline wait in the feed queue, or for their retry
+        delayed = pipeline.feed_queue.delayed_count()
+        QUEUE_DEPTH.set(pipeline.feed_queue.qsize() - delayed, stage='feed')
+        QUEUE_DEPTH.set(delayed, stage='retry_wait')
+        for name, size in pipeline.queue_sizes().items():
+            QUEUE_DEPTH.set(size, stage=name)
 
+    REGISTRY.add_collector(collect_queue_depths)
+    pipeline.start()
+    for task, delay in tasks:
+        pipeline.submit(task, delay)
     try:
-        # Load the file queue from the saved file list
-        for file_entry in file_list:
-            destination = os.path.join(DEST_DIR, file_entry['title'])
-            file_queue.put((file_entry['id'], file_entry['title'], destination, 0))
+        pipeline.join()
+    finally:
+        REGISTRY.remove_collector(collect_queue_depths)
 
-        for _ in range(NUM_THREADS):
-            t = Thread(target=download_and_process_worker, args=(file_queue, completed_list_writer, short_video_list_writer, error_video_list_writer))
-            t.daemon = True
-            t.start()
+def run_worker_threads(tasks, context: RunContext):
+    file_queue = DelayQueue()
 
+    # Load the file queue from the saved file list
+    for task, delay in tasks:
+        file_queue.put(task, delay)
+
+    def collect_queue_depths():
+        delayed = file_queue.delayed_count()
+        QUEUE_DEPTH.set(file_queue.qsize() - delayed, stage='download')
+        QUEUE_DEPTH.set(delayed, stage='retry_wait')
+
+    REGISTRY.add_collector(collect_queue_depths)
+    # Each worker downloads and uploads, so there are enough of them for the most of either
+    for _ in range(max(pool_size(NUM_THREADS, context.download_limit), context.upload_limit.maximum)):
+        t = Thread(target=download_and_process_worker, args=(file_queue, context))
+        t.daemon = True
+        t.start()
+
+    try:
         file_queue.join()
+    finally:
+        REGISTRY.remove_collector(collect_queue_depths)
+
+def open_state_store():
+    if STATE_SERVER_URL:
+        # The server imports the CSV ledgers of its own host
+        return RemoteStateStore(STATE_SERVER_URL, STATE_SERVER_TOKEN)
+    state_store = StateStore(STATE_DB, batch_size=STATE_BATCH_SIZE, flush_interval=STATE_FLUSH_INTERVAL, logger=logger)
+    if state_store.is_empty():
+        # First run with the state database, carry over the CSV ledgers of earlier runs
+        count = state_store.import_csvs(COMPLETED_LIST_CSV, SHORT_VIDEO_LIST_CSV, ERROR_VIDEO_LIST_CSV)
+        if count:
+            logger.info("Imported %d rows from the CSV ledgers into %s", count, STATE_DB)
+    return state_store
+
+def make_task(file_entry):
+    destination = os.path.join(DEST_DIR, file_entry['title'])
+    size = int(file_entry['size']) if file_entry.get('size') else None
+    return FileTask(file_entry['id'], file_entry['title'], destination, md5_checksum=file_entry.get('md5Checksum'), size=size)
+
+def main():
+    setup_logging()
+    logger.debug("Base directory: %s", BASE_DIR)
+    file_list = load_file_list()
+    state_store = open_state_store()
+
+    backfilled = state_store.backfill_drive_md5(file_list)
+    if backfilled:
+        logger.info("Added %d uploaded files to the content index", backfilled)
+
+    # Return all files from file_list that have not been uploaded, skipped as short or failed
+    finished_ids = state_store.finished_ids()
+    file_list = [f for f in file_list if f['id'] not in finished_ids]
+    logger.info("Worker %s: %d files to process, %d already finished", WORKER_ID, len(file_list), len(finished_ids))
+
+    # Files that failed in an earlier run keep their retry count and wait out the rest of their backoff
+    pending_retries = state_store.pending_retries()
+    now = time.time()
+    tasks = []
+    for file_entry in file_list:
+        task = make_task(file_entry)
+        delay = 0
+        if file_entry['id'] in pending_retries:
+            task.iterations, next_attempt_at = pending_retries[file_entry['id']]
+            delay = max(0, (next_attempt_at or now) - now)
+        else:
+            state_store.mark_queued(file_entry['id'], file_entry['title'], WORKER_ID)
+        tasks.append((task, delay))
+    retrying = sum(1 for f in file_list if f['id'] in pending_retries)
+    if retrying:
+        logger.info("%d files are waiting to be retried", retrying)
+    tasks = order_by_size(tasks, SCHEDULE_ORDER, lambda entry: entry[0].size)
+
+    context = RunContext(state_store)
+    metrics_exporter = MetricsExporter(METRICS_PORT, METRICS_SNAPSHOT, METRICS_SNAPSHOT_INTERVAL, logger=logger).start()
+    if metrics_exporter.server:
+        logger.info("Serving metrics on http://127.0.0.1:%d/metrics", METRICS_PORT)
+    context.download_limit.start()
+    context.upload_limit.start()
+    lease_heartbeat = LeaseHeartbeat(state_store, WORKER_ID, LEASE_SECONDS, LEASE_HEARTBEAT_INTERVAL, logger).start()
+
+    try:
+        if PIPELINE_MODE:
+            run_pipeline(tasks, context)
+        else:
+            run_worker_threads(tasks, context)
     except KeyboardInterrupt:
         logger.info("Keyboard interrupt, stopping threads.")
-        completed_list_writer.close()
-        short_video_list_writer.close()
+        lease_heartbeat.stop()
+        # The files in progress can be claimed again right away, by this worker's next run or another
+        state_store.release_leases(WORKER_ID)
+        context.close(cancel=True)
+        metrics_exporter.stop()
+        state_store.close()
         exit()
 
-    completed_list_writer.close()
-    short_video_list_writer.close()
+    lease_heartbeat.stop()
+    state_store.release_leases(WORKER_ID)
+    context.close()
+    metrics_exporter.stop()
+    state_store.close()
     logger.info("All files downloaded and processed.")
 
+def plan_run():
+    """
+    Works out what a run would do without logging in anywhere, writing a log file or changing any state:
+    the files left to process, those waiting for a retry, and the bytes to download.
+    """
+    file_list = load_file_list()
+    finished_ids, pending_retries = None, {}
+    if STATE_SERVER_URL:
+        state_store = RemoteStateStore(STATE_SERVER_URL, STATE_SERVER_TOKEN)
+        if not state_store.is_empty():
+            finished_ids, pending_retries = state_store.finished_ids(), state_store.pending_retries()
+        state_store.close()
+    elif os.path.exists(STATE_DB):
+        finished_ids, pending_retries = read_progress(STATE_DB)
+    if finished_ids is None:
+        # What the first run would import from the CSV ledgers
+        finished_ids = {row['id'] for path in (COMPLETED_LIST_CSV, SHORT_VIDEO_LIST_CSV, ERROR_VIDEO_LIST_CSV) for row in read_csv(path)}
+
+    tasks = order_by_size([make_task(f) for f in file_list if f['id'] not in finished_ids], SCHEDULE_ORDER, lambda task: task.size)
+    sizes = [task.size for task in tasks if task.size is not None]
+    now = time.time()
+    retry_due = [next_attempt_at or now for file_id, (retries, next_attempt_at) in pending_retries.items()
+                 if file_id not in finished_ids]
+    return {
+        'worker_id': WORKER_ID,
+        'files': len(file_list),
+        'finished': len(file_list) - len(tasks),
+        'pending': len(tasks),
+        'retrying': len(retry_due),
+        'next_retry_in': max(0.0, min(retry_due) - now) if retry_due else None,
+        'pending_bytes': sum(sizes),
+        'unknown_size': len(tasks) - len(sizes),
+        'largest_scratch_bytes': max((scratch_bytes(task) for task in tasks), default=0),
+        'disk_budget': DISK_BUDGET,
+        'disk_free': shutil.disk_usage(DEST_DIR).free if os.path.isdir(DEST_DIR) else None,
+        'order': SCHEDULE_ORDER,
+        'first_files': [task.file_title for task in tasks[:5]],
+    }
+
+def print_plan(plan):
+    gb = 1024 ** 3
+    print(f"Worker {plan['worker_id']}: {plan['pending']} of {plan['files']} files to process, {plan['finished']} already finished")
+    if plan['retrying']:
+        print(f"  {plan['retrying']} waiting to be retried, the next in {plan['next_retry_in']:.0f}s")
+    print(f"  {plan['pending_bytes'] / gb:.2f} GB to download" + (f", {plan['unknown_size']} without a size" if plan['unknown_size'] else ""))
+    disk_free = f"{plan['disk_free'] / gb:.2f} GB free in DEST_DIR" if plan['disk_free'] is not None else "DEST_DIR missing"
+    print(f"  Largest file needs {plan['largest_scratch_bytes'] / gb:.2f} GB of scratch space, budget {plan['disk_budget'] / gb:.2f} GB, {disk_free}")
+    if plan['first_files']:
+        print(f"  First in {plan['order']} order: {', '.join(plan['first_files'])}")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Download the files of the file list from Google Drive and upload them to Gong')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what is left to process, without logging in anywhere')
+    parser.add_argument('--json', action='store_true', help='With --dry-run, print the plan as JSON')
+    args = parser.parse_args()
+    if args.dry_run:
+        plan = plan_run()
+        print(json.dumps(plan)) if args.json else print_plan(plan)
+    else:
+        main()
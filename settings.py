@@ -1,19 +1,33 @@
 import os
+import socket
 
 BASE_DIR = os.getcwd()
-print(BASE_DIR)
 
 DATA_DIR = os.path.join(BASE_DIR, 'data')
 LOG_DIR = os.path.join(BASE_DIR, 'logs')
 DEST_DIR = os.path.join(BASE_DIR, 'dest')
 
+# Names this process in the leases of the state database and its metrics snapshot, host name and pid by default
+WORKER_ID = os.environ.get('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+
+# The Gong users call participants are matched to. process_files.py keeps the directory cached here and fetches
+# it again in the background once it is USER_DIRECTORY_TTL seconds old, or USER_DIRECTORY_RETRY_INTERVAL seconds
+# after a failed fetch. USER_LIST_PICKLE is the map older versions saved, only read while there is no cache yet
+USER_DIRECTORY_FILE = os.path.join(DATA_DIR, 'user_directory.json.gz')
+USER_DIRECTORY_TTL = 3600
+USER_DIRECTORY_RETRY_INTERVAL = 300
 USER_LIST_PICKLE = os.path.join(DATA_DIR, 'user_list.pickle')
 USER_LIST_CSV = os.path.join(DATA_DIR, 'user_list.csv')
+USER_MATCHER_PICKLE = os.path.join(DATA_DIR, 'user_matcher.pickle')
 
 
 GOOGLE_FOLDER_ID = os.environ.get('GOOGLE_FOLDER_ID')
 
-GONG_API_URL = 'https://us-27353.api.gong.io'
+DRIVE_API_URL = os.environ.get('DRIVE_API_URL', 'https://www.googleapis.com/drive/v3')
+# Set to use a fixed Drive access token instead of the PyDrive2 login, e.g. against the benchmark's fake Drive
+DRIVE_ACCESS_TOKEN = os.environ.get('DRIVE_ACCESS_TOKEN')
+
+GONG_API_URL = os.environ.get('GONG_API_URL', 'https://us-27353.api.gong.io')
 # GONG_API_URL = 'http://localhost:8000'
 
 GONG_KEY = os.environ.get('GONG_KEY')
@@ -25,8 +39,136 @@ INPUT_LIST = os.path.join(DATA_DIR, 'file_list.csv')
 COMPLETED_LIST_CSV = os.path.join(DATA_DIR, 'completed_list.csv')
 SHORT_VIDEO_LIST_CSV = os.path.join(DATA_DIR, 'short_video_list.csv')
 ERROR_VIDEO_LIST_CSV = os.path.join(DATA_DIR, 'error_video_list.csv')
+STATE_DB = os.path.join(DATA_DIR, 'state.db')
+DRIVE_CHANGES_TOKEN = os.path.join(DATA_DIR, 'drive_changes_token.json')
 CREDENTIALS_FILE = os.path.join(DATA_DIR, 'credentials.json')
 LOG_FILE = os.path.join(LOG_DIR, 'process_files.log')
 
 NUM_THREADS = 5
-MAX_ITERATIONS = 0
\ No newline at end of file
+# Files that fail with a temporary error are retried up to MAX_ITERATIONS times, after waiting
+# RETRY_BACKOFF_BASE * 2^(retry - 1) seconds (randomized, at most RETRY_BACKOFF_MAX)
+MAX_ITERATIONS = 3
+RETRY_BACKOFF_BASE = 30
+RETRY_BACKOFF_MAX = 3600
+
+# Pipeline mode: separate worker pools for download, unpack/probe, call creation and upload
+PIPELINE_MODE = False
+DOWNLOAD_THREADS = 3
+UNPACK_THREADS = 2
+CREATE_CALL_THREADS = 2
+UPLOAD_THREADS = 3
+# Max items waiting between two stages
+PIPELINE_QUEUE_SIZE = 2
+# Max items downloaded but not yet finished, caps the disk used in DEST_DIR
+PIPELINE_MAX_IN_FLIGHT = 8
+
+# Admission control: a file is only started while the projected scratch space of the files in progress in DEST_DIR
+# (the zip, its extracted copy and any transcoded copy, from the Drive file size) stays under DISK_BUDGET bytes and
+# fits in the free space less DISK_FREE_RESERVE. Files that don't fit wait, and are checked again as others finish
+# or every DISK_CHECK_INTERVAL seconds. DISK_BUDGET = 0 only checks the free space.
+DISK_BUDGET = 20 * 1024 ** 3
+DISK_FREE_RESERVE = 1024 ** 3
+DISK_CHECK_INTERVAL = 5
+# Drive file size assumed for the budget when the file list has none (lists written before sizes were recorded) and
+# Drive can't be asked for it
+UNKNOWN_FILE_SIZE = 2 * 1024 ** 3
+# Order the files are started in: 'fifo' keeps the file list order, 'smallest' starts with the smallest files for quick
+# wins, 'mixed' alternates small and large files so the Drive and Gong links both stay busy
+SCHEDULE_ORDER = 'fifo'
+
+# Check the video length with HTTP Range reads of the zip on Drive before downloading it
+PRECHECK_SHORT_VIDEOS = True
+PRECHECK_BLOCK_SIZE = 32 * 1024
+# Compressed zip members can't be skipped through, give up on the pre-check after this many bytes
+PRECHECK_MAX_READ_BYTES = 4 * 1024 * 1024
+
+# Read the metadata and stream the video straight out of the downloaded zip instead of extracting it
+STREAM_FROM_ZIP = False
+
+# Uploads are streamed from disk with a buffer of UPLOAD_CHUNK_SIZE bytes per upload,
+# and all uploads together hold at most UPLOAD_MEMORY_LIMIT bytes of buffers
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_MEMORY_LIMIT = 32 * 1024 * 1024
+UPLOAD_PROGRESS_INTERVAL = 30
+
+# Gong API client: requests per second (with bursts), retries for 429/5xx, connection pool size, and the seconds
+# to wait for a connection and between bytes of a response (an upload's response only comes once Gong has it all).
+# Creating a call and uploading its media are only retried on 429/503 or when no connection could be made, since
+# Gong may have acted on a request that timed out
+GONG_RATE_LIMIT = 3
+GONG_RATE_BURST = 3
+GONG_MAX_RETRIES = 5
+GONG_BACKOFF_BASE = 1.0
+GONG_BACKOFF_MAX = 60.0
+GONG_POOL_SIZE = 10
+GONG_CONNECT_TIMEOUT = 10
+GONG_READ_TIMEOUT = 300
+
+# State database writes are committed in batches of up to STATE_BATCH_SIZE, at most STATE_FLUSH_INTERVAL seconds apart
+STATE_BATCH_SIZE = 200
+STATE_FLUSH_INTERVAL = 0.5
+
+# Transcode videos before uploading them, Gong only needs the audio: 'audio' copies the audio track out of the MP4
+# without re-encoding, 'lowres' re-encodes the video at TRANSCODE_LOWRES_HEIGHT lines, None uploads the originals.
+# ffmpeg runs in TRANSCODE_WORKERS processes. Videos under TRANSCODE_MIN_SIZE bytes, or whose expected output
+# (TRANSCODE_AUDIO_KBPS or TRANSCODE_LOWRES_KBPS over their duration) saves less than TRANSCODE_MIN_SAVING of
+# the bytes, are uploaded as they are, as are transcodes that turn out not to save enough.
+TRANSCODE_MODE = None
+TRANSCODE_WORKERS = os.cpu_count() or 1
+TRANSCODE_MIN_SIZE = 20 * 1024 * 1024
+TRANSCODE_MIN_SAVING = 0.3
+TRANSCODE_AUDIO_KBPS = 128
+TRANSCODE_LOWRES_HEIGHT = 360
+TRANSCODE_LOWRES_KBPS = 600
+
+# Hash every video before creating its Gong call and skip content that was uploaded before. The video is hashed as the
+# zip downloads, and only read again when the zip's layout can't be followed as it streams in
+CONTENT_HASH_VIDEOS = True
+
+# Metrics in the Prometheus text format on http://127.0.0.1:METRICS_PORT/metrics (off with 0, the default, as every
+# process on a host needs its own port), and a JSON snapshot written to METRICS_SNAPSHOT, one per worker, every
+# METRICS_SNAPSHOT_INTERVAL seconds
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_SNAPSHOT = os.path.join(LOG_DIR, f"metrics_{WORKER_ID}.json")
+METRICS_SNAPSHOT_INTERVAL = 60
+
+# Logging: JSON lines to a file in LOG_DIR, rotated every LOG_MAX_BYTES with LOG_BACKUP_COUNT old files kept,
+# and text on the console. Each sink has its own level.
+LOG_FILE_LEVEL = 'DEBUG'
+LOG_CONSOLE_LEVEL = 'INFO'
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 10
+
+# Adaptive concurrency: the number of active downloads and uploads starts at DOWNLOAD_THREADS and UPLOAD_THREADS
+# (NUM_THREADS in worker mode) and moves between the bounds below. Every ADAPTIVE_INTERVAL seconds it grows by one
+# while all workers are busy, and is halved when errors and 429s are over ADAPTIVE_ERROR_RATE of the attempts or the
+# time per MB goes over ADAPTIVE_LATENCY_TOLERANCE times the best seen. The worker pools are sized for the max.
+ADAPTIVE_CONCURRENCY = True
+MIN_ACTIVE_DOWNLOADS = 1
+MAX_ACTIVE_DOWNLOADS = 8
+MIN_ACTIVE_UPLOADS = 1
+MAX_ACTIVE_UPLOADS = 8
+ADAPTIVE_INTERVAL = 10
+ADAPTIVE_ERROR_RATE = 0.05
+ADAPTIVE_LATENCY_TOLERANCE = 2.0
+
+# Downloads go to a .part file that later attempts resume from, a dropped connection is resumed
+# DOWNLOAD_MAX_RESUMES times within an attempt. Finished downloads are checked against Drive's md5Checksum.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_MAX_RESUMES = 3
+# Seconds to wait for a Drive connection and between bytes of a response, a stalled download is resumed
+DRIVE_CONNECT_TIMEOUT = 10
+DRIVE_READ_TIMEOUT = 60
+
+# Several processes on one host can work through the same file list, sharing STATE_DB on a local disk (SQLite in WAL
+# mode, so not on a network filesystem; across hosts see STATE_SERVER_URL below). Each file is claimed with a lease of LEASE_SECONDS
+# that is renewed every LEASE_HEARTBEAT_INTERVAL seconds while the process runs; when a process dies its files are
+# claimed by the others once their leases run out. Each process is named by WORKER_ID; give every process on a host
+# its own METRICS_PORT (or 0).
+LEASE_SECONDS = 300
+LEASE_HEARTBEAT_INTERVAL = 60
+# Workers on several hosts share the state through state_server.py, run on the host that keeps STATE_DB. Set
+# STATE_SERVER_URL on the workers to use it instead of a local STATE_DB, and STATE_SERVER_TOKEN on all of them
+# to require that token
+STATE_SERVER_URL = os.environ.get('STATE_SERVER_URL')
+STATE_SERVER_TOKEN = os.environ.get('STATE_SERVER_TOKEN')
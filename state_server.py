@@ -0,0 +1,176 @@
+# Description: Serves the state database to workers on other hosts. The database stays on the local disk of the
+# host running this server, and workers on any host reach its leases, clientUniqueId reservations and file states
+# over HTTP through RemoteStateStore, which stands in for StateStore in process_files.py.
+# Usage: python state_server.py [--host 0.0.0.0] [--port 8770]
+#   then run the workers with STATE_SERVER_URL=http://<host>:8770 (and the same STATE_SERVER_TOKEN if one is set)
+
+import argparse
+import json
+import logging
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from state_store import StateStore, LeaseLostError
+
+# The StateStore methods workers may call
+METHODS = {
+    'mark_queued', 'mark_downloading', 'mark_uploading', 'mark_completed', 'mark_retrying', 'mark_short', 'mark_error',
+    'claim', 'holds_lease', 'check_lease', 'renew_leases', 'release_leases', 'reserve_call_id', 'record_call_id',
+    'record_content', 'find_content', 'backfill_drive_md5', 'get', 'is_finished', 'finished_ids', 'pending_retries',
+    'count_by_state', 'is_empty', 'flush',
+}
+# Stands in for the number in a clientUniqueId template sent to reserve_call_id
+NUMBER_PLACEHOLDER = '\0number\0'
+
+
+class StateServerError(Exception):
+    pass
+
+
+class StateHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(format, *args)
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.token and self.headers.get('Authorization') != f"Bearer {self.server.token}":
+            self.send_json({'error': 'Unauthorized', 'message': 'Wrong or missing token'}, 401)
+            return
+        method = self.path.strip('/')
+        if method not in METHODS:
+            self.send_json({'error': 'NotFound', 'message': f"No method {method}"}, 404)
+            return
+        request = json.loads(body or b'{}')
+        args, kwargs = request.get('args', []), request.get('kwargs', {})
+        if method == 'reserve_call_id':
+            # The id template comes in place of the client's function
+            template = args[2]
+            args[2] = lambda number: template.replace(NUMBER_PLACEHOLDER, str(number))
+        try:
+            result = getattr(self.server.state_store, method)(*args, **kwargs)
+        except LeaseLostError as e:
+            self.send_json({'error': 'LeaseLostError', 'message': str(e)}, 409)
+            return
+        except Exception as e:
+            self.server.logger.exception("State call %s failed", method)
+            self.send_json({'error': type(e).__name__, 'message': str(e)}, 500)
+            return
+        if isinstance(result, set):
+            result = sorted(result)
+        self.send_json({'result': result})
+
+
+class StateServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # A worker killed mid-call drops its connection, that is not the server's problem
+        error = sys.exc_info()[1]
+        if isinstance(error, ConnectionError):
+            self.logger.debug("Lost the connection to %s: %s", client_address, error)
+        else:
+            self.logger.exception("Request from %s failed", client_address)
+
+
+def make_server(state_store, host='127.0.0.1', port=8770, token=None, logger=None):
+    server = StateServer((host, port), StateHandler)
+    server.state_store = state_store
+    server.token = token
+    server.logger = logger or logging.getLogger(__name__)
+    return server
+
+
+class RemoteStateStore:
+    """
+    The StateStore of a state server, with the same methods process_files.py uses. Calls that can't reach
+    the server are tried `attempts` times, `retry_delay` seconds apart. Every call is committed or queued
+    on the server before it returns, like on a local StateStore.
+    """
+    def __init__(self, url, token=None, timeout=(10, 60), attempts=3, retry_delay=1.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.session = requests.Session()
+        if token:
+            self.session.headers['Authorization'] = f"Bearer {token}"
+
+    def _call(self, method, *args, **kwargs):
+        for attempt in range(1, self.attempts + 1):
+            try:
+                response = self.session.post(f"{self.url}/{method}", json={'args': args, 'kwargs': kwargs}, timeout=self.timeout)
+                break
+            except requests.exceptions.ConnectionError:
+                if attempt == self.attempts:
+                    raise
+                time.sleep(self.retry_delay)
+        body = response.json()
+        if response.status_code == 409:
+            raise LeaseLostError(body['message'])
+        if response.status_code != 200:
+            raise StateServerError(f"{method} failed on the state server: {body.get('error')}: {body.get('message')}")
+        return body['result']
+
+    def __getattr__(self, method):
+        if method not in METHODS:
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self._call(method, *args, **kwargs)
+
+    def claim(self, file_id, title, owner, lease_seconds):
+        claimed, row = self._call('claim', file_id, title, owner, lease_seconds)
+        return claimed, row
+
+    def reserve_call_id(self, file_id, owner, make_unique_id, first_number=0):
+        return self._call('reserve_call_id', file_id, owner, make_unique_id(NUMBER_PLACEHOLDER), first_number)
+
+    def backfill_drive_md5(self, file_list):
+        # Only the fields it reads
+        return self._call('backfill_drive_md5', [{'id': f['id'], 'md5Checksum': f.get('md5Checksum')} for f in file_list])
+
+    def finished_ids(self):
+        return set(self._call('finished_ids'))
+
+    def pending_retries(self):
+        return {file_id: tuple(value) for file_id, value in self._call('pending_retries').items()}
+
+    def close(self):
+        self.session.close()
+
+
+if __name__ == "__main__":
+    from settings import (STATE_DB, STATE_BATCH_SIZE, STATE_FLUSH_INTERVAL, STATE_SERVER_TOKEN,
+                          COMPLETED_LIST_CSV, SHORT_VIDEO_LIST_CSV, ERROR_VIDEO_LIST_CSV)
+
+    parser = argparse.ArgumentParser(description='Serve the state database to workers on other hosts')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on, 0.0.0.0 for every interface')
+    parser.add_argument('--port', type=int, default=8770)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    state_store = StateStore(STATE_DB, batch_size=STATE_BATCH_SIZE, flush_interval=STATE_FLUSH_INTERVAL)
+    if state_store.is_empty():
+        # Like the first local run, carry over the CSV ledgers of earlier runs
+        count = state_store.import_csvs(COMPLETED_LIST_CSV, SHORT_VIDEO_LIST_CSV, ERROR_VIDEO_LIST_CSV)
+        if count:
+            logging.info("Imported %d rows from the CSV ledgers into %s", count, STATE_DB)
+    server = make_server(state_store, args.host, args.port, STATE_SERVER_TOKEN)
+    logging.info("Serving %s on http://%s:%d", STATE_DB, args.host, server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state_store.close()
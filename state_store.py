@@ -0,0 +1,622 @@
+# Description: SQLite backed state for every Drive file, replacing the CSV ledgers.
+# Writes go through one writer thread that commits them in batches, reads are O(1) lookups by file id.
+# Several processes on one host can share the database: a file is only worked on by the process holding its lease,
+# and every Gong clientUniqueId is reserved here before its call is created, so none is created twice. The database
+# runs in WAL mode, which needs memory shared by all its processes: it must be on a local disk, not on a network
+# filesystem, and can't be opened by processes on different hosts: those reach it through state_server.py.
+# Usage: python state_store.py import|export
+#   import: loads completed_list.csv, short_video_list.csv and error_video_list.csv into the state database
+#   export: writes the same three CSV files from the state database
+
+import argparse
+import csv
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
+
+from metrics import counter
+
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+UPLOADING = 'uploading'
+RETRYING = 'retrying'
+UPLOADED = 'uploaded'
+SHORT = 'short'
+ERROR = 'error'
+FINISHED_STATES = (UPLOADED, SHORT, ERROR)
+
+# Kinds of content hashes in the content index
+DRIVE_MD5 = 'drive_md5'
+VIDEO_SHA256 = 'video_sha256'
+
+FILES_FINISHED = counter('files_finished_total', 'Files that reached a finished state', ['state', 'reason'])
+
+COMPLETED_FIELDS = ['id', 'title', 'call_id', 'url', 'participant_names', 'original_size', 'uploaded_size']
+SHORT_FIELDS = ['id', 'title']
+ERROR_FIELDS = ['id', 'title', 'reason']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    state TEXT NOT NULL,
+    reason TEXT,
+    call_id TEXT,
+    url TEXT,
+    participant_names TEXT,
+    original_size INTEGER,
+    uploaded_size INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    retries INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_state ON files (state);
+CREATE TABLE IF NOT EXISTS content_hashes (
+    hash_type TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    call_id TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (hash_type, hash)
+);
+CREATE TABLE IF NOT EXISTS gong_calls (
+    client_unique_id TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    owner TEXT,
+    call_id TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS gong_calls_file ON gong_calls (file_id);
+"""
+
+UPSERT = """
+INSERT INTO files (id, title, state, reason, call_id, url, participant_names, original_size, uploaded_size, attempts, retries, next_attempt_at, created_at, updated_at)
+VALUES (:id, :title, :state, :reason, :call_id, :url, :participant_names, :original_size, :uploaded_size, :attempts, COALESCE(:retries, 0), :next_attempt_at, :now, :now)
+ON CONFLICT (id) DO UPDATE SET
+    title = COALESCE(excluded.title, files.title),
+    state = excluded.state,
+    reason = excluded.reason,
+    call_id = COALESCE(excluded.call_id, files.call_id),
+    url = COALESCE(excluded.url, files.url),
+    participant_names = COALESCE(excluded.participant_names, files.participant_names),
+    original_size = COALESCE(excluded.original_size, files.original_size),
+    uploaded_size = COALESCE(excluded.uploaded_size, files.uploaded_size),
+    attempts = files.attempts + excluded.attempts,
+    retries = COALESCE(:retries, files.retries),
+    next_attempt_at = excluded.next_attempt_at,
+    updated_at = excluded.updated_at
+"""
+
+INSERT_CONTENT_HASH = """
+INSERT OR IGNORE INTO content_hashes (hash_type, hash, file_id, call_id, created_at)
+VALUES (:hash_type, :hash, :file_id, :call_id, :now)
+"""
+
+# Content of files uploaded before the content index existed
+BACKFILL_DRIVE_MD5 = """
+INSERT OR IGNORE INTO content_hashes (hash_type, hash, file_id, call_id, created_at)
+SELECT :hash_type, :hash, id, call_id, :now FROM files WHERE id = :file_id AND state = 'uploaded'
+"""
+
+# Queues a file unless it is finished or another process is working on it
+ENQUEUE = """
+INSERT INTO files (id, title, state, created_at, updated_at)
+VALUES (:id, :title, 'queued', :now, :now)
+ON CONFLICT (id) DO UPDATE SET
+    title = COALESCE(excluded.title, files.title),
+    state = excluded.state,
+    updated_at = excluded.updated_at
+WHERE files.state NOT IN ('uploaded', 'short', 'error', 'retrying')
+    AND (files.lease_expires_at IS NULL OR files.lease_expires_at < :now OR files.lease_owner = :owner)
+"""
+
+# Takes the lease of a file that isn't finished, isn't leased by another process (or its lease ran out)
+# and isn't waiting for a retry scheduled by another process. Changes no row if the file can't be claimed.
+CLAIM = """
+INSERT INTO files (id, title, state, created_at, updated_at, lease_owner, lease_expires_at)
+VALUES (:id, :title, 'queued', :now, :now, :owner, :expires_at)
+ON CONFLICT (id) DO UPDATE SET
+    lease_owner = excluded.lease_owner,
+    lease_expires_at = excluded.lease_expires_at
+WHERE files.state NOT IN ('uploaded', 'short', 'error')
+    AND (files.lease_owner IS NULL OR files.lease_owner = :owner OR files.lease_expires_at < :now)
+    AND (files.next_attempt_at IS NULL OR files.next_attempt_at <= :now OR files.lease_owner = :owner)
+"""
+
+# A lease that already ran out isn't renewed, another process may have claimed the file since
+RENEW_LEASES = """
+UPDATE files SET lease_expires_at = :expires_at
+WHERE lease_owner = :owner AND lease_expires_at >= :now AND state NOT IN ('uploaded', 'short', 'error')
+"""
+
+RELEASE_LEASES = """
+UPDATE files SET lease_owner = NULL, lease_expires_at = NULL WHERE lease_owner = :owner
+"""
+
+HOLDS_LEASE = """
+SELECT 1 FROM files WHERE id = :id AND lease_owner = :owner AND lease_expires_at >= :now
+"""
+
+
+# Columns added after the first version of the schema, added to older databases on connect
+MIGRATIONS = {
+    'retries': 'ALTER TABLE files ADD COLUMN retries INTEGER NOT NULL DEFAULT 0',
+    'next_attempt_at': 'ALTER TABLE files ADD COLUMN next_attempt_at REAL',
+    'lease_owner': 'ALTER TABLE files ADD COLUMN lease_owner TEXT',
+    'lease_expires_at': 'ALTER TABLE files ADD COLUMN lease_expires_at REAL',
+    'original_size': 'ALTER TABLE files ADD COLUMN original_size INTEGER',
+    'uploaded_size': 'ALTER TABLE files ADD COLUMN uploaded_size INTEGER',
+}
+
+
+def connect(path):
+    # Other processes may hold the write lock for a batch, wait for it rather than fail
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    # Readers don't block the writer; only safe for processes on the same host, on a local disk
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    columns = {row['name'] for row in connection.execute('PRAGMA table_info(files)')}
+    with connection:
+        for column, sql in MIGRATIONS.items():
+            if column not in columns:
+                try:
+                    connection.execute(sql)
+                except sqlite3.OperationalError as e:
+                    # Another process starting at the same time added it first
+                    if 'duplicate column' not in str(e):
+                        raise
+    return connection
+
+
+class PendingWrite:
+    """
+    Lets a caller wait for its write to be committed. The writer thread hands over the error if it
+    failed for good, and `wait()` raises it.
+    """
+    def __init__(self):
+        self.event = Event()
+        self.error = None
+
+    def set(self, error=None):
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class LeaseLostError(Exception):
+    """
+    The lease of a file ran out and was taken by another process while this one worked on it.
+    """
+    pass
+
+
+class StateStore:
+    """
+    State of every Drive file by id: queued, downloading, uploading, retrying, uploaded, short or
+    error, with the number of attempts and timestamps. A file waiting to be retried keeps its retry
+    count and when it is due, so the backoff carries over to the next run. Uploaded files keep the size of the
+    original video and of what was uploaded, which is smaller when it was transcoded. It also indexes the content hashes of uploaded
+    files, so content that is already in Gong can be skipped.
+
+    Processes sharing the database `claim()` a file before working on it, which gives them its lease
+    for `lease_seconds`. A `LeaseHeartbeat` renews the leases of a running process; the files of a
+    process that died become claimable once its leases run out.
+
+    Updates are handed to a writer thread that commits up to `batch_size` of them per transaction,
+    waiting at most `flush_interval` seconds for a batch to fill. Updates to a finished state
+    wait for their commit, so a file is never reported done before it is on disk. A batch that fails,
+    e.g. on a database locked by another process or a full disk, is rolled back and tried again up to
+    `write_attempts` times, then each update on its own; an update that still fails raises in the
+    caller waiting for it, and is logged otherwise.
+    """
+    def __init__(self, path, batch_size=200, flush_interval=0.5, write_attempts=3, retry_delay=1.0, logger=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_attempts = write_attempts
+        self.retry_delay = retry_delay
+        self.logger = logger or logging.getLogger(__name__)
+        self.connection = connect(path)
+        self.read_lock = Lock()
+        self.queue = Queue()
+        self.writer = Thread(target=self._write_batches, name="state-writer", daemon=True)
+        self.writer.start()
+
+    def set_state(self, file_id, title, state, reason=None, call_id=None, url=None, participant_names=None,
+                  original_size=None, uploaded_size=None, new_attempt=False, retries=None, next_attempt_at=None, wait=None):
+        params = {
+            'id': file_id,
+            'title': title,
+            'state': state,
+            'reason': reason,
+            'call_id': None if call_id is None else str(call_id),
+            'url': url,
+            'participant_names': participant_names,
+            'original_size': original_size,
+            'uploaded_size': uploaded_size,
+            'attempts': 1 if new_attempt else 0,
+            'retries': retries,
+            'next_attempt_at': next_attempt_at,
+            'now': time.time(),
+        }
+        if wait is None:
+            wait = state in FINISHED_STATES
+        self._write(UPSERT, params, wait)
+        if state in FINISHED_STATES:
+            FILES_FINISHED.inc(state=state, reason=reason or '')
+
+    def _write(self, sql, params, wait):
+        done = PendingWrite() if wait else None
+        self.queue.put((sql, params, done))
+        if done:
+            done.wait()
+
+    def mark_queued(self, file_id, title, owner=None):
+        self._write(ENQUEUE, {'id': file_id, 'title': title, 'owner': owner, 'now': time.time()}, wait=False)
+
+    def mark_downloading(self, file_id, title):
+        self.set_state(file_id, title, DOWNLOADING, new_attempt=True)
+
+    def mark_uploading(self, file_id, title, call_id):
+        self.set_state(file_id, title, UPLOADING, call_id=call_id)
+
+    def mark_completed(self, file_id, title, call_id, url, participant_names, original_size=None, uploaded_size=None):
+        self.set_state(file_id, title, UPLOADED, call_id=call_id, url=url, participant_names='|'.join(participant_names),
+                       original_size=original_size, uploaded_size=uploaded_size)
+
+    def mark_retrying(self, file_id, title, retries, next_attempt_at, reason):
+        # Waits for the commit, so the retry survives a restart
+        self.set_state(file_id, title, RETRYING, reason=reason, retries=retries, next_attempt_at=next_attempt_at, wait=True)
+
+    def claim(self, file_id, title, owner, lease_seconds):
+        """
+        Takes the lease of a file for `owner`, committed before it returns.
+        Returns (claimed, row), the row showing who holds the file and its state if it wasn't claimed.
+        """
+        now = time.time()
+        params = {'id': file_id, 'title': title, 'owner': owner, 'now': now, 'expires_at': now + lease_seconds}
+        with self.read_lock:
+            with self.connection:
+                claimed = self.connection.execute(CLAIM, params).rowcount == 1
+            row = self.connection.execute('SELECT * FROM files WHERE id = ?', (file_id,)).fetchone()
+        return claimed, dict(row)
+
+    def holds_lease(self, file_id, owner):
+        with self.read_lock:
+            row = self.connection.execute(HOLDS_LEASE, {'id': file_id, 'owner': owner, 'now': time.time()}).fetchone()
+        return row is not None
+
+    def check_lease(self, file_id, owner):
+        if not self.holds_lease(file_id, owner):
+            raise LeaseLostError(f"Lease of {file_id} lost by {owner}")
+
+    def renew_leases(self, owner, lease_seconds):
+        """
+        Extends every lease `owner` still holds and returns how many there are.
+        """
+        now = time.time()
+        with self.read_lock, self.connection:
+            return self.connection.execute(RENEW_LEASES, {'owner': owner, 'now': now, 'expires_at': now + lease_seconds}).rowcount
+
+    def release_leases(self, owner):
+        # After the pending writes, so a state written by this process isn't committed after its release
+        self.flush()
+        with self.read_lock, self.connection:
+            return self.connection.execute(RELEASE_LEASES, {'owner': owner}).rowcount
+
+    def reserve_call_id(self, file_id, owner, make_unique_id, first_number=0):
+        """
+        Reserves a Gong clientUniqueId for a new call of a file whose lease `owner` holds, and returns it.
+        The ids are `make_unique_id(number)` with numbers counting up from `first_number`, skipping every
+        id reserved before, so each is used for one call at most even across processes and restarts.
+        Raises LeaseLostError if the lease was lost.
+        """
+        with self.read_lock:
+            # An immediate transaction takes the write lock first, so the check and the insert are atomic
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                if self.connection.execute(HOLDS_LEASE, {'id': file_id, 'owner': owner, 'now': time.time()}).fetchone() is None:
+                    raise LeaseLostError(f"Lease of {file_id} lost by {owner}")
+                reserved = self.connection.execute('SELECT COUNT(*) FROM gong_calls WHERE file_id = ?', (file_id,)).fetchone()[0]
+                number = max(first_number, reserved)
+                while self.connection.execute('SELECT 1 FROM gong_calls WHERE client_unique_id = ?', (make_unique_id(number),)).fetchone():
+                    number += 1
+                unique_id = make_unique_id(number)
+                self.connection.execute(
+                    'INSERT INTO gong_calls (client_unique_id, file_id, owner, created_at) VALUES (?, ?, ?, ?)',
+                    (unique_id, file_id, owner, time.time()),
+                )
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+        return unique_id
+
+    def record_call_id(self, unique_id, call_id):
+        self._write('UPDATE gong_calls SET call_id = :call_id WHERE client_unique_id = :unique_id',
+                    {'unique_id': unique_id, 'call_id': str(call_id)}, wait=False)
+
+    def mark_short(self, file_id, title):
+        self.set_state(file_id, title, SHORT)
+
+    def mark_error(self, file_id, title, reason):
+        self.set_state(file_id, title, ERROR, reason=reason)
+
+    def record_content(self, file_id, call_id, hashes):
+        """
+        Adds the content hashes of an uploaded file, a dict of hash type to hash, to the content index.
+        """
+        for hash_type, value in hashes.items():
+            if value:
+                params = {'hash_type': hash_type, 'hash': value, 'file_id': file_id, 'call_id': None if call_id is None else str(call_id), 'now': time.time()}
+                self._write(INSERT_CONTENT_HASH, params, wait=True)
+
+    def find_content(self, hash_type, value):
+        """
+        Returns the content index entry for a hash, or None if that content hasn't been uploaded.
+        """
+        if not value:
+            return None
+        with self.read_lock:
+            row = self.connection.execute(
+                'SELECT * FROM content_hashes WHERE hash_type = ? AND hash = ?', (hash_type, value)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def backfill_drive_md5(self, file_list):
+        """
+        Indexes the Drive md5Checksum of every uploaded file in `file_list` that isn't indexed yet.
+        """
+        now = time.time()
+        rows = [
+            {'hash_type': DRIVE_MD5, 'hash': f['md5Checksum'], 'file_id': f['id'], 'now': now}
+            for f in file_list if f.get('md5Checksum')
+        ]
+        self.flush()
+        with self.read_lock, self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(BACKFILL_DRIVE_MD5, rows)
+            return self.connection.total_changes - before
+
+    def get(self, file_id):
+        with self.read_lock:
+            row = self.connection.execute('SELECT * FROM files WHERE id = ?', (file_id,)).fetchone()
+        return dict(row) if row else None
+
+    def is_finished(self, file_id):
+        row = self.get(file_id)
+        return row is not None and row['state'] in FINISHED_STATES
+
+    def finished_ids(self):
+        with self.read_lock:
+            rows = self.connection.execute(
+                f"SELECT id FROM files WHERE state IN ({','.join('?' * len(FINISHED_STATES))})", FINISHED_STATES
+            ).fetchall()
+        return {row['id'] for row in rows}
+
+    def pending_retries(self):
+        """
+        Returns {file id: (retries, next_attempt_at)} of the files waiting to be retried.
+        """
+        with self.read_lock:
+            rows = self.connection.execute(
+                'SELECT id, retries, next_attempt_at FROM files WHERE state = ?', (RETRYING,)
+            ).fetchall()
+        return {row['id']: (row['retries'], row['next_attempt_at']) for row in rows}
+
+    def count_by_state(self):
+        with self.read_lock:
+            rows = self.connection.execute('SELECT state, COUNT(*) AS count FROM files GROUP BY state').fetchall()
+        return {row['state']: row['count'] for row in rows}
+
+    def is_empty(self):
+        with self.read_lock:
+            return self.connection.execute('SELECT 1 FROM files LIMIT 1').fetchone() is None
+
+    def flush(self):
+        done = PendingWrite()
+        self.queue.put((None, None, done))
+        done.wait()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+        self.connection.close()
+
+    def _write_batches(self):
+        connection = connect(self.path)
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            # Wait for a batch to fill unless someone is waiting on a write, then only take what is queued
+            waiting = item[2] is not None
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    if waiting:
+                        item = self.queue.get_nowait()
+                    else:
+                        item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+                waiting = waiting or item[2] is not None
+            errors = self._commit(connection, batch)
+            for (sql, params, done), error in zip(batch, errors):
+                if done:
+                    done.set(error)
+                elif error is not None:
+                    self.logger.error("State update of %s lost - ERROR: %s", params.get('id'), error)
+        connection.close()
+
+    def _commit(self, connection, batch):
+        """
+        Commits a batch and returns the error of each of its updates, None for those written.
+        """
+        for attempt in range(1, self.write_attempts + 1):
+            try:
+                # Rolled back as a whole if any statement fails
+                with connection:
+                    for sql, params, _ in batch:
+                        if sql is not None:
+                            connection.execute(sql, params)
+                return [None] * len(batch)
+            except Exception as e:
+                self.logger.warning("State batch of %d updates failed, attempt %d/%d - ERROR: %s", len(batch), attempt, self.write_attempts, e)
+                if attempt < self.write_attempts:
+                    time.sleep(self.retry_delay * attempt)
+        # One at a time, so an update that can't be written doesn't take the rest of the batch with it
+        errors = []
+        for sql, params, _ in batch:
+            try:
+                if sql is not None:
+                    with connection:
+                        connection.execute(sql, params)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+    def import_csvs(self, completed_csv, short_csv, error_csv):
+        """
+        Loads the CSV ledgers into the store in one transaction and returns the number of rows.
+        """
+        now = time.time()
+        rows = []
+        for path, state in ((completed_csv, UPLOADED), (short_csv, SHORT), (error_csv, ERROR)):
+            for row in read_csv(path):
+                rows.append({
+                    'id': row['id'],
+                    'title': row.get('title'),
+                    'state': state,
+                    'reason': row.get('reason'),
+                    'call_id': row.get('call_id'),
+                    'url': row.get('url'),
+                    'participant_names': row.get('participant_names'),
+                    'original_size': row.get('original_size') or None,
+                    'uploaded_size': row.get('uploaded_size') or None,
+                    'attempts': 0,
+                    'retries': None,
+                    'next_attempt_at': None,
+                    'now': now,
+                })
+        self.flush()
+        with self.read_lock, self.connection:
+            self.connection.executemany(UPSERT, rows)
+        return len(rows)
+
+    def export_csvs(self, completed_csv, short_csv, error_csv):
+        self.flush()
+        exports = (
+            (completed_csv, UPLOADED, COMPLETED_FIELDS),
+            (short_csv, SHORT, SHORT_FIELDS),
+            (error_csv, ERROR, ERROR_FIELDS),
+        )
+        for path, state, fieldnames in exports:
+            with self.read_lock:
+                rows = self.connection.execute('SELECT * FROM files WHERE state = ? ORDER BY updated_at', (state,)).fetchall()
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow({field: row[field] for field in fieldnames})
+
+
+class LeaseHeartbeat:
+    """
+    Renews the leases of `owner` every `interval` seconds on a thread, for as long as the process runs.
+    """
+    def __init__(self, state_store: StateStore, owner, lease_seconds, interval, logger=None):
+        self.state_store = state_store
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name="lease-heartbeat", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                renewed = self.state_store.renew_leases(self.owner, self.lease_seconds)
+                self.logger.debug("Renewed %d leases of %s", renewed, self.owner)
+            except Exception:
+                # The next beat tries again, the leases last several intervals
+                self.logger.exception("Renewing the leases of %s failed", self.owner)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def read_progress(path):
+    """
+    Returns (finished file ids, {file id: (retries, next_attempt_at)} of the files waiting to be retried)
+    from the database at `path`, opened read-only so nothing in it changes. The finished ids are None
+    while the database holds no files.
+    """
+    connection = sqlite3.connect(f"{Path(path).absolute().as_uri()}?mode=ro", uri=True, timeout=30)
+    connection.row_factory = sqlite3.Row
+    try:
+        if connection.execute('SELECT 1 FROM files LIMIT 1').fetchone() is None:
+            return None, {}
+        rows = connection.execute(
+            f"SELECT id FROM files WHERE state IN ({','.join('?' * len(FINISHED_STATES))})", FINISHED_STATES
+        ).fetchall()
+        finished_ids = {row['id'] for row in rows}
+        rows = connection.execute('SELECT id, retries, next_attempt_at FROM files WHERE state = ?', (RETRYING,)).fetchall()
+        return finished_ids, {row['id']: (row['retries'], row['next_attempt_at']) for row in rows}
+    except sqlite3.OperationalError as e:
+        # Created but never set up
+        if 'no such table' not in str(e):
+            raise
+        return None, {}
+    finally:
+        connection.close()
+
+def read_csv(path):
+    try:
+        with open(path, 'r') as f:
+            return list(csv.DictReader(f))
+    except FileNotFoundError:
+        return []
+
+
+if __name__ == "__main__":
+    from settings import STATE_DB, COMPLETED_LIST_CSV, SHORT_VIDEO_LIST_CSV, ERROR_VIDEO_LIST_CSV
+
+    parser = argparse.ArgumentParser(description='Import or export the CSV ledgers of the state database')
+    parser.add_argument('command', choices=['import', 'export'])
+    args = parser.parse_args()
+
+    state_store = StateStore(STATE_DB)
+    if args.command == 'import':
+        count = state_store.import_csvs(COMPLETED_LIST_CSV, SHORT_VIDEO_LIST_CSV, ERROR_VIDEO_LIST_CSV)
+        print(f"Imported {count} rows into {STATE_DB}")
+    else:
+        state_store.export_csvs(COMPLETED_LIST_CSV, SHORT_VIDEO_LIST_CSV, ERROR_VIDEO_LIST_CSV)
+        print(f"Exported {state_store.count_by_state()} to CSV")
+    state_store.close()
@@ -0,0 +1,120 @@
+# Description: Non-blocking logging for the worker threads.
+# Records are put on a queue by the calling thread and formatted and written by a single listener
+# thread: JSON lines to a size-rotated file and text to the console, each sink with its own level.
+# The file id and stage of the work running on a thread are added to every record it logs.
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+from contextlib import contextmanager
+
+CONTEXT_FIELDS = ('file_id', 'stage')
+
+# Attributes every LogRecord has, anything else on a record came from `extra` or the log context
+STANDARD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'taskName'}
+
+_context = threading.local()
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Adds `fields` (e.g. file_id, stage) to every record logged by this thread inside the block.
+    """
+    previous = getattr(_context, 'fields', {})
+    _context.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copies the thread's log context onto each record, without overriding fields passed in `extra`.
+    Runs on the logging thread, before the record is queued.
+    """
+    def filter(self, record):
+        fields = getattr(_context, 'fields', {})
+        for name in CONTEXT_FIELDS:
+            if not hasattr(record, name):
+                setattr(record, name, fields.get(name))
+        for name, value in fields.items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records as they are. QueueHandler would format the message and traceback on the
+    calling thread so records can be pickled, but the queue never leaves the process, so that
+    work is left to the listener thread.
+    """
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line with the time, level, thread and message, the fields from the log
+    context or `extra` (file_id, stage, duration, ...) and the traceback if there is one.
+    """
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for name, value in record.__dict__.items():
+            if name not in STANDARD_ATTRIBUTES and value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The console format, with the file id in front of the message when there is one.
+    """
+    def formatMessage(self, record):
+        values = dict(record.__dict__)
+        if values.get('file_id'):
+            values['message'] = f"ID: {values['file_id']} - {values['message']}"
+        return self._fmt % values
+
+
+def configure_logging(name, log_file, file_level='DEBUG', console_level='INFO', max_bytes=50 * 1024 * 1024, backup_count=10):
+    """
+    Sets up the logger `name` to log through a queue to a rotating JSON lines file and the console.
+    Returns the logger; the listener thread is stopped, and the queue drained, at exit.
+    """
+    file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setLevel(file_level)
+    file_handler.setFormatter(JsonFormatter())
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(TextFormatter('%(asctime)s - %(levelname)s - %(threadName)s: %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    logger = logging.getLogger(name)
+    # Records below every sink's level are dropped before their message is ever formatted
+    logger.setLevel(min(file_handler.level, console_handler.level))
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    return logger
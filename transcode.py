@@ -0,0 +1,50 @@
+# Description: Shrinks recordings before they are uploaded to Gong, which only needs the conversation audio.
+# 'audio' copies the audio track out of the MP4 without re-encoding it, 'lowres' re-encodes the video at a low
+# resolution and bitrate and keeps the audio as it is. ffmpeg is run from a pool of processes, one per CPU core.
+
+import multiprocessing
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+AUDIO = 'audio'
+LOWRES = 'lowres'
+MODES = (AUDIO, LOWRES)
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def output_path(base_path, mode):
+    return f"{base_path}.audio.m4a" if mode == AUDIO else f"{base_path}.lowres.mp4"
+
+def ffmpeg_command(source, destination, mode, height=360, max_kbps=600):
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', source]
+    if mode == AUDIO:
+        command += ['-vn', '-c:a', 'copy']
+    elif mode == LOWRES:
+        command += ['-vf', f"scale=-2:{height}", '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '30',
+                    '-maxrate', f"{max_kbps}k", '-bufsize', f"{2 * max_kbps}k", '-c:a', 'copy']
+    else:
+        raise ValueError(f"Unknown transcode mode {mode}, expected one of {MODES}")
+    # The index up front, so nothing has to seek to the end of the file to read it
+    return command + ['-movflags', '+faststart', destination]
+
+def transcode(source, destination, mode, height=360, max_kbps=600):
+    """
+    Writes the transcoded `source` to `destination` and returns its size. Runs in a pool process.
+    """
+    try:
+        result = subprocess.run(ffmpeg_command(source, destination, mode, height, max_kbps), capture_output=True)
+    except FileNotFoundError:
+        raise TranscodeError('ffmpeg not found, please install ffmpeg on your system.')
+    if result.returncode != 0:
+        if os.path.exists(destination):
+            os.remove(destination)
+        raise TranscodeError(f"ffmpeg exited with {result.returncode}: {result.stderr.decode(errors='replace')[-500:]}")
+    return os.path.getsize(destination)
+
+def make_pool(workers):
+    # Spawned rather than forked: the parent has threads, and this module is all the workers import
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
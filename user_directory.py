@@ -0,0 +1,220 @@
+# Description: Cache of the Gong user directory that call participants are matched to.
+# The users are fetched from /v2/users and saved in DATA_DIR as gzipped JSON rows, written atomically so
+# readers never see half a file. During a run the cache is fetched again in the background once it is older
+# than its TTL, and the matcher is only rebuilt and swapped in when the users changed.
+
+import gzip
+import json
+import logging
+import os
+import pickle
+import time
+from threading import Thread, Event, Lock
+
+from atomic_file import atomic_write
+from metrics import counter, gauge
+from user_matcher import UserMatcher, user_map_fingerprint
+
+DIRECTORY_VERSION = 1
+# The user fields saved, in the order of each row
+USER_FIELDS = ('id', 'firstName', 'lastName', 'emailAddress')
+
+DIRECTORY_REFRESHES = counter('user_directory_refreshes_total', 'Fetches of the Gong user directory', ['outcome'])
+DIRECTORY_USERS = gauge('user_directory_users', 'Users in the Gong user directory in use')
+
+
+def fetch_users(gong_client):
+    """
+    Returns every user of the Gong account. The pages come one after the other, each holds the cursor of the next.
+    """
+    users = []
+    cursor = None
+    while True:
+        response = gong_client.get("/v2/users", params={'cursor': cursor})
+        response.raise_for_status()
+        page = response.json()
+        users.extend(page['users'])
+        cursor = page['records'].get('cursor')
+        if not cursor:
+            return users
+
+def compact_users(users):
+    """
+    Returns a row of USER_FIELDS for each active user whose telephony calls are imported, the only ones calls
+    can be matched to.
+    """
+    return sorted(
+        [user[field] for field in USER_FIELDS]
+        for user in users
+        if user['active'] and user['settings']['telephonyCallsImported']
+    )
+
+def map_user_names(rows):
+    """
+    Maps every name variant of the users to their id.
+    """
+    user_map = {}
+    for user_id, first_name, last_name, email in rows:
+        # map full name to id
+        user_map[f"{first_name} {last_name}"] = user_id
+        user_map[f"{first_name} - {last_name}"] = user_id
+        # map email to id
+        user_map[email] = user_id
+        # map id to id
+        user_map[user_id] = user_id
+        # map first name and last initial to id
+        user_map[f"{first_name} {last_name[0]}"] = user_id
+        # map first initial and last name to id
+        user_map[f"{first_name[0]} {last_name}"] = user_id
+    return user_map
+
+def build_user_map(users):
+    return map_user_names(compact_users(users))
+
+def save_directory(path, rows, fetched_at):
+    """
+    Writes the rows, gzipped, and renames them over `path` once they are on disk.
+    """
+    data = json.dumps({'version': DIRECTORY_VERSION, 'fetched_at': fetched_at, 'fields': USER_FIELDS, 'users': rows},
+                      separators=(',', ':'))
+    with atomic_write(path, 'wb', fsync=True) as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as compressed:
+            compressed.write(data.encode())
+
+def load_directory(path):
+    """
+    Returns (rows, fetched_at) of a saved directory, or None if it is missing, unreadable or from another version.
+    """
+    try:
+        with gzip.open(path, 'rb') as f:
+            saved = json.loads(f.read())
+    except (FileNotFoundError, OSError, EOFError, ValueError):
+        return None
+    if not isinstance(saved, dict) or saved.get('version') != DIRECTORY_VERSION or tuple(saved.get('fields', ())) != USER_FIELDS:
+        return None
+    return saved['users'], saved['fetched_at']
+
+
+class UserDirectory:
+    """
+    Matches participant names to Gong users with the directory cached at `path`.
+
+    `open()` loads the cache, or the user map pickled by older versions, and only fetches the users right
+    away when there is neither. `start()` then refreshes it in a thread once it is `ttl` seconds old, and
+    `retry_interval` seconds after a failed fetch. A cache written meanwhile by another process sharing the
+    folder is picked up instead of fetching again. `match` always answers from the matcher in memory.
+    """
+    def __init__(self, path, gong_client, ttl, retry_interval=300.0, matcher_path=None, legacy_map_path=None, logger=None):
+        self.path = path
+        self.gong_client = gong_client
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.matcher_path = matcher_path
+        self.legacy_map_path = legacy_map_path
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = Lock()
+        self.matcher = None
+        self.fingerprint = None
+        self.fetched_at = 0.0
+        self.loaded_mtime = None
+        self.stopped = Event()
+        self.thread = None
+
+    def match(self, name):
+        return self.matcher.match(name)
+
+    def _use(self, user_map, user_count, fetched_at, source):
+        """
+        Swaps in a matcher for `user_map` if it differs from the one in use. Returns whether it did.
+        """
+        self.fetched_at = fetched_at
+        fingerprint = user_map_fingerprint(user_map)
+        if fingerprint == self.fingerprint:
+            return False
+        matcher = UserMatcher.load(self.matcher_path, user_map) if self.matcher_path else None
+        if matcher is None:
+            self.logger.info("Building user matcher for %d names", len(user_map))
+            matcher = UserMatcher(user_map)
+            if self.matcher_path:
+                matcher.save(self.matcher_path)
+        # A single assignment, lookups already running finish with the matcher they started with
+        self.matcher, self.fingerprint = matcher, fingerprint
+        DIRECTORY_USERS.set(user_count)
+        self.logger.info("User directory from %s: %d users, fetched %s", source, user_count,
+                         time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(fetched_at)) if fetched_at else 'never')
+        return True
+
+    def load(self):
+        """
+        Loads the cache if it changed on disk since the last load. Returns False if there is no usable cache.
+        """
+        with self.lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                return False
+            if mtime == self.loaded_mtime:
+                return True
+            saved = load_directory(self.path)
+            if saved is None:
+                self.logger.warning("Ignoring unreadable user directory %s", self.path)
+                return False
+            rows, fetched_at = saved
+            self.loaded_mtime = mtime
+            self._use(map_user_names(rows), len(rows), fetched_at, self.path)
+            return True
+
+    def refresh(self):
+        """
+        Fetches the users from Gong and saves them. Returns whether they changed.
+        """
+        with self.lock:
+            rows = compact_users(fetch_users(self.gong_client))
+            fetched_at = time.time()
+            # Saved even when unchanged, so the next run knows how old it is
+            save_directory(self.path, rows, fetched_at)
+            self.loaded_mtime = os.stat(self.path).st_mtime_ns
+            changed = self._use(map_user_names(rows), len(rows), fetched_at, 'Gong')
+        DIRECTORY_REFRESHES.inc(outcome='changed' if changed else 'unchanged')
+        if not changed:
+            self.logger.debug("User directory unchanged, %d users", len(rows))
+        return changed
+
+    def is_stale(self):
+        return time.time() - self.fetched_at >= self.ttl
+
+    def open(self):
+        if self.load():
+            return self
+        if self.legacy_map_path and os.path.exists(self.legacy_map_path):
+            with open(self.legacy_map_path, 'rb') as f:
+                user_map = pickle.load(f)
+            # Used until the first refresh, which is due right away
+            self._use(user_map, len(set(user_map.values())), 0.0, self.legacy_map_path)
+        else:
+            self.refresh()
+        return self
+
+    def start(self):
+        self.thread = Thread(target=self._run, name="user-directory", daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        delay = max(0.0, self.fetched_at + self.ttl - time.time())
+        while not self.stopped.wait(delay):
+            try:
+                self.load()
+                if self.is_stale():
+                    self.refresh()
+                delay = max(0.0, self.fetched_at + self.ttl - time.time())
+            except Exception:
+                # The directory in use stays
+                DIRECTORY_REFRESHES.inc(outcome='failed')
+                self.logger.exception("Refreshing the user directory failed, trying again in %.0fs", self.retry_interval)
+                delay = self.retry_interval
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
@@ -0,0 +1,125 @@
+# Description: Matches participant names to Gong user ids with an Aho-Corasick automaton
+# built once over all the name variants in the user map.
+
+import hashlib
+import pickle
+
+from atomic_file import atomic_write
+
+MATCHER_VERSION = 2
+
+
+def normalize_name(name):
+    return ' '.join(str(name).casefold().split())
+
+def user_map_fingerprint(user_map):
+    digest = hashlib.sha256()
+    for key, value in sorted(user_map.items()):
+        digest.update(f"{key}\0{value}\0".encode())
+    return digest.hexdigest()
+
+
+class UserMatcher:
+    """
+    Finds the user whose name variant (full name, email, initials, ...) appears in a
+    participant name. Names are compared case and whitespace insensitively, and a variant
+    only counts when it starts and ends on a token boundary: the start or end of the name,
+    or a character that is not a letter or digit. An exact match wins, otherwise the longest
+    variant found in the name, and between variants of the same length the one that starts first.
+    """
+    def __init__(self, user_map):
+        self.fingerprint = user_map_fingerprint(user_map)
+        self.exact = {}
+        self.patterns = []
+        # Sorted so the result never depends on the order of the user map
+        for key, value in sorted(user_map.items()):
+            normalized = normalize_name(key)
+            if normalized and normalized not in self.exact:
+                self.exact[normalized] = value
+                self.patterns.append((normalized, value))
+        self._build()
+
+    def _build(self):
+        # goto[node] maps a character to the next node, fail[node] is the longest proper
+        # suffix that is also a trie node, output[node] is the index of the pattern ending
+        # exactly at this node (or None), and dict_link[node] is the longest proper suffix
+        # that ends a pattern (or the root)
+        self.goto = [{}]
+        self.output = [None]
+        for index, (pattern, _) in enumerate(self.patterns):
+            node = 0
+            for char in pattern:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append({})
+                    self.output.append(None)
+                node = next_node
+            self.output[node] = index
+
+        self.fail = [0] * len(self.goto)
+        self.dict_link = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                suffix = self.fail[child]
+                self.dict_link[child] = suffix if self.output[suffix] is not None else self.dict_link[suffix]
+
+    def find(self, name):
+        """
+        Returns (variant, user_id) of the best match in `name`, or None.
+        """
+        text = normalize_name(name)
+        if text in self.exact:
+            return text, self.exact[text]
+        best = None
+        node = 0
+        for end, char in enumerate(text, 1):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            if end < len(text) and text[end].isalnum():
+                continue
+            # The patterns ending here, longest first
+            found = node if self.output[node] is not None else self.dict_link[node]
+            while found:
+                index = self.output[found]
+                start = end - len(self.patterns[index][0])
+                if start == 0 or not text[start - 1].isalnum():
+                    if best is None or len(self.patterns[index][0]) > len(self.patterns[best][0]):
+                        best = index
+                    break
+                found = self.dict_link[found]
+        return self.patterns[best] if best is not None else None
+
+    def match(self, name):
+        found = self.find(name)
+        return found[1] if found else None
+
+    def save(self, path):
+        with atomic_write(path, 'wb') as f:
+            pickle.dump({'version': MATCHER_VERSION, 'matcher': self}, f)
+
+    @classmethod
+    def load(cls, path, user_map=None):
+        """
+        Loads a saved matcher. Returns None if the file is missing, from another version,
+        or was built from a different user map than `user_map`.
+        """
+        try:
+            with open(path, 'rb') as f:
+                saved = pickle.load(f)
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        if not isinstance(saved, dict) or saved.get('version') != MATCHER_VERSION:
+            return None
+        matcher = saved['matcher']
+        if user_map is not None and matcher.fingerprint != user_map_fingerprint(user_map):
+            return None
+        return matcher
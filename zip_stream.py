@@ -0,0 +1,133 @@
+# Description: Hashes a member of a zip archive from the archive's bytes as they arrive, so a download
+# doesn't have to be read back to hash what is inside it. The local file headers are parsed in order
+# until the member is found; stored members are hashed as they are and deflated ones as they decompress.
+
+import hashlib
+import struct
+import zipfile
+import zlib
+
+ZIP64_EXTRA_ID = 0x0001
+ENCRYPTED_FLAG = 0x1
+DATA_DESCRIPTOR_FLAG = 0x8
+UTF8_FLAG = 0x800
+
+
+class ZipMemberHasher:
+    """
+    Fed the bytes of a zip archive from the start with `update`, hashes the content of the first member
+    whose name ends with `suffix`. `name` and `hexdigest()` are set once the member was read to its end.
+    Archives it can't follow, like members whose size only comes after their data or encrypted ones,
+    leave `hexdigest()` None and the member has to be hashed from the finished file.
+    """
+    def __init__(self, suffix, algorithm='sha256'):
+        self.suffix = suffix
+        self.algorithm = algorithm
+        self.reset()
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.state = 'header'
+        self.remaining = 0
+        self.name = None
+        self.digest = None
+        self.decompressor = None
+        self.result = None
+
+    def hexdigest(self):
+        return self.result
+
+    def update(self, data):
+        data = memoryview(data)
+        while data and self.state not in ('done', 'failed'):
+            if self.state == 'header':
+                data = self._read_header(data)
+            elif self.state == 'skip':
+                skipped = min(self.remaining, len(data))
+                self.remaining -= skipped
+                data = data[skipped:]
+                if not self.remaining:
+                    self.state = 'header'
+            else:
+                data = self._hash(data)
+
+    def _header_size(self):
+        if len(self.buffer) < zipfile.sizeFileHeader:
+            return zipfile.sizeFileHeader
+        fields = struct.unpack(zipfile.structFileHeader, self.buffer[:zipfile.sizeFileHeader])
+        return zipfile.sizeFileHeader + fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH]
+
+    def _read_header(self, data):
+        # The fixed part first, then the name and extra field it gives the lengths of
+        while len(self.buffer) < self._header_size():
+            if not data:
+                return data
+            taken = min(self._header_size() - len(self.buffer), len(data))
+            self.buffer += data[:taken]
+            data = data[taken:]
+            if len(self.buffer) >= 4 and self.buffer[:4] != zipfile.stringFileHeader:
+                # The central directory, or something we don't understand: no such member to hash here
+                self.state = 'failed'
+                return data
+
+        fields = struct.unpack(zipfile.structFileHeader, self.buffer[:zipfile.sizeFileHeader])
+        flags = fields[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS]
+        method = fields[zipfile._FH_COMPRESSION_METHOD]
+        compressed_size = fields[zipfile._FH_COMPRESSED_SIZE]
+        name_end = zipfile.sizeFileHeader + fields[zipfile._FH_FILENAME_LENGTH]
+        name = bytes(self.buffer[zipfile.sizeFileHeader:name_end]).decode('utf-8' if flags & UTF8_FLAG else 'cp437')
+        if compressed_size == 0xFFFFFFFF:
+            compressed_size = self._zip64_compressed_size(bytes(self.buffer[name_end:]), fields)
+        self.buffer = bytearray()
+
+        if flags & ENCRYPTED_FLAG or (flags & DATA_DESCRIPTOR_FLAG and method != zipfile.ZIP_DEFLATED) or compressed_size is None:
+            self.state = 'failed'
+        elif name.endswith(self.suffix):
+            if method == zipfile.ZIP_DEFLATED:
+                # Decompressed until the deflate stream ends, its size may only be in a data descriptor
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            elif method != zipfile.ZIP_STORED:
+                self.state = 'failed'
+                return data
+            self.name = name
+            self.digest = hashlib.new(self.algorithm)
+            self.remaining = compressed_size
+            self.state = 'member'
+        elif flags & DATA_DESCRIPTOR_FLAG:
+            # Where the next header starts depends on a descriptor we can't tell apart from data
+            self.state = 'failed'
+        else:
+            self.remaining = compressed_size
+            self.state = 'skip' if compressed_size else 'header'
+        return data
+
+    def _zip64_compressed_size(self, extra, fields):
+        offset = 0
+        while offset + 4 <= len(extra):
+            field_id, size = struct.unpack_from('<HH', extra, offset)
+            if field_id == ZIP64_EXTRA_ID:
+                values = extra[offset + 4:offset + 4 + size]
+                # The uncompressed size comes first when it is in the extra field too
+                index = 8 if fields[zipfile._FH_UNCOMPRESSED_SIZE] == 0xFFFFFFFF else 0
+                if len(values) >= index + 8:
+                    return struct.unpack_from('<Q', values, index)[0]
+                return None
+            offset += 4 + size
+        return None
+
+    def _hash(self, data):
+        if self.decompressor:
+            self.digest.update(self.decompressor.decompress(data))
+            if self.decompressor.eof:
+                self._finish()
+            return b''
+        taken = min(self.remaining, len(data))
+        self.digest.update(data[:taken])
+        self.remaining -= taken
+        if not self.remaining:
+            self._finish()
+        return data[taken:]
+
+    def _finish(self):
+        self.result = self.digest.hexdigest()
+        self.state = 'done'